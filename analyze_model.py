@@ -4,9 +4,13 @@ import argparse
 import numpy as np
 import configparser
 from keras.models import load_model
-from tools.plotting_tools import plot_feature_label_prediction
-from tools.data_tools import DataSequence, get_data_generator, preprocess_feature, preprocess_label
-from tools.loss_metrics_tools import weighted_categorical_crossentropy, focal_loss, weighted_focal_loss
+from tools.model_tools import set_float_dtype
+from tools.inference_tools import TiledPredictor, get_tile_shape
+from tools.export_tools import FrozenModel
+from tools.plotting_tools import EventRenderer
+from tools.data_tools import DataSequence
+from tools.weights_tools import load_class_weights
+from tools.metrics_tools import confusion_matrix, print_class_metrics, print_iou_comparison
 
 def argument_parser():
     ap = argparse.ArgumentParser()
@@ -15,24 +19,36 @@ def argument_parser():
     ap.add_argument("-s", "--statistics", required=True,
 	   help='''Choose number of events to run over to calculate statistics.
              Options are 'Training' or 'Development'.''')
+    ap.add_argument("-f", "--format", default="pdf",
+	   help="Choose format of the plots between 'pdf' (vector) or 'png' (raster).")
+    ap.add_argument("-w", "--workers", default="1",
+	   help="Number of processes drawing the plots.")
+    ap.add_argument("-c", "--compare", default=None,
+	   help="Graph exported by export_model.py to run side by side with the Keras model.")
     return vars(ap.parse_args())
 
-def intersection_over_union(y_true, y_pred, epsilon=1e-6):
-    intersection = np.sum(y_true * y_pred)
-    union = np.sum(y_true + y_pred)
-
+def intersection_over_union(intersection, union, epsilon=1e-6):
     return (2.0 * (intersection + epsilon)/(union + epsilon))
 
-def average_intersection_over_union(y_true, y_pred, class_names):
+def accumulate_intersection_union(totals, y_true, y_pred):
+    """
+    Add the per-class intersection and union of a batch to 'totals' (num_classes x 2);
+    y_true is a class map of integers and y_pred the softmax output.
+    """
+    for c in range(y_pred.shape[-1]):
+        true_c = y_true[:,:,:,0] == c
+        totals[c, 0] += np.sum(true_c * y_pred[:,:,:,c], dtype=np.float64)
+        totals[c, 1] += np.sum(true_c, dtype=np.float64) + np.sum(y_pred[:,:,:,c], dtype=np.float64)
+
+def average_intersection_over_union(totals, n_preds, class_names):
     """
     Average over classes and batch
     """
-    n_preds = y_pred.shape[0]
     print('\nNumber of validation samples IoU evaulated on: {}'.format(n_preds))
 
     total_iou = 0
     for c in range(len(class_names)):
-        iou = intersection_over_union(y_true[:,:,:,c], y_pred[:,:,:,c])
+        iou = intersection_over_union(totals[c, 0], totals[c, 1])
         print('IoU for {} is: {:.3f}'.format(class_names[c], iou))
         total_iou += iou
 
@@ -48,6 +64,23 @@ def main():
         print("Exiting!\n")
         sys.exit(1)
 
+    FORMAT = args["format"]
+    if FORMAT not in ["pdf", "png"]:
+        print("\nError: Format should be either 'pdf' or 'png'")
+        print("Exiting!\n")
+        sys.exit(1)
+    try:
+        WORKERS = int(args["workers"])
+    except ValueError:
+        print("\nError: Workers should be an integer.")
+        print("Exiting!\n")
+        sys.exit(1)
+    COMPARE = args["compare"]
+    if COMPARE is not None and not os.path.isfile(COMPARE):
+        print("\nError: The graph {} doesn't exist; make it with export_model.py".format(COMPARE))
+        print("Exiting!\n")
+        sys.exit(1)
+
     config = configparser.ConfigParser()
     config_path = os.path.join("configurations", "master_configuration.ini")
     config.read(config_path)
@@ -67,8 +100,20 @@ def main():
     IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
     IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
     IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
+    PLANES = config["DEFAULT"]["PLANES"].split()
     CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
     WEIGHTS = np.array(list(map(float, config["DEFAULT"]["WEIGHTS"].split())))
+    WEIGHTS_FILE = config["DEFAULT"]["WEIGHTS_FILE"]
+    if os.path.isfile(WEIGHTS_FILE):
+        WEIGHTS = load_class_weights(WEIGHTS_FILE, CLASS_NAMES)
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
+    FLOAT_DTYPE = config["DEFAULT"]["FLOAT_DTYPE"]
+    EVALUATION_BATCH_SIZE = int(config["DEFAULT"]["EVALUATION_BATCH_SIZE"])
+    TILE_SIZE = int(config["DEFAULT"]["TILE_SIZE"])
+    TILE_OVERLAP = int(config["DEFAULT"]["TILE_OVERLAP"])
+    TILE_BATCH_SIZE = int(config["DEFAULT"]["TILE_BATCH_SIZE"])
+    SKIP_EMPTY_TILES = config["DEFAULT"].getboolean("SKIP_EMPTY_TILES")
+    ADC_THRESHOLD = float(config["DEFAULT"]["ADC_THRESHOLD"])
 
     FEATURE_FILE_TESTING = config["DEFAULT"]["FEATURE_FILE_TESTING"]
     LABEL_FILE_TESTING = config["DEFAULT"]["LABEL_FILE_TESTING"]
@@ -76,60 +121,123 @@ def main():
     print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
     print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
     print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
+    print("PLANES: {}".format(PLANES))
     print("CLASS_NAMES: {}".format(CLASS_NAMES))
     print("FEATURE_FILE_TESTING: {}".format(FEATURE_FILE_TESTING))
     print("LABEL_FILE_TESTING: {}".format(LABEL_FILE_TESTING))
     print("WEIGHTS: {}".format(WEIGHTS))
+    print("WEIGHTS_FILE: {}".format(WEIGHTS_FILE))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
+    print("FLOAT_DTYPE: {}".format(FLOAT_DTYPE))
+    print("EVALUATION_BATCH_SIZE: {}".format(EVALUATION_BATCH_SIZE))
+    print("TILE_SIZE: {}".format(TILE_SIZE))
+    print("TILE_OVERLAP: {}".format(TILE_OVERLAP))
+    print("TILE_BATCH_SIZE: {}".format(TILE_BATCH_SIZE))
+    print("SKIP_EMPTY_TILES: {}".format(SKIP_EMPTY_TILES))
+    print("ADC_THRESHOLD: {}".format(ADC_THRESHOLD))
     print()
 
-    # Get the model
-    model_path = os.path.join("saved_models", "model_and_weights.hdf5")
-    model = load_model(model_path, custom_objects={"loss": focal_loss()})
-
-    # Make comparision plots
-    generator_testing = get_data_generator(FEATURE_FILE_TESTING, LABEL_FILE_TESTING)
-    count = 0
-    for X, y in generator_testing:
-        if count >= NUM_EVENTS_PLOTS:
-            break
-        count += 1
-
-        X_preprocessed = preprocess_feature(X, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH)
-        y_preprocessed = preprocess_label(y, IMAGE_WIDTH, IMAGE_HEIGHT, len(CLASS_NAMES))
-        y_preprocessed_max = np.argmax(y_preprocessed, axis=3)
-
-        prediction = model.predict_on_batch(X_preprocessed)
-        prediction_max = np.argmax(prediction, axis=3)
-
-        feature_image = X_preprocessed.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        label_image = y_preprocessed_max.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        prediction_image = prediction_max.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-
-        plot_feature_label_prediction_path = os.path.join("plots",  "predictions", "prediction_event_{}.pdf".format(count))
-        plot_feature_label_prediction(feature_image, label_image,  prediction_image,
-                                      'Feature', 'Label', 'Model prediction', CLASS_NAMES, plot_feature_label_prediction_path)
-
-    # Calculate Statistics
-    samples = np.zeros((NUM_TESTING, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH))
-    targets = np.zeros((NUM_TESTING, IMAGE_WIDTH, IMAGE_HEIGHT, len(CLASS_NAMES)))
-
-    generator_testing = get_data_generator(FEATURE_FILE_TESTING, LABEL_FILE_TESTING)
-    count = 0
-    for X, y in generator_testing:
-        if count >= NUM_TESTING:
-            break
-        samples[count,:,:,:] = preprocess_feature(X, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH)
-        targets[count,:,:,:] = preprocess_label(y, IMAGE_WIDTH, IMAGE_HEIGHT, len(CLASS_NAMES))
-        count += 1
-
-    predictions = model.predict_on_batch(samples)
-    average_intersection_over_union(targets, predictions, CLASS_NAMES)
+    # The plotting processes are started before TensorFlow, which shouldn't be forked
+    with EventRenderer(CLASS_NAMES, workers=WORKERS) as renderer:
+        # Get the model; only used to predict, so the loss and metrics of its training config aren't loaded
+        set_float_dtype(FLOAT_DTYPE)
+        model_path = os.path.join("saved_models", "model_and_weights.hdf5")
+        model = load_model(model_path, compile=False)
+
+        # Events of any size are predicted through overlapping tiles of the model input
+        tile_shape = get_tile_shape(model, TILE_SIZE)
+        print("Predicting {}x{} tiles".format(*tile_shape))
+        predictor = TiledPredictor(model, tile_shape, TILE_OVERLAP, TILE_BATCH_SIZE,
+                                   skip_empty=SKIP_EMPTY_TILES, threshold=ADC_THRESHOLD)
+
+        # The exported model predicts the same tiles of the same events
+        if COMPARE is not None:
+            exported_model = FrozenModel(COMPARE)
+            print("Comparing with the {} graph {}".format(exported_model.info["quantization"], COMPARE))
+            exported_predictor = TiledPredictor(exported_model, tile_shape, TILE_OVERLAP, TILE_BATCH_SIZE,
+                                                skip_empty=SKIP_EMPTY_TILES, threshold=ADC_THRESHOLD)
+            exported_matrix = np.zeros((len(CLASS_NAMES), len(CLASS_NAMES)), dtype=np.int64)
+            agreeing = 0
+
+        # One pass over the testing events, a batch at a time: make the comparison plots for the
+        # first events and accumulate the statistics, so memory doesn't grow with NUM_TESTING.
+        # The planes are stacked as channels; TiledPredictor splits them for a model with an input per plane
+        datasequence_testing = DataSequence(feature_file=FEATURE_FILE_TESTING,
+                                            label_file=LABEL_FILE_TESTING,
+                                            image_width=IMAGE_WIDTH,
+                                            image_height=IMAGE_HEIGHT,
+                                            image_depth=len(PLANES) if len(PLANES) > 1 else IMAGE_DEPTH,
+                                            num_classes=len(CLASS_NAMES),
+                                            max_index=max(NUM_TESTING, NUM_EVENTS_PLOTS),
+                                            batch_size=EVALUATION_BATCH_SIZE,
+                                            data_format=DATA_FORMAT,
+                                            dtype=FLOAT_DTYPE,
+                                            planes=PLANES)
+
+        totals = np.zeros((len(CLASS_NAMES), 2))
+        matrix = np.zeros((len(CLASS_NAMES), len(CLASS_NAMES)), dtype=np.int64)
+        correct = 0
+        count = 0
+        for index in range(len(datasequence_testing)):
+            samples, targets = datasequence_testing[index]
+            # The samples are scaled per event, so a threshold in ADC counts needs the stored values
+            adc = datasequence_testing.read_adc(index) if SKIP_EMPTY_TILES and ADC_THRESHOLD > 0 else None
+            predictions = predictor.predict(samples, adc)
+            predictions_max = np.argmax(predictions, axis=3)
+            if COMPARE is not None:
+                exported_predictions_max = np.argmax(exported_predictor.predict(samples, adc), axis=3)
+
+            for j in range(len(samples)):
+                if count + j >= NUM_EVENTS_PLOTS:
+                    break
+                # The plane of the labels
+                feature_image = samples[j, ..., -1].reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
+                label_image = targets[j].reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
+                prediction_image = predictions_max[j].reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
+
+                plot_feature_label_prediction_path = os.path.join("plots",  "predictions",
+                                                                  "prediction_event_{}.{}".format(count + j + 1, FORMAT))
+                renderer.submit("feature_label_prediction", feature_image, label_image, prediction_image,
+                                plot_feature_label_prediction_path)
+
+            # Calculate Statistics
+            rows = min(len(samples), NUM_TESTING - count)
+            if rows > 0:
+                accumulate_intersection_union(totals, targets[:rows], predictions[:rows])
+                correct += np.sum(predictions_max[:rows] == targets[:rows,:,:,0])
+                matrix += confusion_matrix(targets[:rows], predictions_max[:rows], len(CLASS_NAMES))
+                if COMPARE is not None:
+                    exported_matrix += confusion_matrix(targets[:rows], exported_predictions_max[:rows], len(CLASS_NAMES))
+                    agreeing += np.sum(exported_predictions_max[:rows] == predictions_max[:rows])
+            count += len(samples)
+
+    print('\nInference: {}'.format(predictor.report()))
+
+    n_preds = min(count, NUM_TESTING)
+    average_intersection_over_union(totals, n_preds, CLASS_NAMES)
+
+    # Per-class metrics of the predicted class maps
+    print('\nConfusion matrix (rows are labels, columns are predictions):\n{}\n'.format(matrix))
+    print_class_metrics(matrix, CLASS_NAMES)
 
     # Print the test accuracy
-    score = model.evaluate(samples, targets, verbose=0)
-    accuracy = 100*score[1]
+    accuracy = 100.0*correct/max(n_preds*IMAGE_WIDTH*IMAGE_HEIGHT, 1)
     print('\nTest accuracy of the model is: {:.2f}%'.format(accuracy))
 
+    if COMPARE is not None:
+        exported_model.close()
+        print('\nExported {} model: {}'.format(exported_model.info["quantization"], exported_predictor.report()))
+        print('Speed-up over the Keras model: {:.2f}x'.format(
+            (exported_predictor.num_events/max(exported_predictor.seconds, 1e-9))/
+            (predictor.num_events/max(predictor.seconds, 1e-9))))
+        print('Size: {:.2f} MB of Keras weights ({:.2f} MB file), {:.2f} MB exported graph'.format(
+            sum(w.nbytes for w in model.get_weights())/2.0**20, os.path.getsize(model_path)/2.0**20,
+            os.path.getsize(COMPARE)/2.0**20))
+        print('Pixels with the same class: {:.3f}%\n'.format(
+            100.0*agreeing/max(n_preds*IMAGE_WIDTH*IMAGE_HEIGHT, 1)))
+        print_iou_comparison(matrix, exported_matrix, CLASS_NAMES,
+                             names=("Keras", exported_model.info["quantization"]))
+
     print("\nDone!\n")
 
 if __name__ == "__main__":
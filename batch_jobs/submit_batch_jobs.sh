@@ -39,6 +39,8 @@ echo "JOB $SLURM_JOB_ID is running on $SLURM_JOB_NODELIST "
 echo "*********************************************************"
 echo ""
 srun python train_model.py -o Training -e Default
+## Per-step profile (steps.csv, summary.json) of this job
+echo "Profile: logs/profile/*_job_$SLURM_JOB_ID"
 
 echo "*********************************************************"
 echo "Running python analyze_model.py"
@@ -0,0 +1,39 @@
+#!/bin/sh
+
+## Set number of nodes for the job
+#SBATCH -N 2
+
+## One replica per node, using all of its cores
+#SBATCH --ntasks-per-node 1
+#SBATCH -c 16
+
+## Specify requested time
+## day-hr
+#SBATCH -t 7-00:00:00
+
+## Specify stdout, stderr log; default is slurm-jobid.out
+#SBATCH -o output_parallel.log
+#SBATCH -e error_parallel.log
+
+echo ""
+echo "*********************************************************"
+echo "This was run on:"
+date
+echo "*********************************************************"
+echo ""
+module load anaconda2
+source activate envDeepLearningWithProtoDUNE
+cd ../
+
+## Replica 0 listens on the first node
+MASTER=$(scontrol show hostnames $SLURM_JOB_NODELIST | head -n 1)
+
+## Secret of this job, shared by its replicas through srun's environment
+export PARALLEL_AUTHKEY=$(openssl rand -hex 16)
+
+echo "*********************************************************"
+echo "Running python train_parallel.py with $SLURM_NTASKS replicas"
+echo "JOB $SLURM_JOB_ID is running on $SLURM_JOB_NODELIST "
+echo "*********************************************************"
+echo ""
+srun sh -c "python train_parallel.py -o Training -e Default -w \$SLURM_NTASKS -r \$SLURM_PROCID -a $MASTER:29500 -t \$SLURM_CPUS_PER_TASK"
@@ -0,0 +1,290 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import configparser
+import numpy as np
+
+# The model benchmarks measure CPU step times
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+from tools.csv_tools import CSVEventReader
+from tools.store_tools import cast_adc, convert_to_store, convert_events_to_hits, get_hits_store
+from tools.data_tools import get_data_generator, preprocess_features, preprocess_feature, preprocess_label
+from tools.data_tools import DataSequence
+from tools.benchmark_tools import make_synthetic_events, write_synthetic_csv, legacy_data_generator, time_generator
+from tools.benchmark_tools import legacy_batch, time_function, add_result, save_results, load_results, compare_results
+
+BENCHMARKS = ["csv", "dtype", "loader", "preprocess", "model", "variants"]
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-b", "--benchmark", required=True,
+	   help="Choose benchmark; options are {} or 'all'.".format(", ".join("'{}'".format(b) for b in BENCHMARKS)))
+    ap.add_argument("-e", "--events", default="100",
+	   help="Number of synthetic events.")
+    ap.add_argument("-r", "--repeats", default="3",
+	   help="Best of this many repeats is kept.")
+    ap.add_argument("-j", "--json", default=None,
+	   help="Save the results to this JSON file.")
+    ap.add_argument("-c", "--compare", default=None,
+	   help="Compare with the results in this JSON file and flag regressions.")
+    ap.add_argument("-t", "--tolerance", default="0.1",
+	   help="Relative change that counts as a regression.")
+    ap.add_argument("--filters", default="8,16",
+	   help="Comma separated num_filters of the model benchmark.")
+    ap.add_argument("--batch-sizes", default="1,2",
+	   help="Comma separated batch sizes of the model benchmark.")
+    ap.add_argument("--sizes", default="64,128",
+	   help="Comma separated image sizes (multiples of 16) of the model benchmark.")
+    ap.add_argument("--depths", default="4,3",
+	   help="Comma separated U-Net depths of the variants benchmark.")
+    ap.add_argument("--widths", default="1,0.5,0.25",
+	   help="Comma separated width multipliers of the variants benchmark.")
+    ap.add_argument("--separable", default="0,1",
+	   help="Variants with normal (0) and/or depthwise-separable (1) convolution blocks.")
+    ap.add_argument("--additive", default="0,1",
+	   help="Variants with concatenated (0) and/or additive (1) skip connections.")
+    return vars(ap.parse_args())
+
+def benchmark_csv(results, directory, num_events, image_width, image_height, repeats):
+    """
+    Events per second of csv parsing, row by row (legacy) versus in blocks.
+    """
+    features, labels = make_synthetic_events(num_events, image_width, image_height)
+    feature_file, label_file = write_synthetic_csv(directory, features, labels)
+
+    legacy = time_generator(lambda: legacy_data_generator(feature_file, label_file), repeats)
+    blocks = time_generator(lambda: get_data_generator(feature_file, label_file), repeats)
+    add_result(results, "csv/row_by_row", legacy, "events/s")
+    add_result(results, "csv/blocks", blocks, "events/s")
+    print("Speed-up: {:.1f}x".format(blocks/legacy))
+
+def benchmark_dtype(results, num_events, image_width, image_height, image_depth, num_classes, batch_size, repeats):
+    """
+    Memory and batches per second of the float64 one-hot batches versus the dtype policy.
+    """
+    features, labels = make_synthetic_events(batch_size, image_width, image_height)
+    adc = cast_adc(features, np.uint16)
+    repeats = max(repeats, num_events//batch_size)
+
+    def policy_batch(dtype):
+        samples = np.empty((batch_size, image_width, image_height, image_depth), dtype=dtype)
+        preprocess_features(adc, samples)
+        targets = labels.astype(np.uint8).reshape(batch_size, image_width, image_height, 1)
+        return samples, targets
+
+    candidates = [("float64_one_hot", lambda: legacy_batch(features, labels, image_width, image_height,
+                                                           image_depth, num_classes)),
+                  ("uint16_to_float32", lambda: policy_batch(np.float32)),
+                  ("uint16_to_float16", lambda: policy_batch(np.float16))]
+    print("Batch of {} events:".format(batch_size))
+    for name, make_batch in candidates:
+        samples, targets = make_batch()
+        add_result(results, "dtype/{}/batch_size".format(name), (samples.nbytes + targets.nbytes)/1e6, "MB",
+                   higher_is_better=False)
+        add_result(results, "dtype/{}/speed".format(name), 1.0/max(time_function(make_batch, repeats), 1e-9),
+                   "batches/s")
+    print("Stored event: float32 {:.2f} MB, uint16 {:.2f} MB".format(features[0].nbytes/1e6, adc[0].nbytes/1e6))
+
+def benchmark_loader(results, directory, num_events, image_width, image_height, image_depth, num_classes,
+                     batch_size, repeats):
+    """
+    Events per second of get_data_generator and DataSequence for every data format.
+    """
+    features, labels = make_synthetic_events(num_events, image_width, image_height)
+    feature_file, label_file = write_synthetic_csv(directory, features, labels)
+    convert_to_store(feature_file, label_file, np.uint16)
+    convert_events_to_hits(CSVEventReader(feature_file, label_file), get_hits_store(feature_file),
+                           image_width, image_height, np.uint16)
+
+    for data_format in ["csv", "npy", "sparse"]:
+        rate = time_generator(lambda: get_data_generator(feature_file, label_file, data_format), repeats)
+        add_result(results, "loader/get_data_generator/{}".format(data_format), rate, "events/s")
+
+        sequence = DataSequence(feature_file, label_file, image_width, image_height, image_depth, num_classes,
+                                max_index=num_events, batch_size=batch_size, data_format=data_format, shuffle=True)
+        seconds = time_function(lambda: [sequence[index] for index in range(len(sequence))], repeats)
+        add_result(results, "loader/DataSequence/{}".format(data_format), num_events/max(seconds, 1e-9),
+                   "events/s")
+
+def benchmark_preprocess(results, num_events, image_width, image_height, image_depth, repeats):
+    """
+    Microseconds per event of the feature scaling and label reshaping, one event at a time and in batches.
+    """
+    features, labels = make_synthetic_events(num_events, image_width, image_height)
+    adc = cast_adc(features, np.uint16)
+
+    seconds = time_function(lambda: [preprocess_feature(x, image_width, image_height, image_depth)
+                                     for x in adc], repeats)
+    add_result(results, "preprocess/preprocess_feature", 1e6*seconds/num_events, "us/event", higher_is_better=False)
+
+    seconds = time_function(lambda: [preprocess_label(y, image_width, image_height) for y in labels], repeats)
+    add_result(results, "preprocess/preprocess_label", 1e6*seconds/num_events, "us/event", higher_is_better=False)
+
+    out = np.empty((num_events, image_width, image_height, image_depth), dtype=np.float32)
+    seconds = time_function(lambda: preprocess_features(adc, out), repeats)
+    add_result(results, "preprocess/preprocess_features", 1e6*seconds/num_events, "us/event",
+               higher_is_better=False)
+
+def benchmark_model(results, filters, batch_sizes, sizes, image_depth, num_classes, repeats):
+    """
+    Forward and forward/backward step times of the U-Net on CPU, sweeping num_filters, batch size and image size.
+    """
+    from keras import backend as K
+    from keras.layers import Input
+    from keras.optimizers import SGD
+    from tools.model_tools import get_unet_model
+    from tools.loss_metrics_tools import sparse_focal_loss
+
+    rng = np.random.RandomState(0)
+    for size in sizes:
+        for num_filters in filters:
+            K.clear_session()
+            model = get_unet_model(Input((size, size, image_depth)), num_classes, num_filters=num_filters)
+            target_tensor = K.placeholder(ndim=4, dtype="uint8", name="target")
+            model.compile(optimizer=SGD(lr=1e-5), loss=sparse_focal_loss(), target_tensors=[target_tensor])
+            for batch_size in batch_sizes:
+                x = rng.rand(batch_size, size, size, image_depth).astype(np.float32)
+                y = rng.randint(0, num_classes, (batch_size, size, size, 1)).astype(np.uint8)
+                # The first calls build the functions
+                model.predict_on_batch(x)
+                model.train_on_batch(x, y)
+
+                name = "model/filters_{}/batch_{}/size_{}".format(num_filters, batch_size, size)
+                forward = time_function(lambda: model.predict_on_batch(x), repeats)
+                step = time_function(lambda: model.train_on_batch(x, y), repeats)
+                add_result(results, name + "/forward", 1e3*forward, "ms/batch", higher_is_better=False)
+                add_result(results, name + "/train_step", 1e3*step, "ms/batch", higher_is_better=False)
+                add_result(results, name + "/train_speed", batch_size/max(step, 1e-9), "samples/s")
+
+def benchmark_variants(results, num_filters, depths, widths, separables, additives, image_width, image_height,
+                       image_depth, num_classes, batch_size, repeats):
+    """
+    Parameters, operations and CPU inference speed on full images of the U-Net variants;
+    the speed-up is relative to the first variant.
+    """
+    from keras import backend as K
+    from keras.layers import Input
+    from tools.model_tools import get_unet_model, count_flops
+
+    x = np.random.RandomState(0).rand(batch_size, image_width, image_height, image_depth).astype(np.float32)
+    baseline = None
+    for depth in depths:
+        if image_width % 2**depth or image_height % 2**depth:
+            print("Depth {} doesn't fit {}x{} images, skipped".format(depth, image_width, image_height))
+            continue
+        for width in widths:
+            for separable in separables:
+                for additive in additives:
+                    K.clear_session()
+                    model = get_unet_model(Input((image_width, image_height, image_depth)), num_classes,
+                                           num_filters=num_filters, depth=depth, width_multiplier=width,
+                                           separable=separable, additive_skips=additive)
+                    # The first call builds the function
+                    model.predict_on_batch(x)
+                    rate = batch_size/max(time_function(lambda: model.predict_on_batch(x), repeats), 1e-9)
+
+                    name = "variants/depth_{}/width_{}/{}/{}".format(depth, width,
+                                                                     "separable" if separable else "conv",
+                                                                     "add" if additive else "concat")
+                    add_result(results, name + "/parameters", model.count_params(), "", higher_is_better=False)
+                    add_result(results, name + "/operations", count_flops(model)/1e9, "GFLOPs/image",
+                               higher_is_better=False)
+                    add_result(results, name + "/speed", rate, "images/s")
+                    baseline = baseline or rate
+                    print("{:55s} {:12.2f}x".format(name + "/speed_up", rate/baseline))
+
+def main():
+    args = argument_parser()
+    try:
+        NUM_EVENTS = int(args["events"])
+        REPEATS = int(args["repeats"])
+        TOLERANCE = float(args["tolerance"])
+        FILTERS = [int(x) for x in args["filters"].split(",")]
+        BATCH_SIZES = [int(x) for x in args["batch_sizes"].split(",")]
+        SIZES = [int(x) for x in args["sizes"].split(",")]
+        DEPTHS = [int(x) for x in args["depths"].split(",")]
+        WIDTHS = [float(x) for x in args["widths"].split(",")]
+        SEPARABLE = [bool(int(x)) for x in args["separable"].split(",")]
+        ADDITIVE = [bool(int(x)) for x in args["additive"].split(",")]
+    except ValueError:
+        print("\nError: Events, repeats, filters, batch sizes, sizes, depths, separable and additive should be"
+              " integers; tolerance and widths numbers.")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    benchmarks = BENCHMARKS if args["benchmark"] == "all" else [args["benchmark"]]
+    if any(benchmark not in BENCHMARKS for benchmark in benchmarks):
+        print("\nError: Benchmark should be one of {} or 'all'".format(", ".join(BENCHMARKS)))
+        print("Exiting!\n")
+        sys.exit(1)
+    if any(size % 16 for size in SIZES):
+        print("\nError: Sizes should be multiples of 16")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
+    IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
+    IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
+    CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    BATCH_SIZE = int(config["DEFAULT"]["BATCH_SIZE"])
+    NUM_FILTERS = int(config["DEFAULT"]["NUM_FILTERS"])
+    print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
+    print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
+    print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
+    print("CLASS_NAMES: {}".format(CLASS_NAMES))
+    print("BATCH_SIZE: {}".format(BATCH_SIZE))
+    print("NUM_FILTERS: {}".format(NUM_FILTERS))
+    print("Running over {} synthetic events, best of {} repeats.\n".format(NUM_EVENTS, REPEATS))
+
+    # Same synthetic events (fixed seed) and settings every time, so results can be compared
+    results = {}
+    settings = {"events": NUM_EVENTS, "repeats": REPEATS, "image_width": IMAGE_WIDTH,
+                "image_height": IMAGE_HEIGHT, "batch_size": BATCH_SIZE, "filters": FILTERS,
+                "batch_sizes": BATCH_SIZES, "sizes": SIZES, "num_filters": NUM_FILTERS, "depths": DEPTHS,
+                "widths": WIDTHS, "separable": SEPARABLE, "additive": ADDITIVE}
+    directory = tempfile.mkdtemp()
+    try:
+        for benchmark in benchmarks:
+            print("\nBenchmark: {}".format(benchmark))
+            benchmark_directory = os.path.join(directory, benchmark)
+            if benchmark == "csv":
+                benchmark_csv(results, benchmark_directory, NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT, REPEATS)
+            elif benchmark == "dtype":
+                benchmark_dtype(results, NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH, len(CLASS_NAMES),
+                                BATCH_SIZE, REPEATS)
+            elif benchmark == "loader":
+                benchmark_loader(results, benchmark_directory, NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH,
+                                 len(CLASS_NAMES), BATCH_SIZE, REPEATS)
+            elif benchmark == "preprocess":
+                benchmark_preprocess(results, NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH, REPEATS)
+            elif benchmark == "model":
+                benchmark_model(results, FILTERS, BATCH_SIZES, SIZES, IMAGE_DEPTH, len(CLASS_NAMES), REPEATS)
+            elif benchmark == "variants":
+                benchmark_variants(results, NUM_FILTERS, DEPTHS, WIDTHS, SEPARABLE, ADDITIVE, IMAGE_WIDTH,
+                                   IMAGE_HEIGHT, IMAGE_DEPTH, len(CLASS_NAMES), BATCH_SIZE, REPEATS)
+    finally:
+        shutil.rmtree(directory)
+
+    if args["json"]:
+        save_results(args["json"], results, settings)
+        print("\nResults are saved in {}".format(args["json"]))
+
+    if args["compare"]:
+        print("\nComparison with {}:".format(args["compare"]))
+        regressions = compare_results(results, load_results(args["compare"])["results"], TOLERANCE)
+        if regressions:
+            print("\n{} regressions beyond {:.0f}%!\n".format(len(regressions), 100*TOLERANCE))
+            sys.exit(1)
+
+    print("\nDone!\n")
+
+if __name__ == "__main__":
+    main()
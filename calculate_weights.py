@@ -1,22 +1,20 @@
 import os
+import argparse
 import configparser
-from tqdm import tqdm
-from collections import Counter
-from tools.data_tools import get_data_generator
+import numpy as np
 from tools.plotting_tools import plot_weights_median
+from tools.weights_tools import get_class_counts, get_event_weights, get_median_weights, save_class_weights
 
-def get_class_weights(y):
-    """
-    Returns the weights for each class based on the frequencies of the samplesself.
-    For 3 classes with classA:10%, classB:50% and classC:40%, weights will be: {0:1, 1:0.2, 2:0.25}
-    The loss will be 5x more for miss-classifying classA than for classB and so on...
-    """
-    counter = Counter(y)
-
-    minority = min(counter.values())
-    return {cls: float(minority) / float(count) for cls, count in counter.items()}
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-a", "--add", nargs=2, action="append", default=[], metavar=("FEATURE_FILE", "LABEL_FILE"),
+	   help="Also include this feature/label pair; can be repeated.")
+    ap.add_argument("-w", "--workers", default=str(os.cpu_count() or 1),
+	   help="Number of processes scanning the events.")
+    return vars(ap.parse_args())
 
 def main():
+    args = argument_parser()
     config = configparser.ConfigParser()
     config_path = os.path.join("configurations", "master_configuration.ini")
     config.read(config_path)
@@ -25,24 +23,42 @@ def main():
     FEATURE_FILE_TRAINING = config["DEFAULT"]["FEATURE_FILE_TRAINING"]
     LABEL_FILE_TRAINING = config["DEFAULT"]["LABEL_FILE_TRAINING"]
     CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
+    WEIGHTS_FILE = config["DEFAULT"]["WEIGHTS_FILE"]
+    IMAGE_SHAPE = (int(config["DEFAULT"]["IMAGE_WIDTH"]), int(config["DEFAULT"]["IMAGE_HEIGHT"]))
+    WORKERS = int(args["workers"])
 
     print("FEATURE_FILE_TRAINING: {}".format(FEATURE_FILE_TRAINING))
     print("LABEL_FILE_TRAINING: {}".format(LABEL_FILE_TRAINING))
     print("CLASS_NAMES: {}".format(CLASS_NAMES))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
+    print("WEIGHTS_FILE: {}".format(WEIGHTS_FILE))
+    print("WORKERS: {}".format(WORKERS))
     print()
 
-    iter_data = get_data_generator(FEATURE_FILE_TRAINING, LABEL_FILE_TRAINING)
-    weights = [[],[],[]]
-    for X, y in tqdm(iter_data):
-        class_weights = get_class_weights(y)
-        for index, weight in class_weights.items():
-            weights[index].append(weight)
+    # Every file is scanned once, after that its class counts come from its cached event index
+    files = [(FEATURE_FILE_TRAINING, LABEL_FILE_TRAINING)] + [tuple(pair) for pair in args["add"]]
+    counts = []
+    for feature_file, label_file in files:
+        file_counts = get_class_counts(feature_file, label_file, DATA_FORMAT, IMAGE_SHAPE, len(CLASS_NAMES), WORKERS)
+        print("{}: {} events, pixels per class {}".format(label_file, len(file_counts), file_counts.sum(axis=0)))
+        counts.append(file_counts)
+    counts = np.concatenate(counts)
+
+    event_weights = get_event_weights(counts)
+    medians = get_median_weights(event_weights)
+    weights = [event_weights[~np.isnan(event_weights[:, c]), c] for c in range(len(CLASS_NAMES))]
 
     ranges = [(0,0.04), (0,0.4), (0.8, 1.2)]
 
     plot_path = os.path.join("plots", "weights_median.pdf")
     plot_weights_median(weights, ranges, CLASS_NAMES, plot_path)
-    print("\nDone! Plot with median weights for each class is saved at {}!\n".format(plot_path))
+
+    save_class_weights(WEIGHTS_FILE, CLASS_NAMES, medians, [label_file for _, label_file in files], len(counts))
+    print("\nMedian weights: {}".format(" ".join("{}: {:.3f}".format(name, weight)
+                                                   for name, weight in zip(CLASS_NAMES, medians))))
+    print("\nDone! Plot with median weights for each class is saved at {}".format(plot_path))
+    print("and the weights at {}, where train_model.py reads them from!\n".format(WEIGHTS_FILE))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import argparse
+import configparser
+from tools.csv_tools import CSVEventReader, get_row_offsets
+from tools.store_tools import convert_to_store, convert_events_to_hits, convert_hits_csv, get_hits_store
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-f", "--format", required=True,
+	   help='''Choose format between 'npy' (dense binary store) or 'sparse' (hit lists).
+             For 'sparse', hits_w.csv written by RootToCSV is used if present.''')
+    return vars(ap.parse_args())
+
+def main():
+    args = argument_parser()
+    if args["format"] not in ["npy", "sparse"]:
+        print("\nError: Format should be either 'npy' or 'sparse'")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
+    IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
+    ADC_DTYPE = config["DEFAULT"]["ADC_DTYPE"]
+    print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
+    print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
+    print("ADC_DTYPE: {}".format(ADC_DTYPE))
+
+    for split in ["TRAINING", "VALIDATION", "TESTING"]:
+        feature_file = config["DEFAULT"]["FEATURE_FILE_{}".format(split)]
+        label_file = config["DEFAULT"]["LABEL_FILE_{}".format(split)]
+
+        if args["format"] == "npy":
+            print("\nConverting {} and {}".format(feature_file, label_file))
+            feature_store, label_store = convert_to_store(feature_file, label_file, ADC_DTYPE)
+            print("Saved {} and {}".format(feature_store, label_store))
+            continue
+
+        hits_store = get_hits_store(feature_file)
+        hits_file = hits_store + ".csv"
+        if os.path.isfile(hits_file):
+            print("\nConverting {}".format(hits_file))
+            # Events without hits aren't in the hit list; the dense csv, if there is one, has them all
+            num_events = len(get_row_offsets(feature_file)) - 1 if os.path.isfile(feature_file) else None
+            try:
+                num_events = convert_hits_csv(hits_file, hits_store, IMAGE_WIDTH, IMAGE_HEIGHT, ADC_DTYPE, num_events)
+            except ValueError as exception:
+                print("\nError: {}".format(exception))
+                print("Exiting!\n")
+                sys.exit(1)
+        else:
+            print("\nConverting {} and {}".format(feature_file, label_file))
+            reader = CSVEventReader(feature_file, label_file)
+            num_events = convert_events_to_hits(reader, hits_store, IMAGE_WIDTH, IMAGE_HEIGHT, ADC_DTYPE)
+        print("Saved {} events in {}".format(num_events, hits_store))
+
+    print("\nDone! Set DATA_FORMAT = {} in the configuration to use it.\n".format(args["format"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import argparse
+import configparser
+from keras import backend as K
+from keras.models import load_model
+from tools.model_tools import set_float_dtype
+from tools.data_tools import DataSequence
+from tools.inference_tools import get_tile_shape
+from tools.export_tools import QUANTIZATIONS, freeze_model, optimize_graph, store_weights_as_float16
+from tools.export_tools import quantize_int8, iterate_tiles, save_graph
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-q", "--quantization", default="none",
+	   help="Options are 'none' (float32), 'float16' (weights stored as float16) or 'int8' (eight-bit ops).")
+    ap.add_argument("-c", "--calibration", default="100",
+	   help="Number of training events to calibrate the int8 ranges on.")
+    ap.add_argument("-o", "--output", default=None,
+	   help="Graph file; saved_models/model_frozen_<quantization>.pb by default.")
+    return vars(ap.parse_args())
+
+def main():
+    args = argument_parser()
+    QUANTIZATION = args["quantization"]
+    if QUANTIZATION not in QUANTIZATIONS:
+        print("\nError: Quantization should be one of {}".format(", ".join(QUANTIZATIONS)))
+        print("Exiting!\n")
+        sys.exit(1)
+    try:
+        NUM_CALIBRATION = int(args["calibration"])
+    except ValueError:
+        print("\nError: Calibration events should be an integer.")
+        print("Exiting!\n")
+        sys.exit(1)
+    if NUM_CALIBRATION < 1:
+        print("\nError: Calibration needs at least one event.")
+        print("Exiting!\n")
+        sys.exit(1)
+    OUTPUT = args["output"] or os.path.join("saved_models", "model_frozen_{}.pb".format(QUANTIZATION))
+
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
+    IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
+    IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
+    PLANES = config["DEFAULT"]["PLANES"].split()
+    CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
+    FLOAT_DTYPE = config["DEFAULT"]["FLOAT_DTYPE"]
+    EVALUATION_BATCH_SIZE = int(config["DEFAULT"]["EVALUATION_BATCH_SIZE"])
+    TILE_SIZE = int(config["DEFAULT"]["TILE_SIZE"])
+    FEATURE_FILE_TRAINING = config["DEFAULT"]["FEATURE_FILE_TRAINING"]
+    LABEL_FILE_TRAINING = config["DEFAULT"]["LABEL_FILE_TRAINING"]
+
+    print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
+    print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
+    print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
+    print("PLANES: {}".format(PLANES))
+    print("CLASS_NAMES: {}".format(CLASS_NAMES))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
+    print("FLOAT_DTYPE: {}".format(FLOAT_DTYPE))
+    print("EVALUATION_BATCH_SIZE: {}".format(EVALUATION_BATCH_SIZE))
+    print("TILE_SIZE: {}".format(TILE_SIZE))
+    print("FEATURE_FILE_TRAINING: {}".format(FEATURE_FILE_TRAINING))
+    print("LABEL_FILE_TRAINING: {}".format(LABEL_FILE_TRAINING))
+    print()
+
+    if QUANTIZATION != "none" and FLOAT_DTYPE != "float32":
+        print("\nError: Quantization needs a float32 model, FLOAT_DTYPE is {}".format(FLOAT_DTYPE))
+        print("Exiting!\n")
+        sys.exit(1)
+
+    # Built in the test phase, so that the graph has no training branches
+    K.set_learning_phase(0)
+    set_float_dtype(FLOAT_DTYPE)
+    model_path = os.path.join("saved_models", "model_and_weights.hdf5")
+    model = load_model(model_path, compile=False)
+    if isinstance(model.input, list):
+        print("\nError: Only models with a single input can be exported; train with PLANE_MODE = channels")
+        print("Exiting!\n")
+        sys.exit(1)
+    input_name = model.input.op.name
+    output_name = model.output.op.name
+
+    graph_def = optimize_graph(freeze_model(model), input_name, output_name)
+    if QUANTIZATION == "float16":
+        graph_def = store_weights_as_float16(graph_def)
+    elif QUANTIZATION == "int8":
+        # Calibrated on the tiles the model sees in TiledPredictor
+        tile_shape = get_tile_shape(model, TILE_SIZE)
+        datasequence_calibration = DataSequence(feature_file=FEATURE_FILE_TRAINING,
+                                                label_file=LABEL_FILE_TRAINING,
+                                                image_width=IMAGE_WIDTH,
+                                                image_height=IMAGE_HEIGHT,
+                                                image_depth=len(PLANES) if len(PLANES) > 1 else IMAGE_DEPTH,
+                                                num_classes=len(CLASS_NAMES),
+                                                max_index=NUM_CALIBRATION,
+                                                batch_size=EVALUATION_BATCH_SIZE,
+                                                data_format=DATA_FORMAT,
+                                                dtype=FLOAT_DTYPE,
+                                                planes=PLANES)
+        batches = (tiles for index in range(len(datasequence_calibration))
+                   for tiles in iterate_tiles(datasequence_calibration[index][0], tile_shape, EVALUATION_BATCH_SIZE))
+        print("Calibrating the int8 ranges on {} training events".format(NUM_CALIBRATION))
+        graph_def = quantize_int8(graph_def, input_name, output_name, batches)
+
+    info = {"input": input_name,
+            "output": output_name,
+            "input_shape": list(model.input_shape),
+            "output_shape": list(model.output_shape),
+            "quantization": QUANTIZATION,
+            "calibration_events": NUM_CALIBRATION if QUANTIZATION == "int8" else 0,
+            "class_names": CLASS_NAMES}
+    save_graph(graph_def, OUTPUT, info)
+    print("Saved the {} graph to {}: {:.2f} MB, against {:.2f} MB of Keras weights".format(
+        QUANTIZATION, OUTPUT, os.path.getsize(OUTPUT)/2.0**20, sum(w.nbytes for w in model.get_weights())/2.0**20))
+
+    print("\nDone!\n")
+
+if __name__ == "__main__":
+    main()
@@ -18,8 +18,8 @@
 
 using namespace std;
 
-RootToCSV :: RootToCSV(const TString input, const TString output, const int minHits)
-    : InputFile(input), OutputDirectory(output), MinHitsBeam(minHits)
+RootToCSV :: RootToCSV(const TString input, const TString output, const int minHits, const bool sparse)
+    : InputFile(input), OutputDirectory(output), MinHitsBeam(minHits), Sparse(sparse)
 {
 }
 
@@ -37,6 +37,11 @@ void RootToCSV::SetMinHitsBeam(const int minHits)
 {
     MinHitsBeam = minHits;
 }
+
+void RootToCSV::SetSparse(const bool sparse)
+{
+    Sparse = sparse;
+}
 ///////////////////////////////////////////////////////////////////////////////////////
 void RootToCSV::MakeCSV()
 {
@@ -65,17 +70,35 @@ void RootToCSV::MakeCSV()
     ofstream FileOutput[6]; // 3 planes x (Feature + Label)
     TString FileName[6] = {"feature_u.csv", "feature_v.csv", "feature_w.csv", "label_u.csv", "label_v.csv", "label_w.csv"};
 
+    // In sparse mode there is one hit list per plane
+    unsigned int nFiles = 6;
+    TString SparseFileName[3] = {"hits_u.csv", "hits_v.csv", "hits_w.csv"};
+    if(Sparse)
+        {
+            nFiles = 3;
+            for (unsigned int iFile = 0; iFile < nFiles; iFile++)
+                {
+                    FileName[iFile] = SparseFileName[iFile];
+                }
+            cout << "Writing only the non-zero pixels." << endl;
+        }
+
     // Save histograms for hits
     TFile *HistogramFile = new TFile("Histograms.root", "RECREATE");
     TH1D *hHits = new TH1D("hHits", "", 100, 0, 100000);
     TH1D *hHitsBeam = new TH1D("hHitsBeam", "", 200, 0, 10000);
 
-    for (unsigned int iFile = 0; iFile < 6; iFile++)
+    for (unsigned int iFile = 0; iFile < nFiles; iFile++)
         {
             // Create and open the .csv file
             FileOutput[iFile].open(OutputDirectory + FileName[iFile]);
 
             // Write the file headers
+            if(Sparse)
+                {
+                    FileOutput[iFile] << "Event,Wire,TDC,ADC,Label" << endl;
+                    continue;
+                }
             for (unsigned int iPixel = 0; iPixel < ProtoDuneDL::MaxTDCs * ProtoDuneDL::MaxWires; iPixel++)
                 {
                     FileOutput[iFile] << "Pixel " << iPixel;
@@ -154,6 +177,27 @@ void RootToCSV::MakeCSV()
                         }
                 }
 
+            if(Sparse)
+                {
+                    for (unsigned int iPlane = 0; iPlane < ProtoDuneDL::MaxPlanes; iPlane++)
+                        {
+                            for (unsigned int iTDC = 0; iTDC < ProtoDuneDL::MaxTDCs; iTDC++)
+                                {
+                                    for (unsigned int iWire = 0; iWire < ProtoDuneDL::MaxWires; iWire++)
+                                        {
+                                            if(FeatureMap[iPlane][iTDC][iWire] == 0.0 && LabelMap[iPlane][iTDC][iWire] == 0)
+                                                {
+                                                    continue;
+                                                }
+                                            FileOutput[iPlane] << count - 1 << "," << iWire << "," << iTDC << ","
+                                                               << FeatureMap[iPlane][iTDC][iWire] << ","
+                                                               << LabelMap[iPlane][iTDC][iWire] << "\n";
+                                        }
+                                }
+                        }
+                    continue;
+                }
+
             for (unsigned int iPlane = 0; iPlane < ProtoDuneDL::MaxPlanes; iPlane++)
                 {
                     int iCount = 0;
@@ -177,7 +221,7 @@ void RootToCSV::MakeCSV()
         }
 
     // Close the output file
-    for (unsigned int iFile = 0; iFile < 6; iFile++)
+    for (unsigned int iFile = 0; iFile < nFiles; iFile++)
         {
             FileOutput[iFile].close();
         }
@@ -187,9 +231,10 @@ void RootToCSV::MakeCSV()
 
 int main(int argc, char* argv[])
 {
-    if(argc != 4)
+    if(argc != 4 && argc != 5)
         {
             cout << "Error! Please provide 3 arguments: input file, output directory name, and min beam hits." << endl;
+            cout << "Optionally, add 'sparse' as 4th argument to write only the hits." << endl;
             return 1;
         }
 
@@ -197,6 +242,7 @@ int main(int argc, char* argv[])
     myRootToCSV->SetInputFile(argv[1]);
     myRootToCSV->SetOutputDirectory(argv[2]);
     myRootToCSV->SetMinHitsBeam(atoi(argv[3]));
+    myRootToCSV->SetSparse(argc == 5 && string(argv[4]) == "sparse");
     myRootToCSV->MakeCSV();
 
     return 0;
@@ -10,16 +10,19 @@ class RootToCSV
     TString InputFile;
     TString OutputDirectory;
     unsigned int MinHitsBeam;
+    bool Sparse;
 
  public :
 
     // With default values
-    RootToCSV(const TString input = "NONE", const TString output = "NONE", const int minHits = 500);
+    RootToCSV(const TString input = "NONE", const TString output = "NONE", const int minHits = 500, const bool sparse = false);
 
     // To set values of choice
     void SetInputFile(const TString input);
     void SetOutputDirectory(const TString output);
     void SetMinHitsBeam(const int minHits);
+    // Write only the non-zero pixels as Event,Wire,TDC,ADC,Label rows (hits_u/v/w.csv)
+    void SetSparse(const bool sparse);
 
     // To make CSV file
     void MakeCSV();
@@ -4,12 +4,18 @@ import os
 import argparse
 import configparser
 from tools.data_tools import get_data_generator
-from tools.plotting_tools import plot_feature_label, plot_categories
+from tools.plotting_tools import EventRenderer
 
 def argument_parser():
     ap = argparse.ArgumentParser()
     ap.add_argument("-e", "--events", required=True,
 	   help="Choose number of events to run over.")
+    ap.add_argument("-f", "--format", default="pdf",
+	   help="Choose format between 'pdf' (vector) or 'png' (raster).")
+    ap.add_argument("-w", "--workers", default="1",
+	   help="Number of processes drawing the events.")
+    ap.add_argument("-d", "--dpi", default="100",
+	   help="Resolution of the png plots.")
     return vars(ap.parse_args())
 
 def main():
@@ -22,6 +28,19 @@ def main():
         print("Exiting!\n")
         sys.exit(1)
 
+    FORMAT = args["format"]
+    if FORMAT not in ["pdf", "png"]:
+        print("\nError: Format should be either 'pdf' or 'png'")
+        print("Exiting!\n")
+        sys.exit(1)
+    try:
+        WORKERS = int(args["workers"])
+        DPI = int(args["dpi"])
+    except ValueError:
+        print("\nError: Workers and dpi should be integers.")
+        print("Exiting!\n")
+        sys.exit(1)
+
     config = configparser.ConfigParser()
     config_path = os.path.join("configurations", "master_configuration.ini")
     config.read(config_path)
@@ -31,6 +50,7 @@ def main():
     IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
     IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
     CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
 
     FEATURE_FILE_TRAINING = config["DEFAULT"]["FEATURE_FILE_TRAINING"]
     LABEL_FILE_TRAINING = config["DEFAULT"]["LABEL_FILE_TRAINING"]
@@ -43,6 +63,7 @@ def main():
     print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
     print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
     print("CLASS_NAMES: {}".format(CLASS_NAMES))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
 
     print("FEATURE_FILE_TRAINING: {}".format(FEATURE_FILE_TRAINING))
     print("LABEL_FILE_TRAINING: {}".format(LABEL_FILE_TRAINING))
@@ -52,56 +73,35 @@ def main():
     print("LABEL_FILE_TESTING: {}\n".format(LABEL_FILE_TESTING))
     print()
 
-    generator_training = get_data_generator(FEATURE_FILE_TRAINING, LABEL_FILE_TRAINING)
-    generator_validation = get_data_generator(FEATURE_FILE_VALIDATION, LABEL_FILE_VALIDATION)
-    generator_testing = get_data_generator(FEATURE_FILE_TESTING, LABEL_FILE_TESTING)
-
-    plot_path = os.path.join("plots",  "events", "*.pdf")
-    files = glob.glob(plot_path)
-    for f in files:
-        os.remove(f)
-
-    count = 0
-    for X, y in generator_training:
-        if count >= NUM_EVENTS:
-            break
-        count += 1
-
-        feature_image = X.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        label_image = y.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        plot_feature_label_path = os.path.join("plots",  "events", "feature_label_training_event_{}.pdf".format(count))
-        plot_feature_label(feature_image, label_image,  'Feature', 'Label', CLASS_NAMES, plot_feature_label_path)
-
-        plot_categories_path = os.path.join("plots", "events", "categories_training_event_{}.pdf".format(count))
-        plot_categories(feature_image, label_image, CLASS_NAMES, plot_categories_path)
-
-    count = 0
-    for X, y in generator_validation:
-        if count >= NUM_EVENTS:
-            break
-        count += 1
-
-        feature_image = X.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        label_image = y.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        plot_feature_label_path = os.path.join("plots",  "events", "feature_label_validaiton_event_{}.pdf".format(count))
-        plot_feature_label(feature_image, label_image,  'Feature', 'Label', CLASS_NAMES, plot_feature_label_path)
-
-        plot_categories_path = os.path.join("plots", "events", "categories_validation_event_{}.pdf".format(count))
-        plot_categories(feature_image, label_image, CLASS_NAMES, plot_categories_path)
-
-    count = 0
-    for X, y in generator_testing:
-        if count >= NUM_EVENTS:
-            break
-        count += 1
-
-        feature_image = X.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        label_image = y.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
-        plot_feature_label_path = os.path.join("plots",  "events", "feature_label_testing_event_{}.pdf".format(count))
-        plot_feature_label(feature_image, label_image,  'Feature', 'Label', CLASS_NAMES, plot_feature_label_path)
-
-        plot_categories_path = os.path.join("plots", "events", "categories_testing_event_{}.pdf".format(count))
-        plot_categories(feature_image, label_image, CLASS_NAMES, plot_categories_path)
+    generator_training = get_data_generator(FEATURE_FILE_TRAINING, LABEL_FILE_TRAINING, DATA_FORMAT)
+    generator_validation = get_data_generator(FEATURE_FILE_VALIDATION, LABEL_FILE_VALIDATION, DATA_FORMAT)
+    generator_testing = get_data_generator(FEATURE_FILE_TESTING, LABEL_FILE_TESTING, DATA_FORMAT)
+
+    for extension in ["pdf", "png"]:
+        files = glob.glob(os.path.join("plots",  "events", "*.{}".format(extension)))
+        for f in files:
+            os.remove(f)
+
+    # Events are read here and drawn by a pool of processes that reuse their figures
+    with EventRenderer(CLASS_NAMES, workers=WORKERS, dpi=DPI) as renderer:
+        for generator, split in [(generator_training, "training"),
+                                 (generator_validation, "validation"),
+                                 (generator_testing, "testing")]:
+            count = 0
+            for X, y in generator:
+                if count >= NUM_EVENTS:
+                    break
+                count += 1
+
+                feature_image = X.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
+                label_image = y.reshape(IMAGE_WIDTH, IMAGE_HEIGHT)
+                plot_feature_label_path = os.path.join("plots",  "events", "feature_label_{}_event_{}.{}".format(
+                    split, count, FORMAT))
+                renderer.submit("feature_label", feature_image, label_image, plot_feature_label_path)
+
+                plot_categories_path = os.path.join("plots", "events", "categories_{}_event_{}.{}".format(
+                    split, count, FORMAT))
+                renderer.submit("categories", feature_image, label_image, plot_categories_path)
 
     print("\nDone! Plots are saved in \plots!\n")
 
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import configparser
+from numpy.lib.format import open_memmap
+from keras.models import load_model
+from tools.model_tools import set_float_dtype
+from tools.export_tools import FrozenModel
+from tools.data_tools import count_events, iterate_feature_batches, preprocess_features
+from tools.store_tools import get_plane_file
+from tools.inference_tools import TiledPredictor, get_tile_shape
+from tools.thread_tools import iterate_in_thread, ThreadedWriter
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", default=None,
+	   help="Feature file to predict; FEATURE_FILE_TESTING by default. No label file is needed.")
+    ap.add_argument("-o", "--output", default="predictions",
+	   help="Directory for class_map.npy (and probabilities.npy).")
+    ap.add_argument("-e", "--events", default="All",
+	   help="Options are 'All' or a number of events.")
+    ap.add_argument("-p", "--probabilities", action="store_true",
+	   help="Also save the float16 probabilities of every class.")
+    ap.add_argument("-m", "--model", default=os.path.join("saved_models", "model_and_weights.hdf5"),
+	   help="Keras model (.hdf5) or graph exported by export_model.py (.pb).")
+    return vars(ap.parse_args())
+
+def main():
+    args = argument_parser()
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
+    IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
+    IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
+    PLANES = config["DEFAULT"]["PLANES"].split()
+    CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
+    FLOAT_DTYPE = config["DEFAULT"]["FLOAT_DTYPE"]
+    EVALUATION_BATCH_SIZE = int(config["DEFAULT"]["EVALUATION_BATCH_SIZE"])
+    TILE_SIZE = int(config["DEFAULT"]["TILE_SIZE"])
+    TILE_OVERLAP = int(config["DEFAULT"]["TILE_OVERLAP"])
+    TILE_BATCH_SIZE = int(config["DEFAULT"]["TILE_BATCH_SIZE"])
+    SKIP_EMPTY_TILES = config["DEFAULT"].getboolean("SKIP_EMPTY_TILES")
+    ADC_THRESHOLD = float(config["DEFAULT"]["ADC_THRESHOLD"])
+    FEATURE_FILE = args["input"] or config["DEFAULT"]["FEATURE_FILE_TESTING"]
+    OUTPUT_DIR = args["output"]
+
+    # Several planes are read from the _u, _v and _w siblings of the feature file; a single plane
+    # from its sibling of FEATURE_FILE_TESTING, as in training, or from the file given with -i as it is
+    planes = PLANES if len(PLANES) > 1 else None
+    try:
+        if not planes and not args["input"]:
+            FEATURE_FILE = get_plane_file(FEATURE_FILE, PLANES[-1])
+        NUM_EVENTS = count_events(get_plane_file(FEATURE_FILE, PLANES[-1]) if planes else FEATURE_FILE, DATA_FORMAT)
+    except ValueError as exception:
+        print("\nError: {}".format(exception))
+        print("Exiting!\n")
+        sys.exit(1)
+    if args["events"] != "All":
+        try:
+            NUM_EVENTS = min(NUM_EVENTS, int(args["events"]))
+        except ValueError:
+            print("\nError: Events should be 'All' or an integer.")
+            print("Exiting!\n")
+            sys.exit(1)
+
+    print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
+    print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
+    print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
+    print("PLANES: {}".format(PLANES))
+    print("CLASS_NAMES: {}".format(CLASS_NAMES))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
+    print("FLOAT_DTYPE: {}".format(FLOAT_DTYPE))
+    print("EVALUATION_BATCH_SIZE: {}".format(EVALUATION_BATCH_SIZE))
+    print("TILE_SIZE: {}".format(TILE_SIZE))
+    print("TILE_OVERLAP: {}".format(TILE_OVERLAP))
+    print("TILE_BATCH_SIZE: {}".format(TILE_BATCH_SIZE))
+    print("SKIP_EMPTY_TILES: {}".format(SKIP_EMPTY_TILES))
+    print("ADC_THRESHOLD: {}".format(ADC_THRESHOLD))
+    print("FEATURE_FILE: {}".format(FEATURE_FILE))
+    print("OUTPUT_DIR: {}".format(OUTPUT_DIR))
+    print("MODEL: {}".format(args["model"]))
+    print("Predicting {} events.\n".format(NUM_EVENTS))
+
+    # Get the model, once
+    set_float_dtype(FLOAT_DTYPE)
+    model_path = args["model"]
+    if model_path.endswith(".pb"):
+        model = FrozenModel(model_path)
+    else:
+        model = load_model(model_path, compile=False)
+    tile_shape = get_tile_shape(model, TILE_SIZE)
+    print("Predicting {}x{} tiles".format(*tile_shape))
+    predictor = TiledPredictor(model, tile_shape, TILE_OVERLAP, TILE_BATCH_SIZE,
+                               skip_empty=SKIP_EMPTY_TILES, threshold=ADC_THRESHOLD)
+
+    # The outputs are memory-mapped .npy files, filled a batch at a time
+    if not os.path.isdir(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    class_map_file = os.path.join(OUTPUT_DIR, "class_map.npy")
+    class_maps = open_memmap(class_map_file, mode="w+", dtype=np.uint8,
+                             shape=(NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT))
+    probabilities = None
+    if args["probabilities"]:
+        probabilities_file = os.path.join(OUTPUT_DIR, "probabilities.npy")
+        probabilities = open_memmap(probabilities_file, mode="w+", dtype=np.float16,
+                                    shape=(NUM_EVENTS, IMAGE_WIDTH, IMAGE_HEIGHT, len(CLASS_NAMES)))
+
+    def write(start, batch_class_maps, batch_probabilities):
+        class_maps[start:start + len(batch_class_maps)] = batch_class_maps
+        if probabilities is not None:
+            probabilities[start:start + len(batch_probabilities)] = batch_probabilities
+
+    # Three stages that overlap: a thread reads the next batch, this thread predicts
+    # and another thread writes the previous batch
+    batches = iterate_in_thread(iterate_feature_batches(FEATURE_FILE, DATA_FORMAT, EVALUATION_BATCH_SIZE,
+                                                        NUM_EVENTS, planes))
+    writer = ThreadedWriter(write)
+    start_time = time.time()
+    last_report = start_time
+    count = 0
+    for features in batches:
+        rows = len(features)
+        # Several planes are stacked as channels; TiledPredictor splits them for a model with an input per plane
+        samples = np.empty((rows, IMAGE_WIDTH, IMAGE_HEIGHT, len(PLANES) if planes else IMAGE_DEPTH), dtype=FLOAT_DTYPE)
+        preprocess_features(features, samples)
+        predictions = predictor.predict(samples, features[..., -1] if planes else features)
+        writer.put(count, np.argmax(predictions, axis=3).astype(np.uint8),
+                   predictions.astype(np.float16) if probabilities is not None else None)
+        count += rows
+
+        if time.time() - last_report > 10 or count == NUM_EVENTS:
+            last_report = time.time()
+            elapsed = last_report - start_time
+            print("{}/{} events ({:.1f}%), {:.2f} events/s".format(count, NUM_EVENTS, 100.0*count/max(NUM_EVENTS, 1),
+                                                                    count/max(elapsed, 1e-9)))
+    writer.close()
+    class_maps.flush()
+    if probabilities is not None:
+        probabilities.flush()
+
+    elapsed = time.time() - start_time
+    print("\nInference: {}".format(predictor.report()))
+    print("Overall, with reading and writing: {:.2f} events/s".format(count/max(elapsed, 1e-9)))
+    print("\nDone! Class maps are saved in {}{}\n".format(
+        class_map_file, " and probabilities in {}".format(probabilities_file) if probabilities is not None else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import numpy as np
+import configparser
+import multiprocessing
+
+# The runs share the CPU cores
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+from keras import backend as K
+from keras.layers import Input
+from keras.callbacks import LambdaCallback
+from tools.data_tools import DataSequence
+from tools.weights_tools import load_class_weights
+from tools.model_tools import get_unet_model, get_multiplane_unet_model, set_float_dtype
+from tools.loss_metrics_tools import sparse_accuracy, ConfusionMatrix
+from tools.checkpoint_tools import save_checkpoint, load_checkpoint
+from tools.sweep_tools import load_search_space, sample_configurations, get_rung_epochs, select_survivors
+from tools.sweep_tools import get_optimizer, get_loss, get_best, rank_trials, print_results_table, PARAMETERS
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-s", "--space", default=os.path.join("configurations", "sweep_space.json"),
+	   help="JSON file with the values of every parameter.")
+    ap.add_argument("-n", "--configurations", default="9",
+	   help="Number of configurations drawn from the search space.")
+    ap.add_argument("-w", "--workers", default="3",
+	   help="Number of runs at the same time; each gets an equal share of the cores.")
+    ap.add_argument("--min-epochs", default="1",
+	   help="Epochs of every configuration in the first rung.")
+    ap.add_argument("--eta", default="3",
+	   help="Every rung keeps the best 1/eta of the configurations and trains them eta times longer.")
+    ap.add_argument("-m", "--monitor", default="val_mean_iou",
+	   help="Quantity to rank by; losses are minimized, anything else maximized.")
+    ap.add_argument("-t", "--target", default=None,
+	   help="Value of the monitor for the time-to-quality; 90% of the best value found by default.")
+    ap.add_argument("--seed", default="0",
+	   help="Seed of the configurations drawn.")
+    ap.add_argument("-d", "--directory", default=None,
+	   help="Directory of the runs and results; sweeps/<date> by default.")
+    return vars(ap.parse_args())
+
+def run_trial(task):
+    """
+    Train one configuration on the development events up to 'epochs', continuing from its
+    checkpoint of the previous rung, and return its history (cumulative seconds and logs per epoch).
+    Runs in a fresh process of the pool.
+    """
+    trial, params, settings, epochs, threads, trial_dir = task
+    import tensorflow as tf
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                   inter_op_parallelism_threads=threads)))
+    history = []
+    try:
+        sequences = [DataSequence(feature_file=settings["FEATURE_FILE_" + split],
+                                  label_file=settings["LABEL_FILE_" + split],
+                                  image_width=settings["IMAGE_WIDTH"],
+                                  image_height=settings["IMAGE_HEIGHT"],
+                                  image_depth=settings["IMAGE_DEPTH"],
+                                  num_classes=len(settings["CLASS_NAMES"]),
+                                  max_index=settings["NUM_" + split],
+                                  batch_size=params["batch_size"],
+                                  data_format=settings["DATA_FORMAT"],
+                                  shuffle=split == "TRAINING",
+                                  dtype=settings["FLOAT_DTYPE"],
+                                  planes=settings["PLANES"],
+                                  plane_mode=settings["PLANE_MODE"]) for split in ["TRAINING", "VALIDATION"]]
+        training, validation = sequences
+
+        set_float_dtype(settings["FLOAT_DTYPE"])
+        input_shape = (settings["IMAGE_WIDTH"], settings["IMAGE_HEIGHT"], settings["IMAGE_DEPTH"])
+        if len(settings["PLANES"]) > 1 and settings["PLANE_MODE"] == "inputs":
+            input_tensors = [Input(input_shape, name="input_{}".format(plane)) for plane in settings["PLANES"]]
+            model = get_multiplane_unet_model(input_tensors=input_tensors, num_classes=len(settings["CLASS_NAMES"]),
+                                              num_filters=params["num_filters"], dropout=params["dropout"],
+                                              batchnorm=True, depth=params["depth"],
+                                              width_multiplier=params["width_multiplier"],
+                                              separable=params["separable"], additive_skips=params["additive_skips"])
+        else:
+            model = get_unet_model(input_tensor=Input(input_shape), num_classes=len(settings["CLASS_NAMES"]),
+                                   num_filters=params["num_filters"], dropout=params["dropout"], batchnorm=True,
+                                   depth=params["depth"], width_multiplier=params["width_multiplier"],
+                                   separable=params["separable"], additive_skips=params["additive_skips"])
+        target_tensor = K.placeholder(ndim=4, dtype="uint8", name="target")
+        model.compile(optimizer=get_optimizer(params["optimizer"], params["lr"]),
+                      loss=get_loss(params["loss"], np.array(settings["WEIGHTS"])),
+                      metrics=[sparse_accuracy, ConfusionMatrix(num_classes=len(settings["CLASS_NAMES"]))],
+                      target_tensors=[target_tensor])
+
+        checkpoint_file = os.path.join(trial_dir, "checkpoint.npz")
+        if os.path.isfile(checkpoint_file):
+            model_weights, optimizer_weights, state = load_checkpoint(checkpoint_file)
+            # The optimizer weights exist once the train function is made
+            model._make_train_function()
+            model.set_weights(model_weights)
+            model.optimizer.set_weights(optimizer_weights)
+            history = state["history"]
+            training.set_epoch(len(history), state["seed"])
+        start = [0.0]
+
+        def on_epoch_end(epoch, logs):
+            seconds = (history[-1]["seconds"] if history else 0.0) + time.time() - start[0]
+            history.append(dict({name: float(value) for name, value in logs.items()}, epoch=epoch + 1,
+                                seconds=seconds))
+
+        recorder = LambdaCallback(on_epoch_begin=lambda epoch, logs: start.__setitem__(0, time.time()),
+                                  on_epoch_end=on_epoch_end)
+        model.fit_generator(training,
+                            steps_per_epoch=len(training),
+                            epochs=epochs,
+                            initial_epoch=len(history),
+                            validation_data=validation,
+                            validation_steps=len(validation),
+                            verbose=0,
+                            callbacks=[recorder],
+                            shuffle=False,
+                            workers=1)
+
+        model_weights = model.get_weights()
+        optimizer_weights = model.optimizer.get_weights()
+        save_checkpoint(checkpoint_file, model_weights, optimizer_weights,
+                        {"history": history, "seed": int(training.seed), "params": params,
+                         "num_model_weights": len(model_weights), "num_optimizer_weights": len(optimizer_weights)})
+        return {"trial": trial, "params": params, "history": history}
+    except Exception as exception:
+        # e.g. out of memory; the configuration is dropped at the end of the rung
+        return {"trial": trial, "params": params, "history": history, "error": repr(exception)}
+
+def main():
+    args = argument_parser()
+    try:
+        NUM_CONFIGURATIONS = int(args["configurations"])
+        WORKERS = int(args["workers"])
+        MIN_EPOCHS = int(args["min_epochs"])
+        ETA = int(args["eta"])
+        SEED = int(args["seed"])
+        TARGET = float(args["target"]) if args["target"] is not None else None
+    except ValueError:
+        print("\nError: Configurations, workers, min-epochs, eta and seed should be integers; target a number.")
+        print("Exiting!\n")
+        sys.exit(1)
+    if ETA < 2 or MIN_EPOCHS < 1 or WORKERS < 1:
+        print("\nError: eta should be at least 2; min-epochs and workers at least 1")
+        print("Exiting!\n")
+        sys.exit(1)
+    MONITOR = args["monitor"]
+    MODE = "min" if MONITOR.endswith("loss") else "max"
+
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    # The model of the configuration unless the search space varies it
+    defaults = {"depth": int(config["DEFAULT"]["DEPTH"]),
+                "width_multiplier": float(config["DEFAULT"]["WIDTH_MULTIPLIER"]),
+                "separable": config["DEFAULT"].getboolean("SEPARABLE"),
+                "additive_skips": config["DEFAULT"].getboolean("ADDITIVE_SKIPS")}
+    try:
+        space = load_search_space(args["space"], defaults)
+    except (OSError, ValueError) as exception:
+        print("\nError: The search space {} couldn't be read: {}".format(args["space"], exception))
+        print("Exiting!\n")
+        sys.exit(1)
+
+    CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
+    WEIGHTS = np.array(list(map(float, config["DEFAULT"]["WEIGHTS"].split())))
+    WEIGHTS_FILE = config["DEFAULT"]["WEIGHTS_FILE"]
+    if os.path.isfile(WEIGHTS_FILE):
+        WEIGHTS = load_class_weights(WEIGHTS_FILE, CLASS_NAMES)
+    # Configurations are compared on the development events
+    settings = {"NUM_TRAINING": int(config["DEVELOPMENT"]["NUM_TRAINING"]),
+                "NUM_VALIDATION": int(config["DEVELOPMENT"]["NUM_VALIDATION"]),
+                "NUM_EPOCHS": int(config["DEVELOPMENT"]["NUM_EPOCHS"]),
+                "IMAGE_WIDTH": int(config["DEFAULT"]["IMAGE_WIDTH"]),
+                "IMAGE_HEIGHT": int(config["DEFAULT"]["IMAGE_HEIGHT"]),
+                "IMAGE_DEPTH": int(config["DEFAULT"]["IMAGE_DEPTH"]),
+                "PLANES": config["DEFAULT"]["PLANES"].split(),
+                "PLANE_MODE": config["DEFAULT"]["PLANE_MODE"],
+                "CLASS_NAMES": CLASS_NAMES,
+                "WEIGHTS": [float(w) for w in WEIGHTS],
+                "FEATURE_FILE_TRAINING": config["DEFAULT"]["FEATURE_FILE_TRAINING"],
+                "LABEL_FILE_TRAINING": config["DEFAULT"]["LABEL_FILE_TRAINING"],
+                "FEATURE_FILE_VALIDATION": config["DEFAULT"]["FEATURE_FILE_VALIDATION"],
+                "LABEL_FILE_VALIDATION": config["DEFAULT"]["LABEL_FILE_VALIDATION"],
+                "DATA_FORMAT": config["DEFAULT"]["DATA_FORMAT"],
+                "FLOAT_DTYPE": config["DEFAULT"]["FLOAT_DTYPE"]}
+    for name, value in settings.items():
+        print("{}: {}".format(name, value))
+    print("MONITOR: {} ({})".format(MONITOR, "minimized" if MODE == "min" else "maximized"))
+
+    directory = args["directory"] or os.path.join("sweeps", time.strftime("%Y%m%d_%H%M%S"))
+    threads = max(1, os.cpu_count()//WORKERS)
+    rung_epochs = get_rung_epochs(MIN_EPOCHS, max(MIN_EPOCHS, settings["NUM_EPOCHS"]), ETA)
+    configurations = sample_configurations(space, NUM_CONFIGURATIONS, SEED)
+    print("\n{} configurations, {} at a time with {} threads each; epochs by rung: {}".format(
+        len(configurations), WORKERS, threads, rung_epochs))
+    print("Runs and results are saved in {}\n".format(directory))
+
+    trials = {i: {"trial": i, "params": params, "history": []} for i, params in enumerate(configurations)}
+    alive = sorted(trials)
+    context = multiprocessing.get_context("spawn")
+    for rung, epochs in enumerate(rung_epochs):
+        print("Rung {}: {} configurations up to {} epochs".format(rung + 1, len(alive), epochs))
+        tasks = []
+        for i in alive:
+            trial_dir = os.path.join(directory, "trial_{:03d}".format(i))
+            if not os.path.isdir(trial_dir):
+                os.makedirs(trial_dir)
+            tasks.append((i, trials[i]["params"], settings, epochs, threads, trial_dir))
+        # A fresh process for every run, so that TensorFlow starts clean
+        with context.Pool(WORKERS, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_trial, tasks):
+                trials[result["trial"]] = result
+                best = get_best([epoch.get(MONITOR) for epoch in result["history"]], MODE)
+                print("  Trial {:3d} {}: {}".format(
+                    result["trial"], ", ".join("{}={}".format(name, result["params"][name]) for name in PARAMETERS),
+                    result["error"] if "error" in result else "best {} {:.4g}".format(
+                        MONITOR, best if best is not None else float("nan"))))
+
+        if rung < len(rung_epochs) - 1:
+            survivors = select_survivors([trials[i] for i in alive if "error" not in trials[i]], MONITOR, MODE, ETA)
+            alive = sorted(trial["trial"] for trial in survivors)
+            print("Kept trials {}\n".format(alive))
+        if not alive:
+            break
+
+    best = get_best([epoch.get(MONITOR) for trial in trials.values() for epoch in trial["history"]], MODE)
+    if best is None:
+        print("\nError: No configuration gave a value of {}".format(MONITOR))
+        print("Exiting!\n")
+        sys.exit(1)
+    target = TARGET if TARGET is not None else (0.9*best if MODE == "max" else best/0.9)
+    rows = rank_trials(trials.values(), MONITOR, MODE, target)
+    print_results_table(rows, MONITOR, target)
+
+    with open(os.path.join(directory, "trials.json"), "w") as f:
+        json.dump({"monitor": MONITOR, "target": target, "rung_epochs": rung_epochs, "settings": settings,
+                   "trials": list(trials.values())}, f, indent=4)
+    with open(os.path.join(directory, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["rank", "trial"] + PARAMETERS + ["epochs", "best", "seconds",
+                                                                                "time_to_quality"])
+        writer.writeheader()
+        for rank, row in enumerate(rows):
+            writer.writerow(dict(row, rank=rank + 1))
+    print("\nDone! The ranked results are saved in {}\n".format(os.path.join(directory, "results.csv")))
+
+if __name__ == "__main__":
+    main()
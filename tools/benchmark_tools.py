@@ -0,0 +1,126 @@
+import os
+import sys
+import csv
+import json
+import time
+import platform
+import numpy as np
+
+def make_synthetic_events(num_events, image_width, image_height, occupancy=0.05, seed=0):
+    """
+    ProtoDUNE-like events: a small fraction of pixels has an ADC value, with
+    mostly Background and Cosmic hits and a few Beam hits.
+    """
+    rng = np.random.RandomState(seed)
+    num_pixels = image_width*image_height
+    hits = rng.rand(num_events, num_pixels) < occupancy
+    features = np.where(hits, np.round(rng.gamma(2.0, 50.0, (num_events, num_pixels)), 2), 0.0)
+    labels = np.where(hits, rng.choice(3, (num_events, num_pixels), p=[0.3, 0.6, 0.1]), 0)
+    return features.astype(np.float32), labels.astype(np.uint8)
+
+def write_synthetic_csv(directory, features, labels, plane="w"):
+    """
+    Write events in the RootToCSV format; returns the feature and label file paths.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    header = ",".join("Pixel {}".format(pixel) for pixel in range(features.shape[1]))
+    feature_file = os.path.join(directory, "feature_{}.csv".format(plane))
+    label_file = os.path.join(directory, "label_{}.csv".format(plane))
+    np.savetxt(feature_file, features, fmt="%g", delimiter=",", header=header, comments="")
+    np.savetxt(label_file, labels, fmt="%d", delimiter=",", header=header, comments="")
+    return feature_file, label_file
+
+def legacy_data_generator(feature_file, label_file):
+    """
+    The original row by row csv.reader parsing; kept as the reference for benchmarks.
+    """
+    with open(feature_file, "r") as csv1, open(label_file, "r") as csv2:
+        reader1 = csv.reader(csv1)
+        reader2 = csv.reader(csv2)
+        # Skip the header row
+        next(reader1)
+        next(reader2)
+        for row1, row2 in zip(reader1, reader2):
+            array_row1 = np.array(row1, dtype=np.float64)
+            array_row2 = np.array(row2, dtype=np.int64)
+            yield array_row1, array_row2
+
+def legacy_batch(features, labels, image_width, image_height, image_depth, num_classes):
+    """
+    The original batch: float64 samples normalised event by event and float64 one-hot targets.
+    """
+    rows = len(features)
+    samples = np.zeros((rows, image_width, image_height, image_depth))
+    targets = np.zeros((rows, image_width, image_height, num_classes))
+    for j in range(rows):
+        x = np.array(features[j], dtype=np.float64)
+        samples[j,:,:,:] = (x/np.max(x)).reshape(image_width, image_height, image_depth)
+        targets[j,:,:,:] = np.eye(num_classes)[labels[j]].reshape(image_width, image_height, num_classes)
+    return samples, targets
+
+def time_function(function, repeats=1):
+    """
+    Best wall time in seconds of 'repeats' calls of function().
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+def time_generator(generator, repeats=1):
+    """
+    Best events per second over 'repeats' passes of generator().
+    """
+    best = 0.0
+    for _ in range(repeats):
+        start = time.time()
+        num_events = sum(1 for _ in generator())
+        best = max(best, num_events/max(time.time() - start, 1e-9))
+    return best
+
+def add_result(results, name, value, unit, higher_is_better=True):
+    """
+    Record (and print) one measurement under 'name'.
+    """
+    results[name] = {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+    print("{:55s} {:12.4g} {}".format(name, value, unit))
+
+def get_environment():
+    return {"python": sys.version.split()[0], "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def save_results(results_file, results, settings):
+    directory = os.path.dirname(results_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(results_file, "w") as f:
+        json.dump({"environment": get_environment(), "settings": settings, "results": results}, f, indent=4)
+
+def load_results(results_file):
+    with open(results_file, "r") as f:
+        return json.load(f)
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Print every measurement next to its baseline; returns the names of those that got worse by
+    more than 'tolerance' (a fraction), respecting whether higher or lower is better.
+    """
+    regressions = []
+    print("{:55s} {:>12s} {:>12s} {:>8s}".format("Benchmark", "Baseline", "Current", "Change"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print("{:55s} {:>12s} {:12.4g} {:>8s}".format(name, "-", result["value"], "new"))
+            continue
+        before, after = baseline[name]["value"], result["value"]
+        change = (after - before)/abs(before) if before else 0.0
+        worse = -change if result["higher_is_better"] else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:55s} {:12.4g} {:12.4g} {:+7.1f}%{}".format(name, before, after, 100.0*change, flag))
+    return regressions
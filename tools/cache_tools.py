@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from numpy.lib.format import open_memmap
+from tools.store_tools import LABEL_DTYPE, get_store_file, get_hits_store, get_plane_file, HITS_FILES
+
+def get_source_files(feature_file, label_file, data_format):
+    """
+    The files that events are read from for a data format; their size and mtime key the cache.
+    """
+    if data_format == "csv":
+        return [feature_file, label_file]
+    elif data_format == "npy":
+        return [get_store_file(feature_file), get_store_file(label_file)]
+    elif data_format == "sparse":
+        store_dir = get_hits_store(feature_file)
+        return [os.path.join(store_dir, name + ".npy") for name in HITS_FILES]
+    raise ValueError("Unknown data format '{}'; should be 'csv', 'npy' or 'sparse'.".format(data_format))
+
+def get_cache_key(feature_file, label_file, data_format, sample_shape, dtype, planes=None):
+    """
+    Everything the preprocessed events depend on: the source files with their size and mtime,
+    the image shape, the float type and the planes read together. Any change gives a new key,
+    so stale entries are never read.
+    """
+    plane_files = [(feature_file, label_file)] if planes is None else \
+        [(get_plane_file(feature_file, p), get_plane_file(label_file, p)) for p in planes]
+    sources = []
+    for plane_feature_file, plane_label_file in plane_files:
+        for source in get_source_files(plane_feature_file, plane_label_file, data_format):
+            stat = os.stat(source)
+            sources.append([os.path.abspath(source), stat.st_size, stat.st_mtime_ns])
+    key = {"sources": sources, "data_format": data_format, "sample_shape": list(sample_shape),
+           "dtype": np.dtype(dtype).name}
+    if planes is not None:
+        key["planes"] = list(planes)
+    return key
+
+class EventCache(object):
+    """
+    Preprocessed events (samples and uint8 targets) by event index, in two tiers:
+    - memory: an LRU of at most memory_bytes, per process,
+    - disk: memory-mapped .npy files in a directory of cache_dir named after the cache key,
+      shared by all processes and runs; an event is marked as filled only after it is written.
+    Like the event stores the memory maps are opened lazily in every process and not pickled.
+    With several planes the targets have the labels of every plane.
+    """
+    def __init__(self, feature_file, label_file, data_format, num_events, sample_shape, dtype=np.float32,
+                 memory_bytes=0, cache_dir=None, planes=None):
+        self.num_events = num_events
+        self.sample_shape = tuple(sample_shape)
+        self.target_shape = self.sample_shape[:2] + (len(planes) if planes else 1,)
+        self.dtype = np.dtype(dtype)
+        self.event_bytes = int(np.prod(self.sample_shape))*self.dtype.itemsize + int(np.prod(self.target_shape))
+        self.memory_bytes = memory_bytes
+        self.store_dir = None
+        if cache_dir:
+            key = get_cache_key(feature_file, label_file, data_format, sample_shape, dtype, planes)
+            digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+            name = os.path.splitext(os.path.basename(feature_file))[0]
+            self.store_dir = os.path.join(cache_dir, "{}_{}".format(name, digest))
+            self.create(key)
+        self.reset_counts()
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.arrays = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(memory=OrderedDict(), lock=None, arrays=None, pid=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def create(self, key):
+        """
+        Make the disk tier once, before any worker starts; the data files are sparse until filled.
+        """
+        if os.path.isfile(os.path.join(self.store_dir, "key.json")):
+            return
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        open_memmap(os.path.join(self.store_dir, "samples.npy"), mode="w+", dtype=self.dtype,
+                    shape=(self.num_events,) + self.sample_shape)
+        open_memmap(os.path.join(self.store_dir, "targets.npy"), mode="w+", dtype=LABEL_DTYPE,
+                    shape=(self.num_events,) + self.target_shape)
+        open_memmap(os.path.join(self.store_dir, "filled.npy"), mode="w+", dtype=np.uint8,
+                    shape=(self.num_events,))
+        # Written last, so an interrupted creation is redone
+        with open(os.path.join(self.store_dir, "key.json"), "w") as f:
+            json.dump(key, f, indent=4)
+
+    def open(self):
+        if self.arrays is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.arrays = {name: open_memmap(os.path.join(self.store_dir, name + ".npy"), mode="r+")
+                           for name in ["samples", "targets", "filled"]}
+        return self.arrays
+
+    def reset_counts(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def remember(self, index, sample, target):
+        if self.event_bytes > self.memory_bytes:
+            return
+        with self.lock:
+            self.memory[index] = (sample.copy(), target.copy())
+            self.memory.move_to_end(index)
+            while len(self.memory)*self.event_bytes > self.memory_bytes:
+                self.memory.popitem(last=False)
+
+    def read(self, indices, make_events):
+        """
+        Samples and targets of the events at 'indices', from memory, disk, or made by
+        make_events(missing_indices) and then cached in both tiers.
+        """
+        rows = len(indices)
+        samples = np.empty((rows,) + self.sample_shape, dtype=self.dtype)
+        targets = np.empty((rows,) + self.target_shape, dtype=LABEL_DTYPE)
+        arrays = self.open() if self.store_dir else None
+        missing = []
+        for row, index in enumerate(indices):
+            with self.lock:
+                item = self.memory.get(index)
+                if item is not None:
+                    self.memory.move_to_end(index)
+            if item is not None:
+                samples[row], targets[row] = item
+                self.memory_hits += 1
+            elif arrays is not None and arrays["filled"][index]:
+                samples[row], targets[row] = arrays["samples"][index], arrays["targets"][index]
+                self.remember(index, samples[row], targets[row])
+                self.disk_hits += 1
+            else:
+                missing.append(row)
+
+        if missing:
+            missing_indices = np.asarray(indices)[missing]
+            samples[missing], targets[missing] = make_events(missing_indices)
+            for row, index in zip(missing, missing_indices):
+                self.remember(index, samples[row], targets[row])
+                if arrays is not None:
+                    arrays["samples"][index] = samples[row]
+                    arrays["targets"][index] = targets[row]
+                    arrays["filled"][index] = 1
+            self.misses += len(missing)
+        return samples, targets
+
+    def report(self):
+        total = max(self.memory_hits + self.disk_hits + self.misses, 1)
+        return "{} events from memory ({:.1f}%), {} from disk ({:.1f}%), {} made ({:.1f}%)".format(
+            self.memory_hits, 100.0*self.memory_hits/total, self.disk_hits, 100.0*self.disk_hits/total,
+            self.misses, 100.0*self.misses/total)
@@ -0,0 +1,204 @@
+import os
+import re
+import glob
+import json
+import h5py
+import hashlib
+import numpy as np
+import keras
+from keras import backend as K
+from keras.callbacks import Callback
+from keras.engine.saving import save_attributes_to_hdf5_group
+from tools.thread_tools import ThreadedWriter
+
+# Attributes that EarlyStopping, ReduceLROnPlateau and ModelCheckpoint reset in on_train_begin
+CALLBACK_STATE = ["wait", "best", "stopped_epoch", "cooldown_counter"]
+
+def get_checkpoint_file(checkpoint_dir, epoch):
+    return os.path.join(checkpoint_dir, "checkpoint_epoch_{:04d}.npz".format(epoch))
+
+def get_best_checkpoint_file(checkpoint_dir):
+    return os.path.join(checkpoint_dir, "checkpoint_best.npz")
+
+def list_checkpoints(checkpoint_dir):
+    """
+    Epoch checkpoints in checkpoint_dir, oldest first.
+    """
+    files = glob.glob(os.path.join(checkpoint_dir, "checkpoint_epoch_*.npz"))
+    return sorted(files, key=lambda f: int(re.search(r"checkpoint_epoch_(\d+)\.npz$", f).group(1)))
+
+def save_checkpoint(checkpoint_file, model_weights, optimizer_weights, state):
+    """
+    Weights, optimizer weights and the JSON state in one .npz, written to a temporary file
+    first so that a job killed while writing never leaves a broken checkpoint.
+    """
+    arrays = {"model_{}".format(i): w for i, w in enumerate(model_weights)}
+    arrays.update({"optimizer_{}".format(i): w for i, w in enumerate(optimizer_weights)})
+    temp_file = checkpoint_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        np.savez(f, state=json.dumps(state), **arrays)
+    os.replace(temp_file, checkpoint_file)
+
+def load_checkpoint(checkpoint_file):
+    with np.load(checkpoint_file) as checkpoint:
+        state = json.loads(str(checkpoint["state"]))
+        model_weights = [checkpoint["model_{}".format(i)] for i in range(state["num_model_weights"])]
+        optimizer_weights = [checkpoint["optimizer_{}".format(i)] for i in range(state["num_optimizer_weights"])]
+    return model_weights, optimizer_weights, state
+
+def to_json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+def get_fingerprint(model, settings):
+    """
+    Short hash of the model architecture and the settings of a run (e.g. the events, the planes,
+    NUM_EPOCHS), so that a checkpoint is only resumed by the run it belongs to.
+    """
+    description = json.dumps({"model": json.loads(model.to_json()), "settings": settings}, sort_keys=True,
+                              default=to_json_value)
+    return hashlib.sha1(description.encode("utf8")).hexdigest()[:12]
+
+def save_model_file(model_file, model_config, layer_weight_names, model_weights):
+    """
+    The .hdf5 of model.save (architecture and weights, without the training config) from a copy
+    of the weights, in layer order as model.get_weights() returns them, so that it can be written
+    in the background while training goes on; load it with load_model(..., compile=False).
+    """
+    temp_file = model_file + ".tmp"
+    with h5py.File(temp_file, "w") as f:
+        f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+        f.attrs["backend"] = K.backend().encode("utf8")
+        f.attrs["model_config"] = model_config.encode("utf8")
+        group = f.create_group("model_weights")
+        save_attributes_to_hdf5_group(group, "layer_names", [name.encode("utf8") for name, _ in layer_weight_names])
+        group.attrs["backend"] = K.backend().encode("utf8")
+        group.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+        weights = iter(model_weights)
+        for layer_name, weight_names in layer_weight_names:
+            layer_group = group.create_group(layer_name)
+            save_attributes_to_hdf5_group(layer_group, "weight_names", [name.encode("utf8") for name in weight_names])
+            for name in weight_names:
+                value = next(weights)
+                dataset = layer_group.create_dataset(name, value.shape, dtype=value.dtype)
+                if value.shape:
+                    dataset[:] = value
+                else:
+                    dataset[()] = value
+    os.replace(temp_file, model_file)
+
+class TrainingCheckpoint(Callback):
+    """
+    Full training state after every epoch: the weights, the optimizer weights (iterations and
+    moments) and learning rate, the epoch, the history, the state of the other callbacks
+    (patience, best values, cooldown) and the seeds of the Sequences. The state is copied
+    in the training loop and written by a background thread, keeping the last 'keep' epochs
+    and the best one according to 'monitor'.
+    The best model is also saved to model_path, from the same background thread.
+    Checkpoints go to a directory of checkpoint_dir named after the fingerprint of the run, and
+    the epoch checkpoints are removed once training ends, so a finished run starts afresh.
+    With resume, the latest checkpoint of the run is restored in on_train_begin; keep this callback
+    after the ones it restores and pass initial_epoch to fit_generator so training continues there.
+    """
+    def __init__(self, checkpoint_dir, monitor='val_loss', mode='min', keep=3, callbacks=(), sequences=(),
+                 resume=True, fingerprint=None, model_path=None):
+        super(TrainingCheckpoint, self).__init__()
+        self.checkpoint_dir = os.path.join(checkpoint_dir, fingerprint) if fingerprint else checkpoint_dir
+        self.fingerprint = fingerprint
+        self.model_path = model_path
+        self.monitor = monitor
+        self.mode = mode
+        self.keep = keep
+        self.callbacks = list(callbacks)
+        self.sequences = list(sequences)
+        self.best = np.inf if mode == 'min' else -np.inf
+        self.history = {}
+        self.initial_epoch = 0
+        self.checkpoint = None
+        checkpoints = list_checkpoints(self.checkpoint_dir) if os.path.isdir(self.checkpoint_dir) else []
+        if resume and checkpoints:
+            checkpoint = load_checkpoint(checkpoints[-1])
+            if checkpoint[2].get("fingerprint") == fingerprint:
+                print("Resuming from {}".format(checkpoints[-1]))
+                self.checkpoint = checkpoint
+                self.initial_epoch = checkpoint[2]["epoch"]
+            else:
+                print("Checkpoint {} belongs to another run, will start afresh!".format(checkpoints[-1]))
+        # Epochs of an earlier attempt would be kept over the new ones when the oldest are removed
+        if self.checkpoint is None:
+            for old_file in checkpoints:
+                os.remove(old_file)
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+    def on_train_begin(self, logs=None):
+        # Restore after the other callbacks reset themselves
+        if self.checkpoint is not None:
+            model_weights, optimizer_weights, state = self.checkpoint
+            self.model.set_weights(model_weights)
+            self.model.optimizer.set_weights(optimizer_weights)
+            K.set_value(self.model.optimizer.lr, state["lr"])
+            for callback, callback_state in zip(self.callbacks, state["callbacks"]):
+                for name, value in callback_state.items():
+                    setattr(callback, name, value)
+            for sequence, seed in zip(self.sequences, state["seeds"]):
+                sequence.set_epoch(state["epoch"], seed)
+            self.best = state["best"]
+            self.history = state["history"]
+            self.checkpoint = None
+        # Taken once, the weights of the best model are copied every time it improves
+        self.model_config = self.model.to_json()
+        self.layer_weight_names = [(layer.name, [str(w.name) if getattr(w, "name", None) else "param_{}".format(i)
+                                                 for i, w in enumerate(layer.weights)]) for layer in self.model.layers]
+        self.writer = ThreadedWriter(self.write, max_size=1)
+
+    def get_state(self, epoch, logs):
+        return {"epoch": epoch + 1,
+                "lr": float(K.get_value(self.model.optimizer.lr)),
+                "callbacks": [{name: to_json_value(getattr(callback, name)) for name in CALLBACK_STATE
+                               if hasattr(callback, name)} for callback in self.callbacks],
+                "seeds": [int(sequence.seed) for sequence in self.sequences],
+                "best": to_json_value(self.best),
+                "monitor": self.monitor,
+                "fingerprint": self.fingerprint,
+                "history": self.history}
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        for name, value in logs.items():
+            self.history.setdefault(name, []).append(to_json_value(value))
+        current = logs.get(self.monitor)
+        is_best = current is not None and (current < self.best if self.mode == 'min' else current > self.best)
+        if is_best:
+            if self.model_path:
+                print("Epoch {}: {} improved from {:.5f} to {:.5f}, saving the model to {}".format(
+                    epoch + 1, self.monitor, self.best, current, self.model_path))
+            self.best = current
+
+        # Copies taken here, between steps; only the writing happens in the background
+        model_weights = self.model.get_weights()
+        optimizer_weights = self.model.optimizer.get_weights()
+        state = self.get_state(epoch, logs)
+        state.update(num_model_weights=len(model_weights), num_optimizer_weights=len(optimizer_weights))
+        self.writer.put(epoch + 1, model_weights, optimizer_weights, state, is_best)
+
+    def write(self, epoch, model_weights, optimizer_weights, state, is_best):
+        checkpoint_file = get_checkpoint_file(self.checkpoint_dir, epoch)
+        save_checkpoint(checkpoint_file, model_weights, optimizer_weights, state)
+        if is_best:
+            save_checkpoint(get_best_checkpoint_file(self.checkpoint_dir), model_weights, optimizer_weights, state)
+            if self.model_path:
+                save_model_file(self.model_path, self.model_config, self.layer_weight_names, model_weights)
+        for old_file in list_checkpoints(self.checkpoint_dir)[:-self.keep]:
+            os.remove(old_file)
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+        # Finished (or stopped early): running the same command again trains afresh, as it did
+        # without checkpoints, instead of resuming at the last epoch; the best one is kept
+        for old_file in list_checkpoints(self.checkpoint_dir):
+            os.remove(old_file)
+        # The History of fit_generator only has the epochs since the last resume
+        history = getattr(self.model, "history", None)
+        if history is not None:
+            history.history = {name: values[:] for name, values in self.history.items()}
+            history.epoch = list(range(len(next(iter(self.history.values()), []))))
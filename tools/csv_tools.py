@@ -0,0 +1,219 @@
+import os
+import numpy as np
+
+BLOCK_SIZE = 1 << 22
+VALID_CHARACTERS = np.frombuffer(b"+-.eE", dtype=np.uint8)
+
+def get_index_file(csv_file):
+    """
+    Row index that sits next to the csv file; e.g. feature_w.csv -> feature_w.index.npz
+    """
+    return os.path.splitext(csv_file)[0] + ".index.npz"
+
+def build_row_offsets(csv_file, block_size=BLOCK_SIZE):
+    """
+    Byte offsets of the data rows (header excluded) found by scanning the file in large blocks.
+    Row i spans offsets[i]:offsets[i + 1], so there is one more offset than rows.
+    """
+    newlines = []
+    position = 0
+    with open(csv_file, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            found = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            newlines.append(found.astype(np.int64) + position)
+            position += len(block)
+
+    newlines = np.concatenate(newlines) if newlines else np.zeros(0, dtype=np.int64)
+    # Every row starts after a newline; the first one closes the header
+    offsets = newlines + 1
+    # A last row without a trailing newline still ends at the end of the file
+    if position > 0 and (len(newlines) == 0 or newlines[-1] != position - 1):
+        offsets = np.append(offsets, position + 1)
+    # Drop blank rows; their start and end are only the newline apart
+    keep = np.ones(len(offsets), dtype=bool)
+    keep[1:] = np.diff(offsets) > 1
+    offsets = offsets[keep]
+    return offsets if len(offsets) else np.zeros(1, dtype=np.int64)
+
+def get_row_offsets(csv_file):
+    """
+    Row offsets of a csv file, cached next to it and rebuilt whenever its size or mtime change.
+    """
+    stat = os.stat(csv_file)
+    index_file = get_index_file(csv_file)
+    if os.path.isfile(index_file):
+        try:
+            with np.load(index_file) as index:
+                if int(index["size"]) == stat.st_size and int(index["mtime_ns"]) == stat.st_mtime_ns:
+                    return index["offsets"]
+        except (OSError, ValueError, KeyError):
+            print("Index {} couldn't be read, will rebuild it!".format(index_file))
+
+    offsets = build_row_offsets(csv_file)
+    temp_file = index_file + ".tmp"
+    try:
+        with open(temp_file, "wb") as f:
+            np.savez(f, offsets=offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        os.replace(temp_file, index_file)
+    except OSError:
+        print("Index for {} couldn't be cached, will keep it in memory!".format(csv_file))
+    return offsets
+
+def parse_long_fields(data, starts, lengths):
+    """
+    Decimal numbers ([-]digits[.digits][e[+-]digits]) spanning data[starts:starts + lengths].
+    Digits are accumulated one character position at a time for all fields at once;
+    exact for up to 15 significant digits (RootToCSV writes 6).
+    """
+    # One row per character position; padding is '+', which doesn't change a number
+    positions = np.arange(lengths.max())[:, None]
+    chars = data[np.minimum(starts + positions, len(data) - 1)]
+    chars[positions >= lengths] = ord("+")
+    valid = (chars - np.uint8(ord("0")) <= 9) | np.isin(chars, VALID_CHARACTERS)
+    if not np.all(valid):
+        raise ValueError("Found a value that is not a decimal number.")
+
+    num_fields = len(starts)
+    mantissa = np.zeros(num_fields)
+    exponent = np.zeros(num_fields)
+    fraction_digits = np.zeros(num_fields)
+    negative = np.zeros(num_fields, dtype=bool)
+    negative_exponent = np.zeros(num_fields, dtype=bool)
+    in_exponent = np.zeros(num_fields, dtype=bool)
+    after_point = np.zeros(num_fields, dtype=bool)
+    for char in chars:
+        digit = char - np.uint8(ord("0"))
+        is_digit = digit <= 9
+        # Everything after 'e' is the exponent, everything after '.' the fraction
+        in_exponent |= (char == ord("e")) | (char == ord("E"))
+        after_point |= char == ord(".")
+        is_minus = char == ord("-")
+        negative |= is_minus & ~in_exponent
+        negative_exponent |= is_minus & in_exponent
+
+        mantissa_digit = is_digit & ~in_exponent
+        mantissa = np.where(mantissa_digit, 10.0*mantissa + digit, mantissa)
+        fraction_digits += mantissa_digit & after_point
+        exponent = np.where(is_digit & in_exponent, 10.0*exponent + digit, exponent)
+
+    exponent = np.where(negative_exponent, -exponent, exponent) - fraction_digits
+    mantissa = np.where(negative, -mantissa, mantissa)
+    # Dividing by an exact power of ten keeps e.g. 0.1 correctly rounded
+    return np.where(exponent >= 0, mantissa*np.power(10.0, np.maximum(exponent, 0)),
+                    mantissa/np.power(10.0, np.maximum(-exponent, 0)))
+
+def parse_values(block, dtype):
+    """
+    Comma or newline separated decimal numbers (bytes) as a flat array, without making a Python
+    object per value. Most pixels are a single digit ('0'), which is decoded directly;
+    only the longer fields go through the full number parsing.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    separators = np.flatnonzero((data == ord(",")) | (data == ord("\n")))
+    starts = np.empty(len(separators) + 1, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = separators + 1
+    lengths = np.append(separators, len(data)) - starts
+    if np.any(lengths == 0):
+        raise ValueError("Found an empty value.")
+
+    # Digits wrap around to values above 9 when the character is not one
+    digits = data[starts] - np.uint8(ord("0"))
+    short = lengths == 1
+    if np.any(digits[short] > 9):
+        raise ValueError("Found a value that is not a decimal number.")
+    values = digits.astype(dtype)
+    long_fields = np.flatnonzero(~short)
+    if len(long_fields):
+        values[long_fields] = parse_long_fields(data, starts[long_fields], lengths[long_fields])
+    return values
+
+def parse_rows(block, dtype, num_columns):
+    """
+    Whole csv rows (bytes) as a (rows, num_columns) array, parsed in one vectorized pass.
+    """
+    block = block.replace(b"\r", b"").strip(b"\n")
+    while b"\n\n" in block:
+        block = block.replace(b"\n\n", b"\n")
+    values = parse_values(block, dtype) if block else np.zeros(0, dtype=dtype)
+    if values.size % num_columns:
+        raise ValueError("Rows don't have {} values each.".format(num_columns))
+    return values.reshape(-1, num_columns)
+
+def parse_row(line, dtype):
+    """
+    One csv row (bytes) as an array.
+    """
+    return parse_values(line.strip(), dtype)
+
+def iterate_row_blocks(csv_file, block_size=BLOCK_SIZE):
+    """
+    Yields the number of columns, then blocks of about block_size bytes made of whole rows.
+    """
+    with open(csv_file, "rb") as f:
+        yield f.readline().count(b",") + 1
+        remainder = b""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            remainder = block[end:]
+            if end:
+                yield block[:end]
+        if remainder.strip():
+            yield remainder
+
+def iterate_rows(csv_file, dtype, block_size=BLOCK_SIZE):
+    """
+    Generates one row at a time, parsing a block of many rows at once.
+    """
+    blocks = iterate_row_blocks(csv_file, block_size)
+    num_columns = next(blocks)
+    for block in blocks:
+        for row in parse_rows(block, dtype, num_columns):
+            yield row
+
+class CSVEventReader(object):
+    """
+    Random access to the events of a feature/label csv pair through their row offsets.
+    Files are opened for every read, so no handle is shared between threads or processes.
+    """
+    def __init__(self, feature_file, label_file):
+        self.feature_file = feature_file
+        self.label_file = label_file
+        self.feature_offsets = get_row_offsets(feature_file)
+        self.label_offsets = get_row_offsets(label_file)
+        if len(self.feature_offsets) != len(self.label_offsets):
+            raise ValueError("{} and {} have different number of events.".format(feature_file, label_file))
+        with open(feature_file, "rb") as f:
+            self.num_columns = f.readline().count(b",") + 1
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    def read_rows(self, csv_file, offsets, indices, dtype):
+        indices = np.asarray(indices)
+        with open(csv_file, "rb") as f:
+            # A contiguous run of rows is read and parsed as one block
+            if len(indices) and np.all(np.diff(indices) == 1):
+                f.seek(offsets[indices[0]])
+                block = f.read(offsets[indices[-1] + 1] - offsets[indices[0]])
+                return parse_rows(block, dtype, self.num_columns)
+            rows = []
+            for index in indices:
+                f.seek(offsets[index])
+                rows.append(parse_row(f.read(offsets[index + 1] - offsets[index]), dtype))
+        return np.stack(rows)
+
+    def read_events(self, indices):
+        """
+        Events at 'indices' as (features, labels) arrays of shape (events, pixels).
+        """
+        features = self.read_rows(self.feature_file, self.feature_offsets, indices, np.float32)
+        labels = self.read_rows(self.label_file, self.label_offsets, indices, np.uint8)
+        return features, labels
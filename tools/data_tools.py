@@ -1,113 +1,354 @@
-import csv
+import time
 import numpy as np
-from keras.utils import np_utils, Sequence
+from keras.utils import Sequence
+from tools.csv_tools import CSVEventReader, iterate_rows, get_row_offsets, parse_rows
+from tools.cache_tools import EventCache
+from tools.store_tools import EventStore, SparseEventStore, FEATURE_DTYPE, LABEL_DTYPE, open_store, get_store_file
+from tools.store_tools import get_plane_file
 
-def get_data_generator(feature_file, label_file):
+# Several planes are the channels of one input, or the inputs of a model with one input per plane
+PLANE_MODES = ["channels", "inputs"]
+
+def resolve_planes(feature_file, label_file, planes):
+    """
+    (feature_file, label_file, planes) to read: a single plane comes from its own files as one
+    plane always did, several planes (kept in the result) are read together by MultiPlaneReader.
+    """
+    if planes is not None and len(planes) == 1:
+        return (get_plane_file(feature_file, planes[0]),
+                get_plane_file(label_file, planes[0]) if label_file is not None else None, None)
+    return feature_file, label_file, list(planes) if planes else None
+
+def get_data_generator(feature_file, label_file, data_format="csv", planes=None):
     """
-    Allows to iterate over csv files.
-    Generates one row at a time.
+    Allows to iterate over csv files (or their binary stores with data_format='npy' or 'sparse').
+    Generates one row at a time, as float32 features and uint8 labels; with several planes
+    (e.g. ['u', 'v', 'w']) the rows of all of them are read in lockstep as (pixels, planes) arrays.
     """
-    with open(feature_file, "r") as csv1, open(label_file, "r") as csv2:
-        reader1 = csv.reader(csv1)
-        reader2 = csv.reader(csv2)
-        # Skip the header row
-        next(reader1)
-        next(reader2)
-        for row1, row2 in zip(reader1, reader2):
-            array_row1 = np.array(row1, dtype=np.float)
-            array_row2 = np.array(row2, dtype=np.int)
-            yield array_row1, array_row2
+    feature_file, label_file, planes = resolve_planes(feature_file, label_file, planes)
+    if planes is not None and data_format == "csv":
+        plane_files = [(get_plane_file(feature_file, p), get_plane_file(label_file, p)) for p in planes]
+        features = zip(*[iterate_rows(f, FEATURE_DTYPE) for f, _ in plane_files])
+        labels = zip(*[iterate_rows(l, LABEL_DTYPE) for _, l in plane_files])
+        for plane_features, plane_labels in zip(features, labels):
+            yield np.stack(plane_features, axis=-1), np.stack(plane_labels, axis=-1)
+        return
 
-def preprocess_feature(x, image_width, image_height, image_depth):
+    if data_format != "csv":
+        reader = get_event_reader(feature_file, label_file, data_format, planes)
+        for index in range(len(reader)):
+            features, labels = reader.read_events([index])
+            yield features[0], labels[0]
+        return
+
+    # Parse blocks of many rows at once
+    features = iterate_rows(feature_file, FEATURE_DTYPE)
+    labels = iterate_rows(label_file, LABEL_DTYPE)
+    for array_row1, array_row2 in zip(features, labels):
+        yield array_row1, array_row2
+
+def count_events(feature_file, data_format="csv"):
+    """
+    Number of events of a feature file (or its binary store).
+    """
+    if data_format == "csv":
+        return len(get_row_offsets(feature_file)) - 1
+    elif data_format == "npy":
+        return len(open_store(get_store_file(feature_file)))
+    return len(SparseEventStore(feature_file, None))
+
+def iterate_feature_batches(feature_file, data_format="csv", batch_size=1, max_events=None, planes=None):
+    """
+    Features only, with no label file needed, as (events, pixels) batches in file order;
+    e.g. to predict events that were never labelled. Several planes are read in lockstep
+    as (events, pixels, planes) batches.
+    """
+    feature_file, _, planes = resolve_planes(feature_file, None, planes)
+    if planes is not None:
+        batches = [iterate_feature_batches(get_plane_file(feature_file, p), data_format, batch_size, max_events)
+                   for p in planes]
+        for plane_batches in zip(*batches):
+            yield np.stack(plane_batches, axis=-1)
+        return
+
+    num_events = count_events(feature_file, data_format)
+    if max_events is not None:
+        num_events = min(num_events, max_events)
+
+    if data_format == "csv":
+        offsets = get_row_offsets(feature_file)
+        with open(feature_file, "rb") as f:
+            num_columns = f.readline().count(b",") + 1
+            for start in range(0, num_events, batch_size):
+                stop = min(start + batch_size, num_events)
+                f.seek(offsets[start])
+                yield parse_rows(f.read(offsets[stop] - offsets[start]), FEATURE_DTYPE, num_columns)
+    elif data_format == "npy":
+        store = open_store(get_store_file(feature_file))
+        for start in range(0, num_events, batch_size):
+            yield store[start:min(start + batch_size, num_events)]
+    elif data_format == "sparse":
+        store = SparseEventStore(feature_file, None)
+        for start in range(0, num_events, batch_size):
+            yield store.read_events(np.arange(start, min(start + batch_size, num_events)))[0]
+    else:
+        raise ValueError("Unknown data format '{}'; should be 'csv', 'npy' or 'sparse'.".format(data_format))
+
+def preprocess_feature(x, image_width, image_height, image_depth, dtype=np.float32):
     """
     Feature is the adc values; scale it such that each value is between 0 and 1.
     """
-    x_max = np.max(x)
-    x = x/x_max
-    return x.reshape(1, image_width, image_height, image_depth)
+    out = np.empty((1, image_width, image_height, image_depth), dtype=dtype)
+    return preprocess_features(x.reshape(1, -1), out)
+
+def preprocess_features(x, out):
+    """
+    Scale a batch of events (events, pixels) of any dtype, e.g. uint16 adc, event by event
+    such that each value is between 0 and 1; written in place into the preallocated 'out'.
+    Several planes (events, pixels, planes) are scaled plane by plane. An empty event or plane stays 0.
+    """
+    if x.ndim == 3:
+        x_max = np.max(x, axis=1).reshape((-1,) + (1,)*(out.ndim - 2) + (x.shape[2],))
+    else:
+        x_max = np.max(x, axis=1).reshape((-1,) + (1,)*(out.ndim - 1))
+    x_max = np.where(x_max > 0, x_max, 1)
+    np.divide(x.reshape(out.shape), x_max, out=out, casting="unsafe")
+    return out
+
+def preprocess_label(y, image_width, image_height):
+    """
+    Label is kept as a class map of integers; use the sparse losses and sparse_accuracy with it.
+    """
+    return y.astype(LABEL_DTYPE, copy=False).reshape(1, image_width, image_height, 1)
+
+def sample_patch_corners(labels, patch_size, patches_per_event, empty_patch_ratio, num_classes, rng):
+    """
+    Corners of patches_per_event patch_size x patch_size crops of every event of a batch of class
+    maps (events, width, height). Crops are centred on a random Cosmic/Beam pixel (any class but
+    Background), except for a fraction empty_patch_ratio (and events without such pixels) which
+    are placed uniformly. Returns the (events*patches_per_event,) event, x and y arrays.
+    """
+    num_events, width, height = labels.shape
+    events = np.repeat(np.arange(num_events), patches_per_event)
+
+    # Pixels of interest of all events, in event order; event e owns hits[starts[e]:starts[e] + counts[e]]
+    hits = np.flatnonzero((labels > 0) & (labels < num_classes))
+    counts = np.bincount(hits//(width*height), minlength=num_events)
+    starts = np.cumsum(counts) - counts
+
+    x = rng.randint(0, width - patch_size + 1, len(events))
+    y = rng.randint(0, height - patch_size + 1, len(events))
+    centred = (rng.rand(len(events)) >= empty_patch_ratio) & (counts[events] > 0)
+    chosen = hits[starts[events[centred]] + (rng.rand(np.sum(centred))*counts[events[centred]]).astype(np.int64)]
+    centre_x, centre_y = np.divmod(chosen % (width*height), height)
+    x[centred] = np.clip(centre_x - patch_size//2, 0, width - patch_size)
+    y[centred] = np.clip(centre_y - patch_size//2, 0, height - patch_size)
+    return events, x, y
+
+def cut_patches(images, events, x, y, patch_size):
+    """
+    Crops (patches, patch_size, patch_size, channels) of a batch of images (events, width, height, channels)
+    at the corners from sample_patch_corners, gathered in one step.
+    """
+    offsets = np.arange(patch_size)
+    return images[events[:, None, None], (x[:, None] + offsets)[:, :, None], (y[:, None] + offsets)[:, None, :]]
 
-def preprocess_label(y, image_width, image_height, num_classes):
-    return np_utils.to_categorical(y, num_classes=num_classes).reshape(1, image_width, image_height, num_classes)
+def get_event_reader(feature_file, label_file, data_format="csv", planes=None):
+    """
+    Random-access reader for a feature/label pair; 'csv' seeks through a cached row index,
+    'npy' slices the memory-mapped binary store and 'sparse' densifies the hit lists
+    made by convert_data.py. Several planes are read together by a MultiPlaneReader.
+    """
+    if planes is not None and len(planes) > 1:
+        return MultiPlaneReader(feature_file, label_file, planes, data_format)
+    feature_file, label_file, _ = resolve_planes(feature_file, label_file, planes)
+    if data_format == "csv":
+        return CSVEventReader(feature_file, label_file)
+    elif data_format == "npy":
+        return EventStore(feature_file, label_file)
+    elif data_format == "sparse":
+        return SparseEventStore(feature_file, label_file)
+    raise ValueError("Unknown data format '{}'; should be 'csv', 'npy' or 'sparse'.".format(data_format))
+
+class MultiPlaneReader(object):
+    """
+    Random access to the same events of several planes, e.g. feature_u/v/w.csv, which RootToCSV
+    writes row for row: every batch is read from all planes with the same indices (so the same
+    offsets in the row index of every file, and the same contiguous runs) and stacked as
+    (events, pixels, planes) features and labels. feature_file and label_file may be of any plane.
+    """
+    def __init__(self, feature_file, label_file, planes, data_format="csv"):
+        self.planes = list(planes)
+        self.readers = [get_event_reader(get_plane_file(feature_file, p), get_plane_file(label_file, p), data_format)
+                        for p in self.planes]
+        lengths = [len(reader) for reader in self.readers]
+        if len(set(lengths)) > 1:
+            raise ValueError("The planes {} have different numbers of events: {}.".format(self.planes, lengths))
+
+    def __len__(self):
+        return len(self.readers[0])
+
+    def read_events(self, indices):
+        planes = [reader.read_events(indices) for reader in self.readers]
+        return np.stack([f for f, _ in planes], axis=-1), np.stack([l for _, l in planes], axis=-1)
 
 class DataSequence(Sequence):
     """
-    Although sequence are a safer way to do multiprocessing,
-    use_multiprocessing=True in fit_generator is currently not supported here.
+    Batch at 'index' is read directly through the event reader, so batches don't depend on the
+    order in which they are requested and the events can be shuffled after every epoch.
+    The files are reopened for every batch (and memory maps in every process), so the batches
+    can be prepared by a pool of threads or, with use_multiprocessing=True, processes.
+    With patch_size > 0 every event gives patches_per_event random crops instead of the full image,
+    mostly centred on Cosmic/Beam pixels; the crops only depend on the epoch and the batch index.
+    A sampler (e.g. EventSampler) chooses the events of every epoch instead of taking each once.
+    With several planes (e.g. ['u', 'v', 'w']) the labels of the last one are the targets and the
+    planes are the image_depth channels of the samples (plane_mode='channels') or a list of
+    single-channel samples, one per input of the model (plane_mode='inputs').
     """
     def __init__(self, feature_file, label_file,
                  image_width, image_height, image_depth, num_classes,
-                 max_index=1, batch_size=1):
+                 max_index=1, batch_size=1, data_format="csv", shuffle=False, dtype=np.float32,
+                 patch_size=0, patches_per_event=1, empty_patch_ratio=0.0, cache_memory=0, cache_dir=None,
+                 num_shards=1, shard=0, sampler=None, planes=None, plane_mode="channels"):
+        feature_file, label_file, planes = resolve_planes(feature_file, label_file, planes)
+        if planes is not None:
+            if plane_mode not in PLANE_MODES:
+                raise ValueError("Unknown plane mode '{}'; should be one of {}.".format(plane_mode,
+                                                                                     ", ".join(PLANE_MODES)))
+            depth = len(planes) if plane_mode == "channels" else 1
+            if image_depth != depth:
+                raise ValueError("{} planes as {} need an image depth of {}, not {}.".format(
+                    len(planes), plane_mode, depth, image_depth))
         self.feature_file = feature_file
         self.label_file = label_file
         self.image_width = image_width
         self.image_height = image_height
         self.image_depth = image_depth
         self.num_classes = num_classes
-        self.max_index = max_index
         self.batch_size = batch_size
+        self.data_format = data_format
+        self.shuffle = shuffle
+        self.dtype = dtype
+        self.patch_size = patch_size
+        self.patches_per_event = patches_per_event
+        self.empty_patch_ratio = empty_patch_ratio
+        self.num_shards = num_shards
+        self.shard = shard
+        self.sampler = sampler
+        self.planes = planes
+        self.plane_mode = plane_mode
+        # Channels of the samples and targets as read, before they are split by plane_mode
+        self.sample_depth = len(planes) if planes else image_depth
+        self.target_depth = len(planes) if planes else 1
+        if patch_size > min(image_width, image_height):
+            raise ValueError("Patches of {} pixels don't fit in {}x{} images.".format(patch_size, image_width,
+                                                                                      image_height))
+        self.reader = get_event_reader(feature_file, label_file, data_format, planes)
+        self.max_index = min(max_index, len(self.reader))
+        # Preprocessed events are cached in memory (up to cache_memory bytes) and/or in cache_dir,
+        # so only the first epoch reads and preprocesses them
+        self.cache = None
+        if cache_memory or cache_dir:
+            self.cache = EventCache(feature_file, label_file, data_format, len(self.reader),
+                                    (image_width, image_height, self.sample_depth), dtype, cache_memory, cache_dir,
+                                    planes)
+        self.seed = np.random.randint(2**31)
+        self.epoch = -1
+        # Seconds spent making batches and their number, read by StepProfiler; with
+        # thread loaders they add up the time of all workers, process loaders keep their own
+        self.load_seconds = 0.0
+        self.load_count = 0
         self.on_epoch_end()
 
     def __len__(self):
         """
         The number of batches in a epoch.
         """
-        return int(np.ceil(self.max_index / float(self.batch_size)))
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
 
     def __getitem__(self, index):
         """
         Generate one batch of data at 'index', which is the position of the batch in the Sequence.
         """
-        full_index = index * self.batch_size
+        start = time.time()
+        indices = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
 
-        if full_index + self.batch_size >= self.max_index:
-            self.rows = self.max_index - full_index
+        # Generate data
+        if self.cache is not None:
+            X, y = self.cache.read(indices, self.__data_generation)
         else:
-            self.rows = min(self.batch_size, self.max_index)
+            X, y = self.__data_generation(indices)
 
-        # print("index {}; full index: {}; rows: {}".format(index, full_index, self.rows))
-
-        # Generate data
-        X, y = self.__data_generation(self.rows)
+        if self.patch_size:
+            # Seeded by epoch and batch, so the crops are the same in any worker thread or process
+            rng = np.random.RandomState([self.seed, self.epoch, index])
+            corners = sample_patch_corners(y[..., -1], self.patch_size, self.patches_per_event,
+                                           self.empty_patch_ratio, self.num_classes, rng)
+            X = cut_patches(X, *corners, patch_size=self.patch_size)
+            y = cut_patches(y, *corners, patch_size=self.patch_size)
+        X, y = self.select_planes(X, y)
 
+        self.load_seconds += time.time() - start
+        self.load_count += 1
         return X, y
 
+    def select_planes(self, X, y):
+        """
+        Targets of the last plane; the samples split into one array per plane for plane_mode='inputs'.
+        """
+        if self.planes is None:
+            return X, y
+        if self.plane_mode == "inputs":
+            X = [X[..., p:p + 1] for p in range(len(self.planes))]
+        return X, y[..., -1:]
+
+    def read_adc(self, index):
+        """
+        ADC values (rows, width, height) of the events of the batch at 'index', as stored (not scaled);
+        those of the last plane, whose labels are the targets, with several planes.
+        """
+        indices = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+        features, _ = self.reader.read_events(indices)
+        if self.planes is not None:
+            features = features[..., -1]
+        return features.reshape(len(indices), self.image_width, self.image_height)
+
     def on_epoch_end(self):
         """
         Update after each epoch.
         """
-        self.rows = min(self.batch_size, self.max_index)
-
-        self.reader1 = csv.reader(open(self.feature_file, "r"))
-        self.reader2 = csv.reader(open(self.label_file, "r"))
+        self.epoch += 1
+        # Seeded by epoch, so a resumed training sees the same events in the same order
+        rng = np.random.RandomState([self.seed, self.epoch])
+        if self.sampler is not None:
+            self.indices = self.sampler.sample(self.max_index, rng)
+        else:
+            self.indices = np.arange(self.max_index)
+        if self.shuffle:
+            rng.shuffle(self.indices)
+        if self.num_shards > 1:
+            # Equal, disjoint shards of the (shuffled) events, so that with the same seed every
+            # replica of data-parallel training takes the same number of steps on its own events
+            num_events = len(self.indices) - len(self.indices) % self.num_shards
+            self.indices = self.indices[:num_events][self.shard::self.num_shards]
 
-        # Skip the header row
-        next(self.reader1)
-        next(self.reader2)
+    def set_epoch(self, epoch, seed=None):
+        """
+        Continue at 'epoch' (with the seed of an earlier run), e.g. when training is resumed.
+        """
+        if seed is not None:
+            self.seed = seed
+        self.epoch = epoch - 1
+        self.on_epoch_end()
 
-    def __data_generation(self, rows):
+    def __data_generation(self, indices):
         """
-        Generates data containing batch_size samples
+        Generates data containing the samples at 'indices'
         """
-        samples = np.zeros((rows, self.image_width, self.image_height, self.image_depth))
-        targets = np.zeros((rows, self.image_width, self.image_height, self.num_classes))
-        for j in range(rows):
-            for row1, row2 in zip(self.reader1, self.reader2):
-                array_row1 = np.array(row1, dtype=np.float)
-                samples[j,:,:,:] = preprocess_feature(array_row1,
-                                                      self.image_width, self.image_height, self.image_depth)
-                try:
-                    next(self.reader1)
-                except StopIteration:
-                    print("CSV iteration end for feature. Calling 'break'.")
-                    break
-
-                array_row2 = np.array(row2, dtype=np.int)
-                targets[j,:,:,:] = preprocess_label(array_row2,
-                                                    self.image_width, self.image_height, self.num_classes)
-                try:
-                    next(self.reader2)
-                except StopIteration:
-                    print("CSV iteration end for label. Calling 'break'.")
-                    break
+        features, labels = self.reader.read_events(indices)
+        rows = len(indices)
+        samples = np.empty((rows, self.image_width, self.image_height, self.sample_depth), dtype=self.dtype)
+        preprocess_features(features, samples)
+        targets = labels.astype(LABEL_DTYPE).reshape(rows, self.image_width, self.image_height, self.target_depth)
 
         return samples, targets
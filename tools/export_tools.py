@@ -0,0 +1,154 @@
+import os
+import json
+import tempfile
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+from tools.inference_tools import get_tile_starts
+
+QUANTIZATIONS = ["none", "float16", "int8"]
+
+# Graph Transform Tool passes for inference: drop identities and checks, fold constants and batch norms
+OPTIMIZE_TRANSFORMS = ["add_default_attributes", "remove_nodes(op=Identity, op=CheckNumerics)",
+                       "fold_constants(ignore_errors=true)", "fold_batch_norms", "fold_old_batch_norms",
+                       "sort_by_execution_order"]
+
+def get_info_file(graph_file):
+    return os.path.splitext(graph_file)[0] + ".json"
+
+def freeze_model(model):
+    """
+    GraphDef of a Keras model with its variables turned into constants, keeping only the nodes
+    its output needs. Load the model after K.set_learning_phase(0), so that BatchNormalization
+    and Dropout are built in their test form.
+    """
+    session = K.get_session()
+    return tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(),
+                                                        [model.output.op.name])
+
+def optimize_graph(graph_def, input_name, output_name):
+    return TransformGraph(graph_def, [input_name], [output_name], OPTIMIZE_TRANSFORMS)
+
+def store_weights_as_float16(graph_def, min_size=16):
+    """
+    Float32 constants of at least min_size values stored as float16, each followed by a Cast back
+    to float32 under its original name: half the size on disk, the same float32 arithmetic.
+    """
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr["value"].tensor)
+            if value.size >= min_size:
+                const = output.node.add()
+                const.op = "Const"
+                const.name = node.name + "_float16"
+                const.attr["dtype"].type = tf.float16.as_datatype_enum
+                const.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float16)))
+                cast = output.node.add()
+                cast.op = "Cast"
+                cast.name = node.name
+                cast.input.append(const.name)
+                cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+                cast.attr["DstT"].type = tf.float32.as_datatype_enum
+                continue
+        output.node.add().CopyFrom(node)
+    return output
+
+def get_requantization_ranges(graph_def, input_name, batches):
+    """
+    Smallest minimum and largest maximum of every RequantizationRange node of an eight-bit
+    graph over the calibration batches.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    names = [node.name for node in graph_def.node if node.op == "RequantizationRange"]
+    fetches = [(graph.get_tensor_by_name(name + ":0"), graph.get_tensor_by_name(name + ":1")) for name in names]
+    input_tensor = graph.get_tensor_by_name(input_name + ":0")
+    ranges = {name: (np.inf, -np.inf) for name in names}
+    with tf.Session(graph=graph) as session:
+        for batch in batches:
+            for name, (minimum, maximum) in zip(names, session.run(fetches, {input_tensor: batch})):
+                low, high = ranges[name]
+                ranges[name] = (min(low, float(minimum)), max(high, float(maximum)))
+    return ranges
+
+def quantize_int8(graph_def, input_name, output_name, batches):
+    """
+    Eight-bit graph of the Graph Transform Tool: the weights and the ops it supports (convolutions,
+    bias adds, ReLUs, pooling, concatenations) run on quantized values with float ranges, the rest
+    in float32. The output range of every requantization is calibrated on 'batches' and frozen
+    into the graph instead of being searched for every input.
+    """
+    quantized = TransformGraph(graph_def, [input_name], [output_name], ["quantize_weights", "quantize_nodes"])
+    ranges = get_requantization_ranges(quantized, input_name, batches)
+
+    # freeze_requantization_ranges reads the ranges in the format of the insert_logging transform
+    with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as f:
+        for name, (minimum, maximum) in ranges.items():
+            f.write(";{}__print__;__requant_min_max:[{!r}][{!r}]\n".format(name, minimum, maximum))
+    try:
+        return TransformGraph(quantized, [input_name], [output_name],
+                              ['freeze_requantization_ranges(min_max_log_file="{}")'.format(f.name)])
+    finally:
+        os.remove(f.name)
+
+def iterate_tiles(images, tile_shape, batch_size):
+    """
+    Batches of the non-overlapping tiles of a batch of images, as a model with a fixed input
+    shape sees them; images smaller than a tile are padded with empty pixels.
+    """
+    tile_width, tile_height = tile_shape
+    width, height = images.shape[1:3]
+    if width < tile_width or height < tile_height:
+        images = np.pad(images, ((0, 0), (0, max(tile_width - width, 0)), (0, max(tile_height - height, 0)), (0, 0)),
+                        mode="constant")
+        width, height = images.shape[1:3]
+    tiles = np.concatenate([images[:, x:x + tile_width, y:y + tile_height]
+                            for x in get_tile_starts(width, tile_width, 0)
+                            for y in get_tile_starts(height, tile_height, 0)])
+    for first in range(0, len(tiles), batch_size):
+        yield tiles[first:first + batch_size]
+
+def save_graph(graph_def, graph_file, info):
+    """
+    The GraphDef and, next to it, a JSON file with the input and output names and shapes.
+    """
+    directory = os.path.dirname(graph_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(graph_file, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    with open(get_info_file(graph_file), "w") as f:
+        json.dump(info, f, indent=4)
+
+class FrozenModel(object):
+    """
+    An exported graph in place of a Keras model, e.g. for TiledPredictor: input_shape,
+    output_shape and predict_on_batch, run in a session of its own.
+    """
+    def __init__(self, graph_file):
+        with open(get_info_file(graph_file), "r") as f:
+            self.info = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(graph_file, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.input = self.graph.get_tensor_by_name(self.info["input"] + ":0")
+        self.output = self.graph.get_tensor_by_name(self.info["output"] + ":0")
+        self.input_shape = tuple(self.info["input_shape"])
+        self.output_shape = tuple(self.info["output_shape"])
+        self.input_dtype = self.input.dtype.as_numpy_dtype
+        self.session = tf.Session(graph=self.graph)
+
+    def predict_on_batch(self, inputs):
+        return self.session.run(self.output, {self.input: inputs.astype(self.input_dtype, copy=False)})
+
+    def close(self):
+        self.session.close()
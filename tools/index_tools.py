@@ -0,0 +1,177 @@
+import os
+import numpy as np
+from tools.csv_tools import CSVEventReader
+from tools.store_tools import EventStore, SparseEventStore
+from tools.scan_tools import CHUNK_SIZE, get_feature_source, get_label_source, get_num_events, scan_in_chunks
+from tools.scan_tools import get_source_key, load_cached_arrays, save_cached_arrays
+
+# Per-event statistics, (events,) or (events, n) arrays
+INDEX_FIELDS = ["counts", "hits", "adc", "bbox"]
+
+def get_event_index_file(source_file):
+    """
+    Statistics index next to the scanned features; e.g. feature_w.csv -> feature_w.events.npz
+    (feature_w.index.npz is the row index of the csv file)
+    """
+    return os.path.splitext(source_file)[0] + ".events.npz"
+
+def count_classes(labels, num_classes):
+    """
+    (events, num_classes) pixel counts of a (events, pixels) label array, with a single bincount.
+    Labels outside the classes (e.g. Undefined) are not counted.
+    """
+    labels = np.asarray(labels)
+    num_events = len(labels)
+    events = np.repeat(np.arange(num_events), labels.size//max(num_events, 1))
+    labels = labels.ravel().astype(np.int64)
+    valid = labels < num_classes
+    counts = np.bincount(events[valid]*num_classes + labels[valid], minlength=num_events*num_classes)
+    return counts.reshape(num_events, num_classes)
+
+def get_first_last(occupied):
+    """
+    First and last True of every row of a (events, n) array; -1 for rows without any.
+    """
+    n = occupied.shape[1]
+    present = occupied.any(axis=1)
+    first = np.where(present, np.argmax(occupied, axis=1), -1)
+    last = np.where(present, n - 1 - np.argmax(occupied[:, ::-1], axis=1), -1)
+    return first, last
+
+def get_dense_statistics(features, labels, image_shape, num_classes):
+    """
+    Statistics of (events, pixels) features and labels: pixel counts of every class, pixels with
+    ADC above zero, their total ADC and bounding box (x_min, x_max, y_min, y_max), inclusive.
+    """
+    features = np.asarray(features).reshape((len(features),) + tuple(image_shape))
+    occupied = features > 0
+    x_min, x_max = get_first_last(occupied.any(axis=2))
+    y_min, y_max = get_first_last(occupied.any(axis=1))
+    return {"counts": count_classes(labels, num_classes),
+            "hits": occupied.sum(axis=(1, 2)),
+            "adc": features.sum(axis=(1, 2), dtype=np.float64),
+            "bbox": np.stack([x_min, x_max, y_min, y_max], axis=1)}
+
+def get_hit_statistics(offsets, x, y, adc, labels, num_pixels, num_classes):
+    """
+    The statistics of get_dense_statistics from hit lists; hit i of event e is in
+    offsets[e]:offsets[e + 1] and pixels without hits are Background.
+    """
+    num_events = len(offsets) - 1
+    events = np.repeat(np.arange(num_events), np.diff(offsets))
+    labels = np.asarray(labels).astype(np.int64)
+    valid = labels < num_classes
+    counts = np.bincount(events[valid]*num_classes + labels[valid], minlength=num_events*num_classes)
+    counts = counts.reshape(num_events, num_classes)
+    counts[:, 0] += num_pixels - np.diff(offsets)
+
+    occupied = np.asarray(adc) > 0
+    events, x, y = events[occupied], np.asarray(x, dtype=np.int64)[occupied], np.asarray(y, dtype=np.int64)[occupied]
+    hits = np.bincount(events, minlength=num_events)
+    bbox = np.empty((num_events, 4), dtype=np.int64)
+    bbox[:, [0, 2]] = np.iinfo(np.int64).max
+    bbox[:, [1, 3]] = -1
+    np.minimum.at(bbox[:, 0], events, x)
+    np.maximum.at(bbox[:, 1], events, x)
+    np.minimum.at(bbox[:, 2], events, y)
+    np.maximum.at(bbox[:, 3], events, y)
+    bbox[hits == 0] = -1
+    return {"counts": counts,
+            "hits": hits,
+            "adc": np.bincount(events, weights=np.asarray(adc, dtype=np.float64)[occupied], minlength=num_events),
+            "bbox": bbox}
+
+def scan_chunk(task):
+    """
+    Statistics of the events [start, stop) of a file; runs in a pool worker.
+    """
+    start, stop, feature_file, label_file, data_format, image_shape, num_classes = task
+    if data_format == "csv":
+        features, labels = CSVEventReader(feature_file, label_file).read_events(np.arange(start, stop))
+        return get_dense_statistics(features, labels, image_shape, num_classes)
+    elif data_format == "npy":
+        features, labels = EventStore(feature_file, label_file).read(start, stop)
+        return get_dense_statistics(features, labels, image_shape, num_classes)
+    store = SparseEventStore(feature_file, label_file)
+    store.open()
+    offsets = np.asarray(store.arrays["offsets"][start:stop + 1])
+    hits = slice(offsets[0], offsets[-1])
+    # Pixel (x, y) of a hit is (tdc, wire), as in SparseEventStore.read_events
+    return get_hit_statistics(offsets - offsets[0], store.arrays["tdc"][hits], store.arrays["wire"][hits],
+                              store.arrays["adc"][hits], store.arrays["label"][hits],
+                              image_shape[0]*image_shape[1], num_classes)
+
+def scan_event_index(feature_file, label_file, data_format, image_shape, num_classes, workers=1,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Statistics of every event of a file in one pass, with chunks of events split across a process pool.
+    """
+    num_events = get_num_events(feature_file, label_file, data_format)
+    chunks = scan_in_chunks(scan_chunk, num_events, (feature_file, label_file, data_format, tuple(image_shape),
+                                                     num_classes), workers, chunk_size)
+    if not chunks:
+        return {"counts": np.zeros((0, num_classes), dtype=np.int64), "hits": np.zeros(0, dtype=np.int64),
+                "adc": np.zeros(0), "bbox": np.zeros((0, 4), dtype=np.int64)}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in INDEX_FIELDS}
+
+def get_event_index(feature_file, label_file, data_format, image_shape, num_classes, workers=1):
+    """
+    Statistics of every event of a file, cached next to its features and rescanned whenever
+    the features or labels change.
+    """
+    sources = [get_feature_source(feature_file, data_format), get_label_source(feature_file, label_file, data_format)]
+    key = get_source_key(sources) + list(image_shape) + [num_classes]
+    index_file = get_event_index_file(sources[0])
+    index = load_cached_arrays(index_file, key, sources, INDEX_FIELDS)
+    if index is None:
+        index = scan_event_index(feature_file, label_file, data_format, image_shape, num_classes, workers)
+        save_cached_arrays(index_file, key, sources, index)
+    return index
+
+class EventSampler(object):
+    """
+    Events of an epoch chosen from the statistics index: events with fewer than min_hits pixels
+    above zero ADC are skipped, and events with at least rich_pixels pixels of class rich_class
+    (e.g. Beam) are drawn 'oversample' times on average, e.g. 2.5: twice each, and once more for
+    half of them picked at random. The number of events is the same in every epoch, as
+    fit_generator expects, and only depends on the random state.
+    """
+    def __init__(self, index, min_hits=0, rich_class=2, rich_pixels=1, oversample=1.0):
+        if oversample < 1.0:
+            raise ValueError("Oversampling rate of {} should be at least 1.".format(oversample))
+        self.index = index
+        self.min_hits = min_hits
+        self.rich_class = rich_class
+        self.rich_pixels = rich_pixels
+        self.oversample = oversample
+
+    def get_masks(self, max_index):
+        kept = self.index["hits"][:max_index] >= self.min_hits
+        rich = kept & (self.index["counts"][:max_index, self.rich_class] >= self.rich_pixels)
+        return kept, rich
+
+    def sample(self, max_index, rng):
+        """
+        Indices of the events of an epoch among the first max_index, with repeats, in file order.
+        """
+        kept, rich = self.get_masks(max_index)
+        repeats = kept.astype(np.int64)
+        repeats[rich] = int(self.oversample)
+        rich_indices = np.flatnonzero(rich)
+        extra = int(round((self.oversample - int(self.oversample))*len(rich_indices)))
+        repeats[rng.choice(rich_indices, size=extra, replace=False)] += 1
+        return np.repeat(np.arange(max_index), repeats)
+
+    def report(self, max_index, class_names):
+        kept, rich = self.get_masks(max_index)
+        counts = self.index["counts"][:max_index]
+        rich_name = class_names[self.rich_class]
+        before = counts.sum(axis=0)/float(max(counts.sum(), 1))
+        epoch_counts = counts[kept].sum(axis=0) + (self.oversample - 1.0)*counts[rich].sum(axis=0)
+        after = epoch_counts/max(epoch_counts.sum(), 1)
+        return ("Skipping {} of {} events with fewer than {} hits; {} {}-rich events (at least {} pixels)"
+                " drawn {:g} times; {} events per epoch\nPixel fractions {} -> {}").format(
+                    max_index - np.sum(kept), max_index, self.min_hits, np.sum(rich), rich_name, self.rich_pixels,
+                    self.oversample, np.sum(kept) + int(round((self.oversample - 1.0)*np.sum(rich))),
+                    " ".join("{}: {:.4f}".format(name, f) for name, f in zip(class_names, before)),
+                    " ".join("{}: {:.4f}".format(name, f) for name, f in zip(class_names, after)))
@@ -0,0 +1,155 @@
+import time
+import numpy as np
+
+def get_tile_starts(length, tile_length, overlap):
+    """
+    Starts of windows of tile_length that cover [0, length) sharing at least 'overlap' pixels;
+    the last window ends at the edge. Shorter lengths are padded up to a single window.
+    """
+    if length <= tile_length:
+        return np.zeros(1, dtype=np.int64)
+    stride = max(tile_length - overlap, 1)
+    return np.append(np.arange(0, length - tile_length, stride), length - tile_length)
+
+def get_blend_window(tile_length, overlap):
+    """
+    Weights along a tile: linear ramps over the overlap at both ends, so that neighbouring
+    tiles fade into each other instead of leaving seams at the tile borders.
+    """
+    ramp = np.arange(1, tile_length + 1, dtype=np.float32)/(overlap + 1)
+    return np.minimum(1.0, np.minimum(ramp, ramp[::-1]))
+
+def get_tile_shape(model, tile_size):
+    """
+    A model with a fixed input shape takes tiles of that shape; fully convolutional
+    models (e.g. trained on patches) take tile_size x tile_size tiles.
+    """
+    input_shape = model.input_shape[0] if isinstance(model.input_shape, list) else model.input_shape
+    width, height = input_shape[1:3]
+    if width is None or height is None:
+        return tile_size, tile_size
+    return width, height
+
+def count_tile_hits(hits, corners, tile_shape):
+    """
+    Number of hits in every tile of every event, (events, tiles), from a summed-area table
+    of the (events, width, height) hit map; four lookups per tile whatever its size.
+    """
+    num_events, width, height = hits.shape
+    integral = np.zeros((num_events, width + 1, height + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(hits, axis=1, dtype=np.int64), axis=2, out=integral[:, 1:, 1:])
+    x = np.array([corner[0] for corner in corners], dtype=np.int64)
+    y = np.array([corner[1] for corner in corners], dtype=np.int64)
+    x_end, y_end = x + tile_shape[0], y + tile_shape[1]
+    return integral[:, x_end, y_end] - integral[:, x, y_end] - integral[:, x_end, y] + integral[:, x, y]
+
+class TiledPredictor(object):
+    """
+    Softmax output of a model for images of any size: every image is cut into overlapping tiles,
+    the tiles of a batch of images go through the model batch_size at a time and their outputs
+    are blended back into full-resolution probabilities. Throughput is accumulated over calls.
+    With skip_empty, tiles without any pixel above 'threshold' don't go through the model and
+    count as Background; every tile covering a hit is still predicted, so pixels with hits get
+    exactly the probabilities of dense inference.
+    A model with one input per plane gets every channel of the images as an input of its own.
+    """
+    def __init__(self, model, tile_shape, overlap=0, batch_size=16, skip_empty=False, threshold=0.0):
+        if overlap >= min(tile_shape):
+            raise ValueError("Overlap of {} pixels doesn't fit in {}x{} tiles.".format(overlap, *tile_shape))
+        self.model = model
+        self.tile_shape = tuple(tile_shape)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.window = np.outer(get_blend_window(self.tile_shape[0], overlap),
+                               get_blend_window(self.tile_shape[1], overlap))
+        self.skip_empty = skip_empty
+        self.threshold = threshold
+        self.num_inputs = len(model.input_shape) if isinstance(model.input_shape, list) else 1
+        self.num_events = 0
+        self.num_pixels = 0
+        self.num_tiles = 0
+        self.seconds = 0.0
+        # (tiles, predicted tiles) of every event
+        self.event_tiles = []
+
+    def get_corners(self, width, height):
+        return [(x, y) for x in get_tile_starts(width, self.tile_shape[0], self.overlap)
+                for y in get_tile_starts(height, self.tile_shape[1], self.overlap)]
+
+    def predict_tiles(self, images, tiles, sums):
+        """
+        Add the weighted model output of the (event, x, y) tiles of images to sums.
+        """
+        tile_width, tile_height = self.tile_shape
+        for first in range(0, len(tiles), self.batch_size):
+            batch = tiles[first:first + self.batch_size]
+            inputs = np.stack([images[event, x:x + tile_width, y:y + tile_height] for event, x, y in batch])
+            if self.num_inputs > 1:
+                inputs = [inputs[..., i:i + 1] for i in range(self.num_inputs)]
+            outputs = self.model.predict_on_batch(inputs)
+            for (event, x, y), output in zip(batch, outputs):
+                sums[event, x:x + tile_width, y:y + tile_height] += output*self.window[..., None]
+        self.num_tiles += len(tiles)
+
+    def predict(self, images, adc=None):
+        """
+        Probabilities (events, width, height, classes) of a batch of images (events, width, height, depth).
+        Empty tiles are found from 'adc' (events, width, height) if given, e.g. when the threshold is
+        in ADC counts and the images are normalised, otherwise from the last channel of the images
+        (the plane whose labels are predicted).
+        """
+        start = time.time()
+        num_events, width, height = images.shape[:3]
+        tile_width, tile_height = self.tile_shape
+        if self.skip_empty:
+            hits = (images[..., -1] if adc is None else adc.reshape(num_events, width, height)) > self.threshold
+
+        # Images smaller than a tile are padded with empty pixels
+        padded_width, padded_height = max(width, tile_width), max(height, tile_height)
+        if (padded_width, padded_height) != (width, height):
+            images = np.pad(images, ((0, 0), (0, padded_width - width), (0, padded_height - height), (0, 0)),
+                            mode="constant")
+            if self.skip_empty:
+                hits = np.pad(hits, ((0, 0), (0, padded_width - width), (0, padded_height - height)),
+                              mode="constant")
+
+        corners = self.get_corners(padded_width, padded_height)
+        weights = np.zeros((padded_width, padded_height), dtype=np.float32)
+        for x, y in corners:
+            weights[x:x + tile_width, y:y + tile_height] += self.window
+
+        num_classes = self.model.output_shape[-1]
+        sums = np.zeros((num_events, padded_width, padded_height, num_classes), dtype=np.float32)
+        if self.skip_empty:
+            occupied = count_tile_hits(hits, corners, self.tile_shape) > 0
+        else:
+            occupied = np.ones((num_events, len(corners)), dtype=bool)
+        tiles = [(event, x, y) for event in range(num_events) for (x, y), tile_occupied
+                 in zip(corners, occupied[event]) if tile_occupied]
+        self.predict_tiles(images, tiles, sums)
+
+        # Skipped tiles are Background with certainty
+        for event, tile in zip(*np.nonzero(~occupied)):
+            x, y = corners[tile]
+            sums[event, x:x + tile_width, y:y + tile_height, 0] += self.window
+        sums /= weights[..., None]
+        self.event_tiles.extend((len(corners), int(predicted)) for predicted in occupied.sum(axis=1))
+
+        self.num_events += num_events
+        self.num_pixels += num_events*width*height
+        self.seconds += time.time() - start
+        return sums[:, :width, :height]
+
+    def report(self):
+        seconds = max(self.seconds, 1e-9)
+        report = "{} events ({} tiles) in {:.1f} s: {:.2f} events/s, {:.3g} pixels/s".format(
+            self.num_events, self.num_tiles, self.seconds, self.num_events/seconds, self.num_pixels/seconds)
+        if self.skip_empty and self.event_tiles:
+            tiles, predicted = np.array(self.event_tiles).T
+            skipped = 1.0 - predicted/tiles.astype(np.float64)
+            report += ("\nSkipped {} of {} tiles ({:.1f}%); per event {:.1f}% on average, {:.1f}% median;"
+                       " {} empty events").format(np.sum(tiles - predicted), np.sum(tiles),
+                                                 100.0*np.sum(tiles - predicted)/np.sum(tiles),
+                                                 100.0*np.mean(skipped), 100.0*np.median(skipped),
+                                                 np.sum(predicted == 0))
+        return report
@@ -1,5 +1,7 @@
+import numpy as np
 import tensorflow as tf
 from keras import backend as K
+from keras.layers import Layer
 
 def weighted_categorical_crossentropy(weights):
     """
@@ -68,6 +70,84 @@ def weighted_focal_loss(weights, gamma=2.0):
 
     return loss
 
+def sparse_targets(loss_function):
+    """
+    Let a loss written for one-hot targets take integer class maps of shape (..., 1) instead.
+    The one-hot tensor is only made in the graph, so the loss values are identical.
+    """
+    def loss(y_true, y_pred):
+        num_classes = K.int_shape(y_pred)[-1]
+        y_true = tf.one_hot(tf.cast(y_true[..., 0], tf.int32), num_classes, dtype=y_pred.dtype)
+        return loss_function(y_true, y_pred)
+
+    return loss
+
+def sparse_weighted_categorical_crossentropy(weights):
+    """
+    weighted_categorical_crossentropy for integer class map targets.
+    """
+    return sparse_targets(weighted_categorical_crossentropy(weights))
+
+def sparse_focal_loss(alpha=0.25, gamma=2.0):
+    """
+    focal_loss for integer class map targets.
+    """
+    return sparse_targets(focal_loss(alpha, gamma))
+
+def sparse_weighted_focal_loss(weights, gamma=2.0):
+    """
+    weighted_focal_loss for integer class map targets.
+    """
+    return sparse_targets(weighted_focal_loss(weights, gamma))
+
+def sparse_accuracy(y_true, y_pred):
+    """
+    Pixel accuracy for integer class map targets of shape (..., 1).
+    """
+    y_true = tf.cast(y_true[..., 0], tf.int64)
+    return K.cast(K.equal(y_true, K.argmax(y_pred, axis=-1)), K.floatx())
+
+class ConfusionMatrix(Layer):
+    """
+    Stateful metric accumulating the confusion matrix (true class rows, predicted class columns)
+    over the batches of an epoch with one bincount per batch; reported as the mean IoU.
+    Keras resets it at the start of every epoch and before validation, so after an epoch
+    'matrix' holds the validation confusion matrix and 'val_mean_iou' is logged for free.
+    """
+    def __init__(self, num_classes, name="mean_iou", **kwargs):
+        super(ConfusionMatrix, self).__init__(name=name, **kwargs)
+        self.stateful = True
+        self.num_classes = num_classes
+        # float64 counts stay exact well beyond the pixels of a full validation set
+        self.matrix = K.variable(np.zeros((num_classes, num_classes)), dtype="float64", name=name + "_matrix")
+
+    def reset_states(self):
+        K.set_value(self.matrix, np.zeros((self.num_classes, self.num_classes)))
+
+    def __call__(self, y_true, y_pred):
+        n = self.num_classes
+        y_true = tf.reshape(tf.cast(y_true[..., 0], tf.int32), [-1])
+        y_pred = tf.reshape(tf.cast(K.argmax(y_pred, axis=-1), tf.int32), [-1])
+
+        # Labels outside the classes (e.g. Undefined) are ignored
+        index = tf.boolean_mask(y_true*n + y_pred, y_true < n)
+        counts = tf.bincount(index, minlength=n*n, maxlength=n*n, dtype=tf.float64)
+        counts = tf.reshape(counts, (n, n))
+
+        matrix = self.matrix*1 + counts
+        self.add_update(K.update_add(self.matrix, counts), inputs=[y_true, y_pred])
+
+        true_positives = tf.diag_part(matrix)
+        union = tf.reduce_sum(matrix, axis=0) + tf.reduce_sum(matrix, axis=1) - true_positives
+        present = union > 0
+        iou = tf.boolean_mask(true_positives, present)/tf.boolean_mask(union, present)
+        return tf.cast(tf.reduce_mean(iou), tf.float32)
+
+    def get_config(self):
+        config = super(ConfusionMatrix, self).get_config()
+        config["num_classes"] = self.num_classes
+        return config
+
 # For Keras, custom metrics can be passed at the compilation step but
 # the function would need to take (y_true, y_pred) as arguments and return a single tensor value.
 # Note: seems like this implementation is not stable; it sometimes returns 0 in standalone tests
@@ -0,0 +1,85 @@
+import numpy as np
+
+def confusion_matrix(y_true, y_pred, num_classes):
+    """
+    (num_classes x num_classes) counts of true class (rows) versus predicted class (columns)
+    from two class maps of any shape, with a single bincount.
+    Pixels with a label outside the classes (e.g. Undefined) are ignored.
+    """
+    y_true = np.asarray(y_true).ravel().astype(np.int64)
+    y_pred = np.asarray(y_pred).ravel().astype(np.int64)
+    valid = y_true < num_classes
+    index = y_true[valid]*num_classes + y_pred[valid]
+    return np.bincount(index, minlength=num_classes*num_classes).reshape(num_classes, num_classes)
+
+def merge_confusion_matrices(matrices):
+    """
+    Sum of partial confusion matrices, e.g. one per batch or per worker.
+    """
+    return np.sum(np.asarray(matrices), axis=0)
+
+def safe_divide(numerator, denominator):
+    """
+    Per-class ratio; classes that never appear get nan instead of a warning.
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    ratio = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=ratio, where=denominator > 0)
+    return ratio
+
+def true_false_counts(matrix):
+    """
+    True positives, false positives and false negatives per class.
+    """
+    true_positives = np.diag(matrix)
+    false_positives = np.sum(matrix, axis=0) - true_positives
+    false_negatives = np.sum(matrix, axis=1) - true_positives
+    return true_positives, false_positives, false_negatives
+
+def intersection_over_union(matrix):
+    tp, fp, fn = true_false_counts(matrix)
+    return safe_divide(tp, tp + fp + fn)
+
+def dice(matrix):
+    tp, fp, fn = true_false_counts(matrix)
+    return safe_divide(2*tp, 2*tp + fp + fn)
+
+def precision(matrix):
+    tp, fp, fn = true_false_counts(matrix)
+    return safe_divide(tp, tp + fp)
+
+def recall(matrix):
+    tp, fp, fn = true_false_counts(matrix)
+    return safe_divide(tp, tp + fn)
+
+def pixel_accuracy(matrix):
+    return np.trace(matrix)/float(max(np.sum(matrix), 1))
+
+def class_metrics(matrix):
+    """
+    IoU, Dice, precision and recall of every class.
+    """
+    return {"iou": intersection_over_union(matrix),
+            "dice": dice(matrix),
+            "precision": precision(matrix),
+            "recall": recall(matrix)}
+
+def print_class_metrics(matrix, class_names):
+    metrics = class_metrics(matrix)
+    print("{:>12s} {:>8s} {:>8s} {:>10s} {:>8s}".format("Class", "IoU", "Dice", "Precision", "Recall"))
+    for c, class_name in enumerate(class_names):
+        print("{:>12s} {:8.3f} {:8.3f} {:10.3f} {:8.3f}".format(class_name, metrics["iou"][c], metrics["dice"][c],
+                                                              metrics["precision"][c], metrics["recall"][c]))
+    print("{:>12s} {:8.3f}".format("Mean", np.nanmean(metrics["iou"])))
+
+def print_iou_comparison(matrix, other_matrix, class_names, names=("Original", "Quantized")):
+    """
+    IoU of every class for two models on the same events, and how much the second one changes it.
+    """
+    iou, other_iou = intersection_over_union(matrix), intersection_over_union(other_matrix)
+    print("{:>12s} {:>10s} {:>10s} {:>8s}".format("Class", names[0], names[1], "Delta"))
+    for c, class_name in enumerate(class_names):
+        print("{:>12s} {:10.4f} {:10.4f} {:+8.4f}".format(class_name, iou[c], other_iou[c], other_iou[c] - iou[c]))
+    print("{:>12s} {:10.4f} {:10.4f} {:+8.4f}".format("Mean", np.nanmean(iou), np.nanmean(other_iou),
+                                                    np.nanmean(other_iou) - np.nanmean(iou)))
@@ -1,91 +1,354 @@
+import os
+import csv
+import json
+import time
+import resource
 from keras.models import Model
-from keras.layers.merge import concatenate
+from keras.layers.merge import concatenate, add
 from keras.layers.pooling import MaxPooling2D
-from keras.layers.convolutional import Conv2D, Conv2DTranspose
+from keras.layers.convolutional import Conv2D, Conv2DTranspose, SeparableConv2D
 from keras.layers import BatchNormalization, Activation, Dense, Dropout
-from keras.callbacks import EarlyStopping, ReduceLROnPlateau, ModelCheckpoint
+from keras import backend as K
+from keras.callbacks import Callback, EarlyStopping, ReduceLROnPlateau, ModelCheckpoint
+from tools.metrics_tools import class_metrics
+from tools.checkpoint_tools import TrainingCheckpoint, get_fingerprint
+
+def set_float_dtype(dtype):
+    """
+    Float type of the layers built afterwards; float16 needs a larger fuzz factor.
+    """
+    K.set_floatx(dtype)
+    if dtype == "float16":
+        K.set_epsilon(1e-4)
+
+def make_conv2d_block(input_tensor, num_filters, kernel_size=3, batchnorm=True, separable=False):
+    # Depthwise-separable convolutions need about kernel_size**2 times fewer multiplications
+    conv = SeparableConv2D if separable else Conv2D
+    initializer = {"depthwise_initializer": "he_normal", "pointwise_initializer": "he_normal"} if separable \
+        else {"kernel_initializer": "he_normal"}
 
-def make_conv2d_block(input_tensor, num_filters, kernel_size=3, batchnorm=True):
     # First layer
-    x = Conv2D(filters=num_filters, kernel_size=(kernel_size, kernel_size), kernel_initializer="he_normal",
-               padding="same")(input_tensor)
+    x = conv(filters=num_filters, kernel_size=(kernel_size, kernel_size), padding="same", **initializer)(input_tensor)
     if batchnorm:
         x = BatchNormalization()(x)
     x = Activation("relu")(x)
 
     # Second layer
-    x = Conv2D(filters=num_filters, kernel_size=(kernel_size, kernel_size), kernel_initializer="he_normal",
-               padding="same")(x)
+    x = conv(filters=num_filters, kernel_size=(kernel_size, kernel_size), padding="same", **initializer)(x)
     if batchnorm:
         x = BatchNormalization()(x)
     x = Activation("relu")(x)
     return x
 
-def get_unet_model(input_tensor, num_classes, num_filters=64, dropout=0.05, batchnorm=True):
-    # Vontracting path
-    c1 = make_conv2d_block(input_tensor, num_filters=num_filters*1, kernel_size=3, batchnorm=batchnorm)
-    p1 = MaxPooling2D((2, 2)) (c1)
-    p1 = Dropout(dropout)(p1)
+def make_unet(input_tensor, num_classes, num_filters=64, dropout=0.05, batchnorm=True,
+              depth=4, width_multiplier=1.0, separable=False, additive_skips=False):
+    """
+    Softmax output of a U-Net on input_tensor that halves the image 'depth' times; level i has
+    (num_filters*width_multiplier)*2**i filters. separable uses depthwise-separable convolution
+    blocks and additive_skips adds the skip connections instead of concatenating them, which
+    halves the input of the expansive blocks.
+    """
+    filters = max(1, int(round(num_filters*width_multiplier)))
 
-    c2 = make_conv2d_block(p1, num_filters=num_filters*2, kernel_size=3, batchnorm=batchnorm)
-    p2 = MaxPooling2D((2, 2)) (c2)
-    p2 = Dropout(dropout)(p2)
+    # Contracting path
+    skips = []
+    x = input_tensor
+    for level in range(depth):
+        c = make_conv2d_block(x, num_filters=filters*2**level, kernel_size=3, batchnorm=batchnorm,
+                              separable=separable)
+        skips.append(c)
+        x = MaxPooling2D((2, 2)) (c)
+        x = Dropout(dropout)(x)
 
-    c3 = make_conv2d_block(p2, num_filters=num_filters*4, kernel_size=3, batchnorm=batchnorm)
-    p3 = MaxPooling2D((2, 2)) (c3)
-    p3 = Dropout(dropout)(p3)
+    x = make_conv2d_block(x, num_filters=filters*2**depth, kernel_size=3, batchnorm=batchnorm, separable=separable)
 
-    c4 = make_conv2d_block(p3, num_filters=num_filters*8, kernel_size=3, batchnorm=batchnorm)
-    p4 = MaxPooling2D(pool_size=(2, 2)) (c4)
-    p4 = Dropout(dropout)(p4)
+    # Expansive path
+    for level in reversed(range(depth)):
+        u = Conv2DTranspose(filters*2**level, (3, 3), strides=(2, 2), padding='same') (x)
+        u = add([u, skips[level]]) if additive_skips else concatenate([u, skips[level]], axis=3)
+        u = Dropout(dropout)(u)
+        x = make_conv2d_block(u, num_filters=filters*2**level, kernel_size=3, batchnorm=batchnorm,
+                              separable=separable)
 
-    c5 = make_conv2d_block(p4, num_filters=num_filters*16, kernel_size=3, batchnorm=batchnorm)
+    return Conv2D(num_classes, (1, 1), activation='softmax') (x)
 
-    # Expansive path
-    u6 = Conv2DTranspose(num_filters*8, (3, 3), strides=(2, 2), padding='same') (c5)
-    u6 = concatenate([u6, c4])
-    u6 = Dropout(dropout)(u6)
-    c6 = make_conv2d_block(u6, num_filters=num_filters*8, kernel_size=3, batchnorm=batchnorm)
+def get_unet_model(input_tensor, num_classes, num_filters=64, dropout=0.05, batchnorm=True,
+                   depth=4, width_multiplier=1.0, separable=False, additive_skips=False):
+    """
+    The U-Net of make_unet as a model; the defaults build the original 5-level U-Net, layer for layer.
+    """
+    outputs = make_unet(input_tensor, num_classes, num_filters=num_filters, dropout=dropout, batchnorm=batchnorm,
+                        depth=depth, width_multiplier=width_multiplier, separable=separable,
+                        additive_skips=additive_skips)
+    model = Model(inputs=[input_tensor], outputs=[outputs])
+    return model
 
-    u7 = Conv2DTranspose(num_filters*4, (3, 3), strides=(2, 2), padding='same') (c6)
-    u7 = concatenate([u7, c3])
-    u7 = Dropout(dropout)(u7)
-    c7 = make_conv2d_block(u7, num_filters=num_filters*4, kernel_size=3, batchnorm=batchnorm)
+def get_multiplane_unet_model(input_tensors, num_classes, num_filters=64, dropout=0.05, batchnorm=True,
+                              depth=4, width_multiplier=1.0, separable=False, additive_skips=False):
+    """
+    U-Net with one input per plane (DataSequence with plane_mode='inputs'): every plane goes
+    through a convolution block of its own, as the planes see the detector from different angles,
+    and the U-Net of make_unet takes their concatenation to predict the class map of the last plane.
+    """
+    filters = max(1, int(round(num_filters*width_multiplier)))
+    stems = [make_conv2d_block(input_tensor, num_filters=filters, kernel_size=3, batchnorm=batchnorm,
+                               separable=separable) for input_tensor in input_tensors]
+    outputs = make_unet(concatenate(stems, axis=3), num_classes, num_filters=num_filters, dropout=dropout,
+                        batchnorm=batchnorm, depth=depth, width_multiplier=width_multiplier, separable=separable,
+                        additive_skips=additive_skips)
+    return Model(inputs=list(input_tensors), outputs=[outputs])
 
-    u8 = Conv2DTranspose(num_filters*2, (3, 3), strides=(2, 2), padding='same') (c7)
-    u8 = concatenate([u8, c2])
-    u8 = Dropout(dropout)(u8)
-    c8 = make_conv2d_block(u8, num_filters=num_filters*2, kernel_size=3, batchnorm=batchnorm)
+def count_flops(model):
+    """
+    Floating point operations (a multiply-add counts as 2) of the convolutions, which dominate
+    the U-Net, for one image; the model needs a fixed input size, e.g. built for the image to count.
+    """
+    input_shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+    if any(None in shape[1:3] for shape in input_shapes):
+        raise ValueError("The model takes any image size; build it with a fixed one to count its operations.")
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, Conv2DTranspose):
+            # Every input pixel spreads over a kernel of output pixels
+            _, width, height, in_channels = layer.input_shape
+            flops += 2*width*height*layer.kernel_size[0]*layer.kernel_size[1]*in_channels*layer.filters
+        elif isinstance(layer, SeparableConv2D):
+            # A kernel per input channel, then a 1x1 convolution over the channels
+            channels = layer.input_shape[-1]*layer.depth_multiplier
+            pixels = layer.output_shape[1]*layer.output_shape[2]
+            flops += 2*pixels*channels*(layer.kernel_size[0]*layer.kernel_size[1] + layer.filters)
+        elif isinstance(layer, Conv2D):
+            pixels = layer.output_shape[1]*layer.output_shape[2]
+            flops += 2*pixels*layer.kernel_size[0]*layer.kernel_size[1]*layer.input_shape[-1]*layer.filters
+    return flops
 
-    u9 = Conv2DTranspose(num_filters*1, (3, 3), strides=(2, 2), padding='same') (c8)
-    u9 = concatenate([u9, c1], axis=3)
-    u9 = Dropout(dropout)(u9)
-    c9 = make_conv2d_block(u9, num_filters=num_filters*1, kernel_size=3, batchnorm=batchnorm)
+class DataWaitTimer(Callback):
+    """
+    Time the training loop spent blocked on the data loader, i.e. between the end of
+    one batch and the start of the next.
+    """
+    def on_train_begin(self, logs=None):
+        self.wait_times = []
 
-    outputs = Conv2D(num_classes, (1, 1), activation='softmax') (c9)
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.last_batch_end = self.epoch_start
+        self.epoch_wait = 0.0
 
-    model = Model(inputs=[input_tensor], outputs=[outputs])
-    return model
+    def on_batch_begin(self, batch, logs=None):
+        self.epoch_wait += time.time() - self.last_batch_end
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Up to the last training batch; validation is excluded
+        duration = self.last_batch_end - self.epoch_start
+        self.wait_times.append(self.epoch_wait)
+        print("Epoch {}: waited {:.1f} s on data ({:.1f}% of {:.1f} s training)".format(
+            epoch + 1, self.epoch_wait, 100.0*self.epoch_wait/max(duration, 1e-9), duration))
+
+def get_peak_rss():
+    """
+    Peak resident memory of this process in MB (ru_maxrss is in kB on Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def get_bottleneck(wait_seconds, step_seconds, threshold=0.2):
+    """
+    'I/O-bound' when the training loop waited on data for more than 'threshold' of its time.
+    """
+    wait_fraction = wait_seconds/max(wait_seconds + step_seconds, 1e-9)
+    return ("I/O-bound" if wait_fraction > threshold else "compute-bound"), wait_fraction
+
+class StepProfiler(DataWaitTimer):
+    """
+    DataWaitTimer that also records every training step: the time waited on the loader, the time
+    in the train step, samples/s, the time the Sequence spent making batches and the peak RSS.
+    Steps go to steps.csv in log_dir (and TensorBoard scalars with tensorboard=True), the epochs
+    and a verdict on whether the run was I/O-bound or compute-bound to summary.json.
+    """
+    def __init__(self, log_dir, sequence=None, tensorboard=False):
+        super(StepProfiler, self).__init__()
+        self.log_dir = log_dir
+        self.sequence = sequence
+        self.tensorboard = tensorboard
+
+    def get_load_seconds(self):
+        return self.sequence.load_seconds if self.sequence is not None else 0.0
+
+    def on_train_begin(self, logs=None):
+        super(StepProfiler, self).on_train_begin(logs)
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.csv_file = open(os.path.join(self.log_dir, "steps.csv"), "w", newline="")
+        self.writer = csv.writer(self.csv_file)
+        self.writer.writerow(["epoch", "step", "wait_s", "step_s", "samples", "samples_per_s", "load_s",
+                              "peak_rss_mb"])
+        self.summary_writer = None
+        if self.tensorboard:
+            import tensorflow as tf
+            self.summary_writer = tf.summary.FileWriter(self.log_dir)
+        self.global_step = 0
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        super(StepProfiler, self).on_epoch_begin(epoch, logs)
+        self.epoch = epoch
+        self.epoch_step = 0.0
+        self.epoch_samples = 0
+        self.epoch_load_start = self.get_load_seconds()
+        self.last_load = self.epoch_load_start
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.batch_wait = self.batch_start - self.last_batch_end
+        super(StepProfiler, self).on_batch_begin(batch, logs)
+
+    def on_batch_end(self, batch, logs=None):
+        super(StepProfiler, self).on_batch_end(batch, logs)
+        logs = logs if logs is not None else {}
+        step = self.last_batch_end - self.batch_start
+        samples = int(logs.get("size", 0))
+        load = self.get_load_seconds()
+        peak_rss = get_peak_rss()
+        self.epoch_step += step
+        self.epoch_samples += samples
+        self.writer.writerow([self.epoch + 1, batch, "{:.6f}".format(self.batch_wait), "{:.6f}".format(step),
+                              samples, "{:.3f}".format(samples/max(step, 1e-9)),
+                              "{:.6f}".format(load - self.last_load), "{:.1f}".format(peak_rss)])
+        self.last_load = load
+        if self.summary_writer is not None:
+            self.add_scalars({"profile/data_wait_s": self.batch_wait, "profile/step_s": step,
+                              "profile/samples_per_s": samples/max(step, 1e-9), "profile/peak_rss_mb": peak_rss})
+        self.global_step += 1
+
+    def add_scalars(self, scalars):
+        import tensorflow as tf
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)
+                                    for tag, value in scalars.items()])
+        self.summary_writer.add_summary(summary, self.global_step)
+
+    def on_epoch_end(self, epoch, logs=None):
+        super(StepProfiler, self).on_epoch_end(epoch, logs)
+        duration = self.last_batch_end - self.epoch_start
+        bottleneck, wait_fraction = get_bottleneck(self.epoch_wait, self.epoch_step)
+        self.epochs.append({"epoch": epoch + 1, "seconds": duration, "wait_s": self.epoch_wait,
+                            "step_s": self.epoch_step, "load_s": self.get_load_seconds() - self.epoch_load_start,
+                            "samples": self.epoch_samples, "samples_per_s": self.epoch_samples/max(duration, 1e-9),
+                            "wait_fraction": wait_fraction, "bottleneck": bottleneck,
+                            "peak_rss_mb": get_peak_rss()})
+        print("Epoch {}: {:.2f} samples/s, {:.1f} s in train steps, peak RSS {:.0f} MB, {}".format(
+            epoch + 1, self.epochs[-1]["samples_per_s"], self.epoch_step, get_peak_rss(), bottleneck))
+        self.csv_file.flush()
+        if self.summary_writer is not None:
+            self.summary_writer.flush()
+        self.save_summary()
+
+    def save_summary(self):
+        """
+        Epochs and totals so far, rewritten every epoch so that a killed job still leaves one.
+        """
+        wait = sum(epoch["wait_s"] for epoch in self.epochs)
+        step = sum(epoch["step_s"] for epoch in self.epochs)
+        seconds = sum(epoch["seconds"] for epoch in self.epochs)
+        samples = sum(epoch["samples"] for epoch in self.epochs)
+        bottleneck, wait_fraction = get_bottleneck(wait, step)
+        self.summary = {"epochs": self.epochs,
+                        "total": {"seconds": seconds, "wait_s": wait, "step_s": step,
+                                  "load_s": sum(epoch["load_s"] for epoch in self.epochs), "samples": samples,
+                                  "samples_per_s": samples/max(seconds, 1e-9), "wait_fraction": wait_fraction,
+                                  "bottleneck": bottleneck, "peak_rss_mb": get_peak_rss()}}
+        with open(os.path.join(self.log_dir, "summary.json"), "w") as f:
+            json.dump(self.summary, f, indent=4)
+
+    def on_train_end(self, logs=None):
+        self.csv_file.close()
+        if self.summary_writer is not None:
+            self.summary_writer.close()
+        if not self.epochs:
+            return
+        total = self.summary["total"]
+        print("\nProfile: {:.1f}% of {:.1f} s waiting on data, {:.2f} samples/s, peak RSS {:.0f} MB".format(
+            100.0*total["wait_fraction"], total["seconds"], total["samples_per_s"], total["peak_rss_mb"]))
+        if total["bottleneck"] == "I/O-bound":
+            print("The run was I/O-bound; try more WORKERS, LOADER = process or DATA_FORMAT = npy/sparse.")
+        else:
+            print("The run was compute-bound; the loader keeps up with the model.")
+        print("Steps and summary are saved in {}".format(self.log_dir))
+
+class ClassMetricsReport(Callback):
+    """
+    Per-class validation IoU, Dice, precision and recall from the confusion matrix that a
+    ConfusionMatrix metric accumulated during the validation pass, so no extra inference is run.
+    Adds 'val_iou_<class>' to the logs; keep it before the callbacks that monitor them.
+    """
+    def __init__(self, confusion_matrix, class_names):
+        super(ClassMetricsReport, self).__init__()
+        self.confusion_matrix = confusion_matrix
+        self.class_names = class_names
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        if "val_" + self.confusion_matrix.name not in logs:
+            return
+        metrics = class_metrics(K.get_value(self.confusion_matrix.matrix))
+        for c, class_name in enumerate(self.class_names):
+            logs["val_iou_{}".format(class_name)] = metrics["iou"][c]
+        print("Epoch {}: validation {}".format(epoch + 1, ", ".join(
+            "{} IoU {:.3f} Dice {:.3f} P {:.3f} R {:.3f}".format(class_name, metrics["iou"][c], metrics["dice"][c],
+                                                                 metrics["precision"][c], metrics["recall"][c])
+            for c, class_name in enumerate(self.class_names))))
+
+def train_model(model, X, y, model_path, num_epochs=1, workers=1, use_multiprocessing=False, max_queue_size=10,
+                monitor='val_loss', class_metrics_report=None, profiler=None, checkpoint_dir=None, keep_checkpoints=3,
+                resume=True, run_settings=None):
+    # Losses are minimized, anything else (accuracy, IoU) is maximized
+    mode = 'min' if monitor.endswith('loss') else 'max'
 
-def train_model(model, X, y, num_training, num_validation, model_path, num_epochs=1, batch_size=1):
     # Stop training when a monitored quantity has stopped improving after certain epochs
-    early_stop = EarlyStopping(monitor='val_loss', mode='min', patience=50, verbose=1)
+    early_stop = EarlyStopping(monitor=monitor, mode=mode, patience=50, verbose=1)
 
     # Reduce learning rate when a metric has stopped improving
-    reduce_lr = ReduceLROnPlateau(monitor='val_loss', mode='min', factor=0.25, patience=2, cooldown=0, verbose=1)
+    reduce_lr = ReduceLROnPlateau(monitor=monitor, mode=mode, factor=0.25, patience=2, cooldown=0, verbose=1)
+
+    # Report how long each epoch waited for batches, step by step with a StepProfiler
+    data_wait = profiler if profiler is not None else DataWaitTimer()
+
+    # The per-class report goes first so the others can monitor the values it adds to the logs
+    callbacks = [early_stop, reduce_lr, data_wait]
+    if class_metrics_report is not None:
+        callbacks.insert(0, class_metrics_report)
 
-    # Save the best model after every epoch
-    check_point = ModelCheckpoint(filepath=model_path, verbose=1, save_best_only=True, monitor='val_loss', mode='min')
+    # Full training state after every epoch, and the best model, written in the background; it goes
+    # last so that it restores the other callbacks after they reset and saves them after they update.
+    # The fingerprint of the model and run_settings keeps other runs from resuming its checkpoints
+    initial_epoch = 0
+    if checkpoint_dir:
+        checkpoint = TrainingCheckpoint(checkpoint_dir, monitor=monitor, mode=mode, keep=keep_checkpoints,
+                                        callbacks=[early_stop, reduce_lr], sequences=[X], resume=resume,
+                                        fingerprint=get_fingerprint(model, run_settings or {}), model_path=model_path)
+        callbacks.append(checkpoint)
+        initial_epoch = checkpoint.initial_epoch
+    else:
+        # Save the best model after every epoch
+        callbacks.insert(-1, ModelCheckpoint(filepath=model_path, verbose=1, save_best_only=True, monitor=monitor,
+                                             mode=mode))
 
+    # X and y are Sequences with random access, so the batches can be prepared by a pool of
+    # workers (threads or processes) into a bounded queue. X shuffles its events from its seed
+    # and the epoch, not the batch order here, so that a resumed training sees the same batches
     history = model.fit_generator(X,
-                                  steps_per_epoch = num_training//batch_size,
+                                  steps_per_epoch=len(X),
                                   epochs=num_epochs,
+                                  initial_epoch=initial_epoch,
                                   validation_data=y,
-                                  validation_steps= num_validation//batch_size,
+                                  validation_steps=len(y),
                                   verbose=2,
-                                  callbacks=[check_point, early_stop, reduce_lr],
+                                  callbacks=callbacks,
                                   shuffle=False,
-                                  use_multiprocessing=False,
-                                  workers=1)
+                                  use_multiprocessing=use_multiprocessing,
+                                  workers=workers,
+                                  max_queue_size=max_queue_size)
 
     return history
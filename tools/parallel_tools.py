@@ -0,0 +1,167 @@
+import os
+import time
+import binascii
+import numpy as np
+from keras import backend as K
+from multiprocessing.connection import Listener, Client
+
+def parse_address(address):
+    """
+    'host:port' -> (host, port)
+    """
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def get_authkey():
+    """
+    Shared secret of the replicas, from PARALLEL_AUTHKEY; the connections unpickle what they
+    receive, so there is no default that anyone on the network could know.
+    """
+    key = os.environ.get("PARALLEL_AUTHKEY")
+    if not key:
+        raise ValueError("PARALLEL_AUTHKEY should be set to the same secret for all replicas.")
+    return key.encode()
+
+def make_authkey():
+    """
+    A random PARALLEL_AUTHKEY, unless one is set, for replicas started from this process.
+    """
+    if not os.environ.get("PARALLEL_AUTHKEY"):
+        os.environ["PARALLEL_AUTHKEY"] = binascii.hexlify(os.urandom(16)).decode()
+
+def flatten_arrays(arrays):
+    """
+    One contiguous float32 array of all arrays, so that they go through a connection at once.
+    """
+    return np.concatenate([np.asarray(a, dtype=np.float32).ravel() for a in arrays])
+
+def unflatten_array(flat, like):
+    """
+    Split a flat array back into arrays of the shapes and types of 'like'.
+    """
+    arrays, start = [], 0
+    for a in like:
+        arrays.append(flat[start:start + a.size].reshape(a.shape).astype(a.dtype))
+        start += a.size
+    return arrays
+
+class ReplicaGroup(object):
+    """
+    Synchronous communication between the replicas of data-parallel training over
+    multiprocessing.connection: replica 0 listens on 'address' and reduces, the others connect
+    to it, on the same machine (localhost) or from other nodes. Arrays are sent as raw bytes.
+    """
+    def __init__(self, rank, num_replicas, address, timeout=300):
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.connections = []
+        self.listener = None
+        if num_replicas == 1:
+            return
+        if rank == 0:
+            self.listener = Listener(parse_address(address), authkey=get_authkey())
+            connections = {}
+            for _ in range(num_replicas - 1):
+                connection = self.listener.accept()
+                connections[connection.recv()] = connection
+            self.connections = [connections[r] for r in sorted(connections)]
+        else:
+            # Replica 0 may not be listening yet
+            start = time.time()
+            while True:
+                try:
+                    connection = Client(parse_address(address), authkey=get_authkey())
+                    break
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if time.time() - start > timeout:
+                        raise
+                    time.sleep(0.5)
+            connection.send(rank)
+            self.connections = [connection]
+
+    def allreduce_mean(self, array):
+        """
+        Mean of a float32 array over all replicas, returned to every replica.
+        """
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if self.num_replicas == 1:
+            return array
+        if self.rank == 0:
+            total = array.copy()
+            buffer = np.empty_like(array)
+            for connection in self.connections:
+                connection.recv_bytes_into(buffer)
+                total += buffer
+            total /= self.num_replicas
+            for connection in self.connections:
+                connection.send_bytes(total)
+            return total
+        self.connections[0].send_bytes(array)
+        result = np.empty_like(array)
+        self.connections[0].recv_bytes_into(result)
+        return result
+
+    def broadcast(self, array):
+        """
+        The float32 array of replica 0 on every replica.
+        """
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if self.num_replicas == 1:
+            return array
+        if self.rank == 0:
+            for connection in self.connections:
+                connection.send_bytes(array)
+            return array
+        result = np.empty_like(array)
+        self.connections[0].recv_bytes_into(result)
+        return result
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        if self.listener is not None:
+            self.listener.close()
+
+def make_step_functions(model, loss_function, optimizer, target_tensor, metric=None):
+    """
+    Two functions instead of one train step, so that the gradients can be averaged in between:
+    - compute_gradients([x, y]) -> [loss, metric] + gradients, which also runs the BatchNormalization updates,
+    - apply_gradients(gradients) updates the weights with the optimizer.
+    And evaluate([x, y]) -> [loss, metric] in the test phase. x is a list for a model with several inputs.
+    """
+    loss = K.mean(loss_function(target_tensor, model.output))
+    if model.losses:
+        loss += sum(model.losses)
+    metric = K.mean(metric(target_tensor, model.output)) if metric is not None else K.constant(0.0)
+    params = model.trainable_weights
+    gradients = K.gradients(loss, params)
+    inputs = model.inputs + [target_tensor]
+    compute = K.function(inputs + [K.learning_phase()], [loss, metric] + gradients, updates=model.updates)
+    evaluate = K.function(inputs + [K.learning_phase()], [loss, metric])
+
+    # The optimizer takes its gradients from placeholders fed with the averaged values
+    placeholders = [K.placeholder(shape=K.int_shape(p), dtype=K.dtype(p)) for p in params]
+    optimizer.get_gradients = lambda loss, params: placeholders
+    apply = K.function(placeholders, [], updates=optimizer.get_updates(loss=loss, params=params))
+
+    def get_inputs(data):
+        x, y = data
+        return (list(x) if isinstance(x, list) else [x]) + [y]
+
+    def compute_gradients(data):
+        return compute(get_inputs(data) + [1])
+
+    def evaluate_batch(data):
+        return evaluate(get_inputs(data) + [0])
+
+    return compute_gradients, apply, evaluate_batch
+
+def get_scaling_efficiency(throughputs):
+    """
+    Speed-up and efficiency of every worker count relative to the smallest, from samples/s:
+    efficiency = (throughput_n/throughput_1)/(n/1), 1.0 being perfect scaling.
+    """
+    counts = sorted(throughputs)
+    base_count = counts[0]
+    base = throughputs[base_count]
+    return [(n, throughputs[n], throughputs[n]/base, (throughputs[n]/base)/(float(n)/base_count)) for n in counts]
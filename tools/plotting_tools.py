@@ -1,6 +1,7 @@
 import matplotlib
 matplotlib.use('Agg')
 import numpy as np
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 
@@ -25,86 +26,177 @@ def plot_weights_median(weights, ranges, class_names, plot_name):
     fig.savefig(plot_name, bbox_inches='tight')
     plt.close(fig)
 
-def get_feature_image(feature_image, fig, ax, title):
-    """
-    Setup for feature image.
-    """
-    c = ax.imshow(feature_image, cmap='winter_r',interpolation='none', origin='lower',
-                  norm=LogNorm(vmin=1.0, vmax=abs(feature_image).max()))
-    fig.colorbar(c, ax=ax)
-    ax.set_xlabel("Global wire no.", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-    ax.set_ylabel("TDC", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-    ax.set_title(title, fontsize=20,fontname='DejaVu Sans',fontweight='bold')
-
-def get_label_image(label_image, class_names, fig, ax, title):
-    """
-    Setup for label image.
-    """
-    minimum = np.min(label_image)
-    maximum = np.max(label_image)
-    cmap = plt.get_cmap('gist_heat_r', maximum-minimum+1)
-    c= ax.imshow(label_image,cmap=cmap,interpolation='none', origin='lower',
-                   vmin=minimum, vmax=maximum)
-    cb = fig.colorbar(c, ax=ax)
-    cb.set_ticks([x for x in range(len(class_names))])
-    cb.set_ticklabels(class_names)
-
+def set_axes_labels(ax, title):
     ax.set_xlabel("Global wire no.", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
     ax.set_ylabel("TDC", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
     ax.set_title(title, fontsize=20,fontname='DejaVu Sans',fontweight='bold')
 
-def plot_feature_label(feature_image, label_image,
-                       feature_title, label_tile,
-                       class_names, plot_name):
+def set_image_data(image, data):
     """
-    Plot feature and label side by side.
+    Swap the data of an image, moving its extent along when the shape changes.
     """
-    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(20,7), facecolor='w')
-
-    get_feature_image(feature_image, fig, ax0, feature_title)
-    get_label_image(label_image, class_names, fig, ax1, label_tile)
-
-    fig.savefig(plot_name, bbox_inches='tight')
-    plt.close(fig)
+    if image.get_array().shape != data.shape:
+        rows, columns = data.shape
+        image.set_extent((-0.5, columns - 0.5, -0.5, rows - 0.5))
+    image.set_data(data)
 
-def plot_categories(feature_image, label_image, class_names, plot_name):
+class EventDisplays(object):
     """
-    Plot categories side by side.
+    The event display figures, made once and reused: drawing an event only swaps the image data
+    and the colour limits. Labels always span all classes, so colours match between events.
+    The output format follows the extension of plot_name (e.g. .pdf or .png at 'dpi').
     """
-    fig, axes = plt.subplots(1, len(class_names), figsize=(25,7), facecolor='w')
-    for index in range(len(class_names)):
-        ax = axes[index]
-        mask = (label_image == index)
-        c = ax.imshow(feature_image*mask, cmap='winter_r',interpolation='none', origin='lower',
-                  norm=LogNorm(vmin=1.0, vmax=np.max(feature_image)))
-        ax.set_xlabel("Global wire no.", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-        ax.set_ylabel("TDC", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-        ax.set_title(class_names[index], fontsize=20,fontname='DejaVu Sans',fontweight='bold')
-
-    fig.savefig(plot_name, bbox_inches='tight')
-    plt.close(fig)
-
-def plot_feature_label_prediction(feature_image, label_image, prediction_image,
-                                  feature_title, label_title, prediction_title,
-                                  class_names, plot_name):
+    def __init__(self, class_names, dpi=100):
+        self.class_names = class_names
+        self.dpi = dpi
+        self.figures = {}
+        self.bounding_boxes = {}
+
+    def get_label_image(self, fig, ax, title):
+        cmap = plt.get_cmap('gist_heat_r', len(self.class_names))
+        zeros = np.zeros((2, 2))
+        image = ax.imshow(zeros, cmap=cmap, interpolation='none', origin='lower',
+                          vmin=0, vmax=len(self.class_names) - 1)
+        cb = fig.colorbar(image, ax=ax)
+        cb.set_ticks([x for x in range(len(self.class_names))])
+        cb.set_ticklabels(self.class_names)
+        set_axes_labels(ax, title)
+        return image
+
+    def get_feature_image(self, fig, ax, title, vmin=1.0, vmax=2.0, colorbar=True):
+        image = ax.imshow(np.ones((2, 2)), cmap='winter_r', interpolation='none', origin='lower',
+                          norm=LogNorm(vmin=vmin, vmax=vmax))
+        if colorbar:
+            fig.colorbar(image, ax=ax)
+        set_axes_labels(ax, title)
+        return image
+
+    def get_figure(self, name):
+        if name in self.figures:
+            return self.figures[name]
+        if name == "feature_label":
+            fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(20,7), facecolor='w')
+            images = [self.get_feature_image(fig, ax0, 'Feature'), self.get_label_image(fig, ax1, 'Label')]
+        elif name == "categories":
+            fig, axes = plt.subplots(1, len(self.class_names), figsize=(25,7), facecolor='w')
+            images = [self.get_feature_image(fig, ax, class_name, colorbar=False)
+                      for ax, class_name in zip(axes, self.class_names)]
+        elif name == "feature_label_prediction":
+            fig, (ax0, ax1, ax2) = plt.subplots(1, 3, figsize=(20,5), facecolor='w')
+            # Featured is scaled to be between 0 and 1
+            images = [self.get_feature_image(fig, ax0, 'Feature', vmin=1E-3, vmax=1.0),
+                      self.get_label_image(fig, ax1, 'Label'),
+                      self.get_label_image(fig, ax2, 'Model prediction')]
+        else:
+            raise ValueError("Unknown event display '{}'.".format(name))
+        self.figures[name] = (fig, images)
+        return self.figures[name]
+
+    def save(self, name, plot_name):
+        """
+        The layout doesn't change between events, so the tight bounding box is only found once
+        (it costs an extra draw); the padding leaves room for wider colorbar tick labels.
+        """
+        fig, _ = self.figures[name]
+        if name not in self.bounding_boxes:
+            self.bounding_boxes[name] = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.2)
+        fig.savefig(plot_name, bbox_inches=self.bounding_boxes[name], dpi=self.dpi)
+
+    def feature_label(self, feature_image, label_image, plot_name):
+        """
+        Feature and label side by side.
+        """
+        _, (feature, label) = self.get_figure("feature_label")
+        set_image_data(feature, feature_image)
+        feature.set_clim(1.0, max(abs(feature_image).max(), 1.0 + 1e-6))
+        set_image_data(label, label_image)
+        self.save("feature_label", plot_name)
+
+    def categories(self, feature_image, label_image, plot_name):
+        """
+        The hits of each class side by side.
+        """
+        _, images = self.get_figure("categories")
+        vmax = max(np.max(feature_image), 1.0 + 1e-6)
+        for index, image in enumerate(images):
+            set_image_data(image, feature_image*(label_image == index))
+            image.set_clim(1.0, vmax)
+        self.save("categories", plot_name)
+
+    def feature_label_prediction(self, feature_image, label_image, prediction_image, plot_name):
+        """
+        Feature, label, and prediction side by side.
+        """
+        _, (feature, label, prediction) = self.get_figure("feature_label_prediction")
+        set_image_data(feature, feature_image)
+        set_image_data(label, label_image)
+        set_image_data(prediction, prediction_image)
+        self.save("feature_label_prediction", plot_name)
+
+# Figures of the current worker process
+worker_displays = None
+
+def init_render_worker(class_names, dpi):
+    global worker_displays
+    worker_displays = EventDisplays(class_names, dpi)
+
+def render_event(task):
+    name, args = task
+    getattr(worker_displays, name)(*args)
+
+class EventRenderer(object):
     """
-    Plot feature, label, and prediction side by side.
+    Draws event displays in a pool of worker processes, each with its own reused EventDisplays;
+    with a single worker they are drawn in this process. At most 'max_pending' events are in flight,
+    so memory stays bounded however many events are rendered.
     """
-    fig, (ax0, ax1, ax2) = plt.subplots(1, 3, figsize=(20,5), facecolor='w')
-
-    # Featured is scaled to be between 0 and 1
-    c = ax0.imshow(feature_image, cmap='winter_r',interpolation='none', origin='lower',
-                   norm=LogNorm(vmin=1E-3, vmax=1.0))
-    fig.colorbar(c, ax=ax0)
-    ax0.set_xlabel("Global wire no.", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-    ax0.set_ylabel("TDC", fontsize=15, fontname='DejaVu Sans',fontweight='bold')
-    ax0.set_title(feature_title, fontsize=20,fontname='DejaVu Sans',fontweight='bold')
-
-    get_label_image(label_image, class_names, fig, ax1, label_title)
-    get_label_image(prediction_image, class_names, fig, ax2, prediction_title)
-
-    fig.savefig(plot_name, bbox_inches='tight')
-    plt.close(fig)
+    def __init__(self, class_names, workers=1, dpi=100, max_pending=None):
+        self.workers = workers
+        self.max_pending = max_pending or 4*workers
+        self.pending = []
+        if workers > 1:
+            self.pool = Pool(workers, initializer=init_render_worker, initargs=(class_names, dpi))
+        else:
+            self.pool = None
+            self.displays = EventDisplays(class_names, dpi)
+
+    def submit(self, name, *args):
+        """
+        Draw the event display 'name' (an EventDisplays method) with args.
+        """
+        if self.pool is None:
+            getattr(self.displays, name)(*args)
+            return
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).get()
+        self.pending.append(self.pool.apply_async(render_event, ((name, args),)))
+
+    def close(self):
+        """
+        Wait for every display to be saved; errors of the workers are raised here.
+        """
+        if self.pool is None:
+            for fig, _ in self.displays.figures.values():
+                plt.close(fig)
+            return
+        try:
+            for result in self.pending:
+                result.get()
+        finally:
+            self.pending = []
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None and self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            return False
+        self.close()
+        return False
 
 def plot_history(history, quantity, plot_title, y_label, plot_name):
     fig, axes = plt.subplots(1, 1, figsize=(15,10), facecolor='w')
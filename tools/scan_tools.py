@@ -0,0 +1,84 @@
+import os
+import numpy as np
+from multiprocessing import Pool
+from tools.csv_tools import CSVEventReader
+from tools.store_tools import EventStore, SparseEventStore, get_store_file, get_hits_store
+
+CHUNK_SIZE = 256
+
+def get_feature_source(feature_file, data_format):
+    """
+    The file that holds the ADC values for a data format; its size and mtime key the caches.
+    """
+    if data_format == "csv":
+        return feature_file
+    elif data_format == "npy":
+        return get_store_file(feature_file)
+    elif data_format == "sparse":
+        return os.path.join(get_hits_store(feature_file), "adc.npy")
+    raise ValueError("Unknown data format '{}'; should be 'csv', 'npy' or 'sparse'.".format(data_format))
+
+def get_label_source(feature_file, label_file, data_format):
+    """
+    The file that holds the labels for a data format; its size and mtime key the caches.
+    """
+    if data_format == "csv":
+        return label_file
+    elif data_format == "npy":
+        return get_store_file(label_file)
+    elif data_format == "sparse":
+        return os.path.join(get_hits_store(feature_file), "label.npy")
+    raise ValueError("Unknown data format '{}'; should be 'csv', 'npy' or 'sparse'.".format(data_format))
+
+def get_num_events(feature_file, label_file, data_format):
+    if data_format == "csv":
+        return len(CSVEventReader(feature_file, label_file))
+    elif data_format == "npy":
+        return len(EventStore(feature_file, label_file))
+    return len(SparseEventStore(feature_file, label_file))
+
+def scan_in_chunks(scan_chunk, num_events, arguments, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Results of scan_chunk((start, stop) + arguments) for the chunks of chunk_size events of a file,
+    split across a process pool; scan_chunk is a module-level function so that it can be pickled.
+    """
+    tasks = [(start, min(start + chunk_size, num_events)) + tuple(arguments)
+             for start in range(0, num_events, chunk_size)]
+    if workers > 1 and len(tasks) > 1:
+        with Pool(min(workers, len(tasks))) as pool:
+            return pool.map(scan_chunk, tasks)
+    return [scan_chunk(task) for task in tasks]
+
+def get_source_key(sources):
+    """
+    Size and mtime of every source file, so that a cache is rebuilt whenever one of them changes.
+    """
+    key = []
+    for source in sources:
+        stat = os.stat(source)
+        key += [stat.st_size, stat.st_mtime_ns]
+    return key
+
+def load_cached_arrays(cache_file, key, sources, names):
+    """
+    The arrays 'names' of a .npz cache saved with the same key and sources; None otherwise.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            if list(cache["key"]) == list(key) and list(cache["sources"]) == list(sources):
+                return {name: cache[name] for name in names}
+    except (OSError, ValueError, KeyError):
+        print("Cache {} couldn't be read, will rescan!".format(cache_file))
+    return None
+
+def save_cached_arrays(cache_file, key, sources, arrays):
+    # Replicas of train_parallel.py may scan the same file at once
+    temp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(temp_file, "wb") as f:
+            np.savez(f, key=np.array(key, dtype=np.int64), sources=np.array(sources), **arrays)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        print("Cache {} couldn't be written!".format(cache_file))
@@ -0,0 +1,265 @@
+import os
+import numpy as np
+from tools.csv_tools import get_row_offsets, iterate_row_blocks, parse_rows
+
+FEATURE_DTYPE = np.float32
+LABEL_DTYPE = np.uint8
+# Induction (U, V) and collection (W) planes, written by RootToCSV as feature_u/v/w.csv and label_u/v/w.csv
+PLANES = ["u", "v", "w"]
+
+def cast_adc(adc, dtype):
+    """
+    ADC values in the store dtype; integer types (e.g. uint16) are rounded and clipped to their range.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        adc = np.clip(np.rint(adc), info.min, info.max)
+    return np.asarray(adc).astype(dtype, copy=False)
+
+def get_plane_file(file_name, plane):
+    """
+    The same file for another plane; e.g. feature_w.csv -> feature_u.csv
+    """
+    root, extension = os.path.splitext(file_name)
+    if plane not in PLANES:
+        raise ValueError("Unknown plane '{}'; should be one of {}.".format(plane, ", ".join(PLANES)))
+    if len(root) < 2 or root[-2] != "_" or root[-1] not in PLANES:
+        raise ValueError("{} isn't the file of a plane; its name should end with _u, _v or _w.".format(file_name))
+    return root[:-1] + plane + extension
+
+def get_store_file(csv_file):
+    """
+    Binary store that sits next to the csv file; e.g. feature_w.csv -> feature_w.npy
+    """
+    return os.path.splitext(csv_file)[0] + ".npy"
+
+def convert_csv_to_store(csv_file, store_file, dtype):
+    """
+    Convert a csv file into an (events, pixels) .npy array.
+    Blocks of rows are parsed and written one at a time through a memory map,
+    so the conversion never holds more than a block in memory.
+    """
+    num_events = len(get_row_offsets(csv_file)) - 1
+    temp_file = store_file + ".tmp"
+    blocks = iterate_row_blocks(csv_file)
+    num_pixels = next(blocks)
+    store = np.lib.format.open_memmap(temp_file, mode="w+", dtype=dtype,
+                                      shape=(num_events, num_pixels))
+    start = 0
+    for block in blocks:
+        rows = parse_rows(block, np.float32, num_pixels)
+        store[start:start + len(rows)] = cast_adc(rows, dtype)
+        start += len(rows)
+        store.flush()
+    del store
+    # Only replace the store once it is complete
+    os.replace(temp_file, store_file)
+    return num_events
+
+def convert_to_store(feature_file, label_file, adc_dtype=FEATURE_DTYPE):
+    """
+    Convert a feature/label csv pair into binary stores, with the ADC values saved as adc_dtype;
+    returns the store paths.
+    """
+    feature_store = get_store_file(feature_file)
+    label_store = get_store_file(label_file)
+    num_features = convert_csv_to_store(feature_file, feature_store, adc_dtype)
+    num_labels = convert_csv_to_store(label_file, label_store, LABEL_DTYPE)
+    if num_features != num_labels:
+        raise ValueError("{} has {} events but {} has {}.".format(feature_file, num_features,
+                                                                  label_file, num_labels))
+    return feature_store, label_store
+
+def open_store(store_file):
+    """
+    Memory map a binary store; slicing rows returns views without copying.
+    """
+    return np.load(store_file, mmap_mode="r")
+
+class EventStore(object):
+    """
+    Random access to the events of a feature/label store pair.
+    The memory maps are opened lazily in every process, and are not pickled,
+    so that the object can be handed to loader processes.
+    """
+    def __init__(self, feature_file, label_file):
+        self.feature_file = get_store_file(feature_file)
+        self.label_file = get_store_file(label_file)
+        self.features = None
+        self.labels = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(features=None, labels=None, pid=None)
+        return state
+
+    def open(self):
+        if self.features is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.features = open_store(self.feature_file)
+            self.labels = open_store(self.label_file)
+            if len(self.features) != len(self.labels):
+                raise ValueError("{} and {} have different number of events.".format(self.feature_file,
+                                                                                   self.label_file))
+
+    def __len__(self):
+        self.open()
+        return len(self.features)
+
+    def read(self, start, stop):
+        """
+        Events [start, stop) as (features, labels) views into the memory maps.
+        """
+        self.open()
+        return self.features[start:stop], self.labels[start:stop]
+
+    def read_events(self, indices):
+        """
+        Events at 'indices'; a contiguous run of events is returned as views (no copy).
+        """
+        indices = np.asarray(indices)
+        if len(indices) and np.all(np.diff(indices) == 1):
+            return self.read(indices[0], indices[-1] + 1)
+        self.open()
+        return self.features[indices], self.labels[indices]
+
+HITS_FILES = ["offsets", "wire", "tdc", "adc", "label"]
+
+def get_hits_store(feature_file):
+    """
+    Sparse store (a directory) for a feature file; e.g. feature_w.csv -> hits_w
+    """
+    directory, name = os.path.split(os.path.splitext(feature_file)[0])
+    if name.startswith("feature"):
+        name = "hits" + name[len("feature"):]
+    else:
+        name = name + "_hits"
+    return os.path.join(directory, name)
+
+def save_hits_store(store_dir, offsets, wire, tdc, adc, label, image_shape, adc_dtype=FEATURE_DTYPE):
+    """
+    Save hits as (wire, tdc, adc, label) columns; hits of event i are offsets[i]:offsets[i + 1].
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(store_dir, "wire.npy"), np.asarray(wire, dtype=np.uint16))
+    np.save(os.path.join(store_dir, "tdc.npy"), np.asarray(tdc, dtype=np.uint16))
+    np.save(os.path.join(store_dir, "adc.npy"), cast_adc(adc, adc_dtype))
+    np.save(os.path.join(store_dir, "label.npy"), np.asarray(label, dtype=LABEL_DTYPE))
+    np.save(os.path.join(store_dir, "shape.npy"), np.asarray(image_shape, dtype=np.int64))
+
+def convert_events_to_hits(reader, store_dir, image_width, image_height, adc_dtype=FEATURE_DTYPE):
+    """
+    Keep only the non-zero pixels of every event of a dense reader (csv or npy).
+    """
+    num_events = len(reader)
+    offsets = np.zeros(num_events + 1, dtype=np.int64)
+    pixels, adcs, labels = [], [], []
+    for index in range(num_events):
+        features, label = reader.read_events([index])
+        hits = np.flatnonzero((features[0] != 0) | (label[0] != 0))
+        pixels.append(hits)
+        adcs.append(features[0][hits])
+        labels.append(label[0][hits])
+        offsets[index + 1] = offsets[index] + len(hits)
+
+    pixels = np.concatenate(pixels) if num_events else np.zeros(0, dtype=np.int64)
+    tdc, wire = np.divmod(pixels, image_height)
+    save_hits_store(store_dir, offsets, wire, tdc,
+                    np.concatenate(adcs) if num_events else [],
+                    np.concatenate(labels) if num_events else [],
+                    (image_width, image_height), adc_dtype)
+    return num_events
+
+def convert_hits_csv(hits_file, store_dir, image_width, image_height, adc_dtype=FEATURE_DTYPE, num_events=None):
+    """
+    Convert the Event,Wire,TDC,ADC,Label csv written by RootToCSV in sparse mode, parsed in blocks
+    into columns of the store dtypes. Events without hits aren't in the file, so give num_events
+    (e.g. the rows of the dense csv) to keep the ones at the end; otherwise the last event with
+    hits is the last event.
+    """
+    blocks = iterate_row_blocks(hits_file)
+    num_columns = next(blocks)
+    if num_columns != 5:
+        raise ValueError("{} should have the 5 columns Event,Wire,TDC,ADC,Label.".format(hits_file))
+    columns = [[], [], [], [], []]
+    for block in blocks:
+        hits = parse_rows(block, np.float64, num_columns)
+        for column, dtype, values in zip(columns, [np.int64, np.uint16, np.uint16, None, LABEL_DTYPE], hits.T):
+            column.append(cast_adc(values, adc_dtype) if dtype is None else values.astype(dtype))
+    events, wire, tdc, adc, label = [np.concatenate(column) if column else np.zeros(0, dtype=np.int64)
+                                     for column in columns]
+
+    last_event = int(events.max()) + 1 if len(events) else 0
+    if num_events is None:
+        num_events = last_event
+    elif last_event > num_events:
+        raise ValueError("{} has hits of event {}, but there are only {} events.".format(
+            hits_file, last_event - 1, num_events))
+    if np.any(np.diff(events) < 0):
+        order = np.argsort(events, kind="mergesort")
+        events, wire, tdc, adc, label = [column[order] for column in [events, wire, tdc, adc, label]]
+    offsets = np.searchsorted(events, np.arange(num_events + 1))
+    save_hits_store(store_dir, offsets, wire, tdc, adc, label, (image_width, image_height), adc_dtype)
+    return num_events
+
+class SparseEventStore(object):
+    """
+    Random access to events saved as hit lists; a batch is densified with one scatter.
+    Like EventStore the memory maps are opened lazily in every process and not pickled.
+    """
+    def __init__(self, feature_file, label_file):
+        self.store_dir = get_hits_store(feature_file)
+        self.arrays = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(arrays=None, pid=None)
+        return state
+
+    def open(self):
+        if self.arrays is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.arrays = {name: open_store(os.path.join(self.store_dir, name + ".npy"))
+                           for name in HITS_FILES}
+            self.image_shape = tuple(np.load(os.path.join(self.store_dir, "shape.npy")))
+
+    def __len__(self):
+        self.open()
+        return len(self.arrays["offsets"]) - 1
+
+    def read_hits(self, index):
+        """
+        Hits of one event as (wire, tdc, adc, label) views.
+        """
+        self.open()
+        start, stop = self.arrays["offsets"][index:index + 2]
+        return tuple(self.arrays[name][start:stop] for name in ["wire", "tdc", "adc", "label"])
+
+    def read_events(self, indices):
+        """
+        Events at 'indices' as dense (features, labels) arrays of shape (events, pixels);
+        features keep the dtype of the stored ADC values.
+        """
+        self.open()
+        indices = np.asarray(indices, dtype=np.int64)
+        offsets = self.arrays["offsets"]
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+
+        # Position of every hit of the batch in the store, and the event it belongs to
+        event = np.repeat(np.arange(len(indices)), lengths)
+        hits = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) \
+               + np.repeat(starts, lengths)
+        pixel = self.arrays["tdc"][hits].astype(np.int64)*self.image_shape[1] + self.arrays["wire"][hits]
+
+        num_pixels = self.image_shape[0]*self.image_shape[1]
+        features = np.zeros((len(indices), num_pixels), dtype=self.arrays["adc"].dtype)
+        labels = np.zeros((len(indices), num_pixels), dtype=LABEL_DTYPE)
+        features[event, pixel] = self.arrays["adc"][hits]
+        labels[event, pixel] = self.arrays["label"][hits]
+        return features, labels
@@ -0,0 +1,127 @@
+import json
+import itertools
+import numpy as np
+from keras.optimizers import SGD, Adam, RMSprop
+from tools.loss_metrics_tools import sparse_focal_loss, sparse_weighted_focal_loss
+from tools.loss_metrics_tools import sparse_weighted_categorical_crossentropy
+
+OPTIMIZERS = {"SGD": SGD, "Adam": Adam, "RMSprop": RMSprop}
+LOSSES = ["focal", "weighted_focal", "weighted_crossentropy"]
+# The architecture knobs may be left out of the search space; they take the configured values
+MODEL_PARAMETERS = ["depth", "width_multiplier", "separable", "additive_skips"]
+PARAMETERS = ["optimizer", "lr", "num_filters", "dropout", "loss", "batch_size"] + MODEL_PARAMETERS
+
+def get_optimizer(name, lr):
+    if name not in OPTIMIZERS:
+        raise ValueError("Unknown optimizer '{}'; should be one of {}.".format(name, ", ".join(OPTIMIZERS)))
+    return OPTIMIZERS[name](lr=lr)
+
+def get_loss(name, weights):
+    """
+    The losses of train_model.py by name; the weighted ones take the median frequency weights.
+    """
+    if name == "focal":
+        return sparse_focal_loss()
+    elif name == "weighted_focal":
+        return sparse_weighted_focal_loss(weights)
+    elif name == "weighted_crossentropy":
+        return sparse_weighted_categorical_crossentropy(weights)
+    raise ValueError("Unknown loss '{}'; should be one of {}.".format(name, ", ".join(LOSSES)))
+
+def load_search_space(space_file, defaults=None):
+    """
+    A JSON object with a list of values for every parameter, e.g. {"lr": [1e-5, 1e-4], ...};
+    parameters missing from it take their value in 'defaults'.
+    """
+    with open(space_file, "r") as f:
+        space = json.load(f)
+    for name, value in (defaults or {}).items():
+        space.setdefault(name, [value])
+    missing = [name for name in PARAMETERS if name not in space]
+    if missing:
+        raise ValueError("The search space has no values for {}.".format(", ".join(missing)))
+    return space
+
+def sample_configurations(space, num_configurations, seed=0):
+    """
+    num_configurations distinct configurations drawn from the grid of the search space
+    (all of them when the grid is smaller).
+    """
+    grid = list(itertools.product(*[space[name] for name in PARAMETERS]))
+    rng = np.random.RandomState(seed)
+    chosen = rng.choice(len(grid), size=min(num_configurations, len(grid)), replace=False)
+    return [dict(zip(PARAMETERS, grid[i])) for i in sorted(chosen)]
+
+def get_rung_epochs(min_epochs, max_epochs, eta):
+    """
+    Epochs trained by the end of every rung of successive halving: min_epochs, min_epochs*eta, ...
+    up to max_epochs.
+    """
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1]*eta, max_epochs))
+    return epochs
+
+def is_better(value, other, mode):
+    return value < other if mode == "min" else value > other
+
+def get_best(values, mode):
+    values = [v for v in values if v is not None and np.isfinite(v)]
+    if not values:
+        return None
+    return min(values) if mode == "min" else max(values)
+
+def select_survivors(trials, monitor, mode, eta):
+    """
+    The best 1/eta of the trials (at least one) by the best value of 'monitor' so far;
+    trials that never gave a finite value are dropped first.
+    """
+    def key(trial):
+        best = get_best([epoch.get(monitor) for epoch in trial["history"]], mode)
+        if best is None:
+            return np.inf
+        return best if mode == "min" else -best
+
+    ranked = sorted(trials, key=key)
+    return ranked[:max(1, len(trials)//eta)]
+
+def get_time_to_quality(history, monitor, target, mode):
+    """
+    Training seconds until 'monitor' first reached 'target', None if it never did.
+    """
+    for epoch in history:
+        value = epoch.get(monitor)
+        if value is not None and (value == target or is_better(value, target, mode)):
+            return epoch["seconds"]
+    return None
+
+def rank_trials(trials, monitor, mode, target):
+    """
+    Rows of the results table, best first: the trials that lasted longer come first, as they
+    survived more rungs, then the better values of 'monitor'.
+    """
+    rows = []
+    for trial in trials:
+        history = trial["history"]
+        best = get_best([epoch.get(monitor) for epoch in history], mode)
+        rows.append(dict(trial["params"], trial=trial["trial"], epochs=len(history), best=best,
+                         seconds=history[-1]["seconds"] if history else 0.0,
+                         time_to_quality=get_time_to_quality(history, monitor, target, mode)))
+    sign = 1 if mode == "min" else -1
+    rows.sort(key=lambda row: (-row["epochs"], sign*row["best"] if row["best"] is not None else np.inf))
+    return rows
+
+def print_results_table(rows, monitor, target):
+    print("\nTarget {} of {:.4g}".format(monitor, target))
+    header = "{:>4s} {:>5s} {:>8s} {:>8s} {:>7s} {:>7s} {:>22s} {:>5s} {:>16s} {:>6s} {:>10s} {:>9s} {:>15s}".format(
+        "Rank", "Trial", "Optim.", "LR", "Filters", "Dropout", "Loss", "Batch", "Model", "Epochs", "Best",
+        "Time (s)", "To target (s)")
+    print(header)
+    print("-"*len(header))
+    for rank, row in enumerate(rows):
+        model = "d{} x{:g}{}{}".format(row["depth"], row["width_multiplier"], " sep" if row["separable"] else "",
+                                      " add" if row["additive_skips"] else "")
+        print("{:4d} {:5d} {:>8s} {:8.1e} {:7d} {:7.2f} {:>22s} {:5d} {:>16s} {:6d} {:10.4g} {:9.1f} {:>15s}".format(
+            rank + 1, row["trial"], row["optimizer"], row["lr"], row["num_filters"], row["dropout"], row["loss"],
+            row["batch_size"], model, row["epochs"], row["best"] if row["best"] is not None else float("nan"),
+            row["seconds"], "{:.1f}".format(row["time_to_quality"]) if row["time_to_quality"] is not None else "-"))
@@ -0,0 +1,67 @@
+import threading
+from queue import Queue
+
+def iterate_in_thread(iterable, max_size=2):
+    """
+    Items of iterable, produced ahead by a background thread into a queue of max_size,
+    so e.g. reading the next batch overlaps with predicting the current one.
+    Exceptions of the thread are raised in the consumer.
+    """
+    queue = Queue(max_size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+            queue.put((done, None))
+        except Exception as exception:
+            queue.put((done, exception))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item, exception = queue.get()
+        if exception is not None:
+            raise exception
+        if item is done:
+            break
+        yield item
+    thread.join()
+
+class ThreadedWriter(object):
+    """
+    Calls write(*args) for every put() in a background thread, with at most max_size pending,
+    so writing the results of one batch overlaps with predicting the next.
+    Exceptions of the thread are raised by the next put() or by close().
+    """
+    def __init__(self, write, max_size=2):
+        self.write = write
+        self.queue = Queue(max_size)
+        self.exception = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                break
+            if self.exception is None:
+                try:
+                    self.write(*args)
+                except Exception as exception:
+                    self.exception = exception
+
+    def check(self):
+        if self.exception is not None:
+            raise self.exception
+
+    def put(self, *args):
+        self.check()
+        self.queue.put(args)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
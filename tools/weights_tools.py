@@ -0,0 +1,53 @@
+import os
+import json
+import numpy as np
+from tools.index_tools import get_event_index
+
+def get_class_counts(feature_file, label_file, data_format, image_shape, num_classes, workers=1):
+    """
+    (events, num_classes) pixel counts of a file, from the event statistics index that the sampler
+    also uses; it is cached next to the file, so adding a file to the weights only scans that file.
+    """
+    return get_event_index(feature_file, label_file, data_format, image_shape, num_classes, workers)["counts"]
+
+def get_event_weights(counts):
+    """
+    Weight of every class in every event, relative to the minority class of the event:
+    for 3 classes with classA:10%, classB:50% and classC:40%, weights will be: [1, 0.2, 0.25].
+    Classes that are absent from an event get nan.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    present = counts > 0
+    minority = np.min(np.where(present, counts, np.inf), axis=1, keepdims=True)
+    weights = np.full(counts.shape, np.nan)
+    np.divide(minority, counts, out=weights, where=present)
+    return weights
+
+def get_median_weights(event_weights):
+    """
+    Median over events of the weight of each class; 1.0 for a class that never appears.
+    """
+    medians = []
+    for c in range(event_weights.shape[1]):
+        weights = event_weights[:, c]
+        weights = weights[~np.isnan(weights)]
+        medians.append(float(np.median(weights)) if len(weights) else 1.0)
+    return medians
+
+def save_class_weights(weights_file, class_names, weights, files, num_events):
+    directory = os.path.dirname(weights_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(weights_file, "w") as f:
+        json.dump({"class_names": class_names, "weights": weights, "files": files, "num_events": num_events},
+                  f, indent=4)
+
+def load_class_weights(weights_file, class_names):
+    """
+    Weights written by calculate_weights.py, in the order of class_names.
+    """
+    with open(weights_file, "r") as f:
+        saved = json.load(f)
+    if saved["class_names"] != list(class_names):
+        raise ValueError("{} has weights for {}, not {}.".format(weights_file, saved["class_names"], class_names))
+    return np.array(saved["weights"], dtype=np.float64)
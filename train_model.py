@@ -1,14 +1,21 @@
 import os
 import sys
+import time
 import argparse
 import numpy as np
 import configparser
+from keras import backend as K
 from keras.layers import Input
 from keras.optimizers import Adam, SGD
-from tools.data_tools import DataSequence
+from tools.data_tools import DataSequence, PLANE_MODES
+from tools.store_tools import PLANES as ALL_PLANES, get_plane_file
+from tools.weights_tools import load_class_weights
+from tools.index_tools import get_event_index, EventSampler
 from tools.plotting_tools import plot_history
-from tools.model_tools import get_unet_model, train_model
-from tools.loss_metrics_tools import weighted_categorical_crossentropy, focal_loss, weighted_focal_loss
+from tools.model_tools import get_unet_model, get_multiplane_unet_model, train_model, set_float_dtype, ClassMetricsReport
+from tools.model_tools import StepProfiler, count_flops
+from tools.loss_metrics_tools import sparse_weighted_categorical_crossentropy, sparse_focal_loss, sparse_weighted_focal_loss
+from tools.loss_metrics_tools import sparse_accuracy, ConfusionMatrix
 
 # Needed when using single GPU with sbatch; else will get the following error
 # failed call to cuInit: CUDA_ERROR_NO_DEVICE
@@ -60,12 +67,46 @@ def main():
     IMAGE_WIDTH = int(config["DEFAULT"]["IMAGE_WIDTH"])
     IMAGE_HEIGHT = int(config["DEFAULT"]["IMAGE_HEIGHT"])
     IMAGE_DEPTH = int(config["DEFAULT"]["IMAGE_DEPTH"])
+    PLANES = config["DEFAULT"]["PLANES"].split()
+    PLANE_MODE = config["DEFAULT"]["PLANE_MODE"]
     CLASS_NAMES = config["DEFAULT"]["CLASS_NAMES"].split()
     FEATURE_FILE_TRAINING = config["DEFAULT"]["FEATURE_FILE_TRAINING"]
     LABEL_FILE_TRAINING = config["DEFAULT"]["LABEL_FILE_TRAINING"]
     FEATURE_FILE_VALIDATION = config["DEFAULT"]["FEATURE_FILE_VALIDATION"]
     LABEL_FILE_VALIDATION = config["DEFAULT"]["LABEL_FILE_VALIDATION"]
     WEIGHTS = np.array(list(map(float, config["DEFAULT"]["WEIGHTS"].split())))
+    WEIGHTS_FILE = config["DEFAULT"]["WEIGHTS_FILE"]
+    if os.path.isfile(WEIGHTS_FILE):
+        WEIGHTS = load_class_weights(WEIGHTS_FILE, CLASS_NAMES)
+    DATA_FORMAT = config["DEFAULT"]["DATA_FORMAT"]
+    FLOAT_DTYPE = config["DEFAULT"]["FLOAT_DTYPE"]
+    SHUFFLE = config["DEFAULT"].getboolean("SHUFFLE")
+    PATCH_SIZE = int(config["DEFAULT"]["PATCH_SIZE"])
+    PATCHES_PER_EVENT = int(config["DEFAULT"]["PATCHES_PER_EVENT"])
+    EMPTY_PATCH_RATIO = float(config["DEFAULT"]["EMPTY_PATCH_RATIO"])
+    NUM_FILTERS = int(config["DEFAULT"]["NUM_FILTERS"])
+    DEPTH = int(config["DEFAULT"]["DEPTH"])
+    WIDTH_MULTIPLIER = float(config["DEFAULT"]["WIDTH_MULTIPLIER"])
+    SEPARABLE = config["DEFAULT"].getboolean("SEPARABLE")
+    ADDITIVE_SKIPS = config["DEFAULT"].getboolean("ADDITIVE_SKIPS")
+    DROPOUT = float(config["DEFAULT"]["DROPOUT"])
+    LOADER = config["DEFAULT"]["LOADER"]
+    WORKERS = int(config["DEFAULT"]["WORKERS"])
+    MAX_QUEUE_SIZE = int(config["DEFAULT"]["MAX_QUEUE_SIZE"])
+    CACHE_MEMORY_MB = int(config["DEFAULT"]["CACHE_MEMORY_MB"])
+    CACHE_DIR = config["DEFAULT"]["CACHE_DIR"]
+    SAMPLER = config["DEFAULT"].getboolean("SAMPLER")
+    SAMPLER_MIN_HITS = int(config["DEFAULT"]["SAMPLER_MIN_HITS"])
+    SAMPLER_RICH_CLASS = config["DEFAULT"]["SAMPLER_RICH_CLASS"]
+    SAMPLER_RICH_PIXELS = int(config["DEFAULT"]["SAMPLER_RICH_PIXELS"])
+    SAMPLER_OVERSAMPLE = float(config["DEFAULT"]["SAMPLER_OVERSAMPLE"])
+    MONITOR = config["DEFAULT"]["MONITOR"]
+    CHECKPOINT_DIR = config["DEFAULT"]["CHECKPOINT_DIR"]
+    CHECKPOINT_KEEP = int(config["DEFAULT"]["CHECKPOINT_KEEP"])
+    RESUME = config["DEFAULT"].getboolean("RESUME")
+    PROFILE = config["DEFAULT"].getboolean("PROFILE")
+    PROFILE_DIR = config["DEFAULT"]["PROFILE_DIR"]
+    PROFILE_TENSORBOARD = config["DEFAULT"].getboolean("PROFILE_TENSORBOARD")
 
     print("NUM_TRAINING: {}".format(NUM_TRAINING))
     print("NUM_VALIDATION: {}".format(NUM_VALIDATION))
@@ -74,14 +115,97 @@ def main():
     print("IMAGE_WIDTH: {}".format(IMAGE_WIDTH))
     print("IMAGE_HEIGHT: {}".format(IMAGE_HEIGHT))
     print("IMAGE_DEPTH: {}".format(IMAGE_DEPTH))
+    print("PLANES: {}".format(PLANES))
+    print("PLANE_MODE: {}".format(PLANE_MODE))
     print("CLASS_NAMES: {}".format(CLASS_NAMES))
     print("FEATURE_FILE_TRAINING: {}".format(FEATURE_FILE_TRAINING))
     print("LABEL_FILE_TRAINING: {}".format(LABEL_FILE_TRAINING))
     print("FEATURE_FILE_VALIDATION: {}".format(FEATURE_FILE_VALIDATION))
     print("LABEL_FILE_VALIDATION: {}".format(LABEL_FILE_VALIDATION))
     print("WEIGHTS: {}".format(WEIGHTS))
+    print("WEIGHTS_FILE: {}".format(WEIGHTS_FILE))
+    print("DATA_FORMAT: {}".format(DATA_FORMAT))
+    print("FLOAT_DTYPE: {}".format(FLOAT_DTYPE))
+    print("SHUFFLE: {}".format(SHUFFLE))
+    print("PATCH_SIZE: {}".format(PATCH_SIZE))
+    print("PATCHES_PER_EVENT: {}".format(PATCHES_PER_EVENT))
+    print("EMPTY_PATCH_RATIO: {}".format(EMPTY_PATCH_RATIO))
+    print("NUM_FILTERS: {}".format(NUM_FILTERS))
+    print("DEPTH: {}".format(DEPTH))
+    print("WIDTH_MULTIPLIER: {}".format(WIDTH_MULTIPLIER))
+    print("SEPARABLE: {}".format(SEPARABLE))
+    print("ADDITIVE_SKIPS: {}".format(ADDITIVE_SKIPS))
+    print("DROPOUT: {}".format(DROPOUT))
+    print("LOADER: {}".format(LOADER))
+    print("WORKERS: {}".format(WORKERS))
+    print("MAX_QUEUE_SIZE: {}".format(MAX_QUEUE_SIZE))
+    print("CACHE_MEMORY_MB: {}".format(CACHE_MEMORY_MB))
+    print("CACHE_DIR: {}".format(CACHE_DIR))
+    print("SAMPLER: {}".format(SAMPLER))
+    print("SAMPLER_MIN_HITS: {}".format(SAMPLER_MIN_HITS))
+    print("SAMPLER_RICH_CLASS: {}".format(SAMPLER_RICH_CLASS))
+    print("SAMPLER_RICH_PIXELS: {}".format(SAMPLER_RICH_PIXELS))
+    print("SAMPLER_OVERSAMPLE: {}".format(SAMPLER_OVERSAMPLE))
+    print("MONITOR: {}".format(MONITOR))
+    print("CHECKPOINT_DIR: {}".format(CHECKPOINT_DIR))
+    print("CHECKPOINT_KEEP: {}".format(CHECKPOINT_KEEP))
+    print("RESUME: {}".format(RESUME))
+    print("PROFILE: {}".format(PROFILE))
+    print("PROFILE_DIR: {}".format(PROFILE_DIR))
+    print("PROFILE_TENSORBOARD: {}".format(PROFILE_TENSORBOARD))
     print()
 
+    if LOADER not in ["thread", "process"]:
+        print("\nError: LOADER should be either 'thread' or 'process'")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    if CHECKPOINT_KEEP < 1:
+        print("\nError: CHECKPOINT_KEEP should be at least 1")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    # The U-Net halves the image DEPTH times
+    if PATCH_SIZE % 2**DEPTH or PATCH_SIZE > min(IMAGE_WIDTH, IMAGE_HEIGHT):
+        print("\nError: PATCH_SIZE should be a multiple of 2**DEPTH that fits in the image")
+        print("Exiting!\n")
+        sys.exit(1)
+    if not PATCH_SIZE and (IMAGE_WIDTH % 2**DEPTH or IMAGE_HEIGHT % 2**DEPTH):
+        print("\nError: IMAGE_WIDTH and IMAGE_HEIGHT should be multiples of 2**DEPTH")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    if not PLANES or any(plane not in ALL_PLANES for plane in PLANES) or PLANE_MODE not in PLANE_MODES:
+        print("\nError: PLANES should be some of {} and PLANE_MODE one of {}".format(ALL_PLANES, PLANE_MODES))
+        print("Exiting!\n")
+        sys.exit(1)
+    if len(PLANES) > 1 and IMAGE_DEPTH != (len(PLANES) if PLANE_MODE == "channels" else 1):
+        print("\nError: IMAGE_DEPTH should be the number of PLANES as channels, 1 as inputs")
+        print("Exiting!\n")
+        sys.exit(1)
+    # The planes are predicted from several inputs only in 'inputs' mode
+    MULTIPLE_INPUTS = len(PLANES) > 1 and PLANE_MODE == "inputs"
+
+    if SAMPLER and SAMPLER_RICH_CLASS not in CLASS_NAMES:
+        print("\nError: SAMPLER_RICH_CLASS should be one of {}".format(CLASS_NAMES))
+        print("Exiting!\n")
+        sys.exit(1)
+    if SAMPLER and SAMPLER_OVERSAMPLE < 1.0:
+        print("\nError: SAMPLER_OVERSAMPLE should be at least 1")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    # Only the training events are sampled; validation sees every event once
+    sampler = None
+    if SAMPLER:
+        # Statistics of the plane whose labels are the targets
+        index = get_event_index(get_plane_file(FEATURE_FILE_TRAINING, PLANES[-1]),
+                                get_plane_file(LABEL_FILE_TRAINING, PLANES[-1]), DATA_FORMAT,
+                                (IMAGE_WIDTH, IMAGE_HEIGHT), len(CLASS_NAMES), WORKERS)
+        sampler = EventSampler(index, min_hits=SAMPLER_MIN_HITS, rich_class=CLASS_NAMES.index(SAMPLER_RICH_CLASS),
+                               rich_pixels=SAMPLER_RICH_PIXELS, oversample=SAMPLER_OVERSAMPLE)
+        print(sampler.report(min(NUM_TRAINING, len(index["hits"])), CLASS_NAMES))
+
     datasequence_training = DataSequence(feature_file=FEATURE_FILE_TRAINING,
                                          label_file=LABEL_FILE_TRAINING,
                                          image_width=IMAGE_WIDTH,
@@ -89,7 +213,18 @@ def main():
                                          image_depth=IMAGE_DEPTH,
                                          num_classes=len(CLASS_NAMES),
                                          max_index=NUM_TRAINING,
-                                         batch_size=BATCH_SIZE)
+                                         batch_size=BATCH_SIZE,
+                                         data_format=DATA_FORMAT,
+                                         shuffle=SHUFFLE,
+                                         dtype=FLOAT_DTYPE,
+                                         patch_size=PATCH_SIZE,
+                                         patches_per_event=PATCHES_PER_EVENT,
+                                         empty_patch_ratio=EMPTY_PATCH_RATIO,
+                                         cache_memory=CACHE_MEMORY_MB*2**20,
+                                         cache_dir=CACHE_DIR,
+                                         sampler=sampler,
+                                         planes=PLANES,
+                                         plane_mode=PLANE_MODE)
 
     datasequence_validation = DataSequence(feature_file=FEATURE_FILE_VALIDATION,
                                            label_file=LABEL_FILE_VALIDATION,
@@ -98,23 +233,54 @@ def main():
                                            image_depth=IMAGE_DEPTH,
                                            num_classes=len(CLASS_NAMES),
                                            max_index=NUM_VALIDATION,
-                                           batch_size=BATCH_SIZE)
+                                           batch_size=BATCH_SIZE,
+                                           data_format=DATA_FORMAT,
+                                           dtype=FLOAT_DTYPE,
+                                           cache_memory=CACHE_MEMORY_MB*2**20,
+                                           cache_dir=CACHE_DIR,
+                                           planes=PLANES,
+                                           plane_mode=PLANE_MODE)
 
     # Note: num_filters needs to be 16 or less for batch size of 5 (for 6 GB memory)
 
+    # Build the model with the same float type as the batches
+    set_float_dtype(FLOAT_DTYPE)
+
     # Compile the model
-    input_tensor = Input((IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH))
+    # Trained on patches, the fully convolutional model takes any image size
+    # so that it is validated, and later used, on the full image
+    if PATCH_SIZE:
+        input_shape = (None, None, IMAGE_DEPTH)
+    else:
+        input_shape = (IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DEPTH)
 
-    model = get_unet_model(input_tensor=input_tensor, num_classes=len(CLASS_NAMES), num_filters=64,
-                           dropout=0.25,
-                           batchnorm=True)
+    if MULTIPLE_INPUTS:
+        input_tensors = [Input(input_shape, name="input_{}".format(plane)) for plane in PLANES]
+        model = get_multiplane_unet_model(input_tensors=input_tensors, num_classes=len(CLASS_NAMES),
+                                          num_filters=NUM_FILTERS, dropout=DROPOUT, batchnorm=True, depth=DEPTH,
+                                          width_multiplier=WIDTH_MULTIPLIER, separable=SEPARABLE,
+                                          additive_skips=ADDITIVE_SKIPS)
+    else:
+        model = get_unet_model(input_tensor=Input(input_shape), num_classes=len(CLASS_NAMES), num_filters=NUM_FILTERS,
+                               dropout=DROPOUT,
+                               batchnorm=True, depth=DEPTH, width_multiplier=WIDTH_MULTIPLIER, separable=SEPARABLE,
+                               additive_skips=ADDITIVE_SKIPS)
+    print("Model: {} parameters{}".format(model.count_params(), "" if PATCH_SIZE else
+                                           ", {:.2f} GFLOPs per image".format(count_flops(model)/1e9)))
 
+    # Targets are fed as uint8 class maps; the sparse losses make the one-hot tensor in the graph
+    target_tensor = K.placeholder(ndim=4, dtype="uint8", name="target")
+    # The confusion matrix is accumulated in the graph during the validation pass,
+    # which gives val_mean_iou and the per-class report at no extra inference cost
+    confusion_matrix = ConfusionMatrix(num_classes=len(CLASS_NAMES))
     model.compile(optimizer=SGD(lr=1e-5, decay=0.0),
-                  loss=focal_loss(),
-                  metrics=['accuracy'])
+                  loss=sparse_focal_loss(),
+                  metrics=[sparse_accuracy, confusion_matrix],
+                  target_tensors=[target_tensor])
 
     model_and_weights = os.path.join("saved_models", "model_and_weights.hdf5")
-    # If weights exist, load them before continuing training
+    # If weights exist, load them before continuing training; a checkpoint of this run found with
+    # RESUME replaces them, together with the rest of the training state, when training starts
     continue_training = True
     if(os.path.isfile(model_and_weights) and continue_training):
         print("Old weights found!")
@@ -124,18 +290,48 @@ def main():
         except:
             print("Old weights couldn't be loaded successfully, will continue!")
 
+    # One directory per run (and per SLURM job), so that runs don't overwrite each other
+    profiler = None
+    if PROFILE:
+        run_name = time.strftime("%Y%m%d_%H%M%S")
+        if "SLURM_JOB_ID" in os.environ:
+            run_name += "_job_{}".format(os.environ["SLURM_JOB_ID"])
+        profiler = StepProfiler(os.path.join(PROFILE_DIR, run_name), sequence=datasequence_training,
+                                tensorboard=PROFILE_TENSORBOARD)
+
+    # A checkpoint is only resumed by a run of the same model on the same events and epochs
+    run_settings = {"OPERATION": args["operation"], "NUM_TRAINING": NUM_TRAINING, "NUM_VALIDATION": NUM_VALIDATION,
+                    "NUM_EPOCHS": NUM_EPOCHS, "BATCH_SIZE": BATCH_SIZE, "PLANES": PLANES, "PLANE_MODE": PLANE_MODE,
+                    "FEATURE_FILE_TRAINING": FEATURE_FILE_TRAINING, "LABEL_FILE_TRAINING": LABEL_FILE_TRAINING,
+                    "FEATURE_FILE_VALIDATION": FEATURE_FILE_VALIDATION, "LABEL_FILE_VALIDATION": LABEL_FILE_VALIDATION,
+                    "DATA_FORMAT": DATA_FORMAT, "FLOAT_DTYPE": FLOAT_DTYPE, "SHUFFLE": SHUFFLE,
+                    "PATCH_SIZE": PATCH_SIZE, "PATCHES_PER_EVENT": PATCHES_PER_EVENT,
+                    "EMPTY_PATCH_RATIO": EMPTY_PATCH_RATIO, "SAMPLER": SAMPLER, "SAMPLER_MIN_HITS": SAMPLER_MIN_HITS,
+                    "SAMPLER_RICH_CLASS": SAMPLER_RICH_CLASS, "SAMPLER_RICH_PIXELS": SAMPLER_RICH_PIXELS,
+                    "SAMPLER_OVERSAMPLE": SAMPLER_OVERSAMPLE, "MONITOR": MONITOR}
+
     # Traing the model
     history = train_model(model=model,
                           X=datasequence_training, y=datasequence_validation,
-                          num_training=NUM_TRAINING, num_validation=NUM_VALIDATION,
-                          model_path=model_and_weights, num_epochs=NUM_EPOCHS, batch_size=BATCH_SIZE)
+                          model_path=model_and_weights, num_epochs=NUM_EPOCHS, workers=WORKERS,
+                          use_multiprocessing=(LOADER == "process"), max_queue_size=MAX_QUEUE_SIZE,
+                          monitor=MONITOR, class_metrics_report=ClassMetricsReport(confusion_matrix, CLASS_NAMES),
+                          profiler=profiler, checkpoint_dir=CHECKPOINT_DIR, keep_checkpoints=CHECKPOINT_KEEP,
+                          resume=RESUME, run_settings=run_settings)
+
+    for datasequence, split in [(datasequence_training, "training"), (datasequence_validation, "validation")]:
+        if datasequence.cache is not None:
+            print("Cache of the {} events: {}".format(split, datasequence.cache.report()))
 
     # Plot the history
     loss_path = os.path.join("plots", "loss_vs_epoch.pdf")
     plot_history(history, quantity='loss', plot_title='Loss', y_label='Loss', plot_name=loss_path)
 
     accuracy_path = os.path.join("plots", "accuracy_vs_epoch.pdf")
-    plot_history(history, quantity='acc', plot_title='Accuracy', y_label='Accuracy', plot_name=accuracy_path)
+    plot_history(history, quantity='sparse_accuracy', plot_title='Accuracy', y_label='Accuracy', plot_name=accuracy_path)
+
+    iou_path = os.path.join("plots", "iou_vs_epoch.pdf")
+    plot_history(history, quantity='mean_iou', plot_title='Mean IoU', y_label='Mean IoU', plot_name=iou_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,396 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import configparser
+import multiprocessing
+
+# Data-parallel training runs on the CPU cores; every replica gets its share of them
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+from keras import backend as K
+from keras.layers import Input
+from keras.optimizers import SGD
+from keras.callbacks import History
+from tools.data_tools import DataSequence, PLANE_MODES
+from tools.store_tools import PLANES as ALL_PLANES, get_plane_file
+from tools.index_tools import get_event_index, EventSampler
+from tools.plotting_tools import plot_history
+from tools.thread_tools import iterate_in_thread
+from tools.model_tools import get_unet_model, get_multiplane_unet_model, set_float_dtype
+from tools.loss_metrics_tools import sparse_focal_loss, sparse_accuracy
+from tools.benchmark_tools import add_result, save_results
+from tools.parallel_tools import ReplicaGroup, make_step_functions, flatten_arrays, unflatten_array, make_authkey
+from tools.parallel_tools import get_scaling_efficiency
+
+def argument_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-o", "--operation", required=True,
+	   help="Choose operation between 'Training' or 'Development.'")
+    ap.add_argument("-e", "--epoch", default="Default",
+	   help="Options are 'Default' or a number.")
+    ap.add_argument("-w", "--workers", default="2",
+	   help="Number of replicas; each trains on its own shard of the training events.")
+    ap.add_argument("-r", "--rank", default=None,
+	   help="Run only this replica (0 to workers-1), e.g. one per SLURM task; all of them on this machine by default.")
+    ap.add_argument("-a", "--address", default="localhost:29500",
+	   help="host:port where replica 0 listens.")
+    ap.add_argument("-t", "--threads", default="0",
+	   help="Threads of every replica; 0 shares the cores of this machine between the local replicas.")
+    ap.add_argument("-s", "--scaling", default=None,
+	   help="Comma separated worker counts (e.g. 1,2,4) to measure the scaling efficiency instead of training.")
+    ap.add_argument("--steps", default="10",
+	   help="Timed steps of every worker count when measuring the scaling.")
+    ap.add_argument("-j", "--json", default=None,
+	   help="Save the scaling results to this JSON file.")
+    return vars(ap.parse_args())
+
+def get_event_sampler(settings):
+    # Statistics of the plane whose labels are the targets
+    plane = settings["PLANES"][-1]
+    index = get_event_index(get_plane_file(settings["FEATURE_FILE_TRAINING"], plane),
+                            get_plane_file(settings["LABEL_FILE_TRAINING"], plane), settings["DATA_FORMAT"],
+                            (settings["IMAGE_WIDTH"], settings["IMAGE_HEIGHT"]), len(settings["CLASS_NAMES"]))
+    return EventSampler(index, min_hits=settings["SAMPLER_MIN_HITS"],
+                        rich_class=settings["CLASS_NAMES"].index(settings["SAMPLER_RICH_CLASS"]),
+                        rich_pixels=settings["SAMPLER_RICH_PIXELS"], oversample=settings["SAMPLER_OVERSAMPLE"])
+
+def make_sequence(settings, split, num_replicas, rank):
+    # Sampled with the shared seed, every replica draws the same events before taking its shard
+    sampler = get_event_sampler(settings) if settings["SAMPLER"] and split == "TRAINING" else None
+    return DataSequence(feature_file=settings["FEATURE_FILE_" + split],
+                        label_file=settings["LABEL_FILE_" + split],
+                        image_width=settings["IMAGE_WIDTH"],
+                        image_height=settings["IMAGE_HEIGHT"],
+                        image_depth=settings["IMAGE_DEPTH"],
+                        num_classes=len(settings["CLASS_NAMES"]),
+                        max_index=settings["NUM_" + split],
+                        batch_size=settings["BATCH_SIZE"],
+                        data_format=settings["DATA_FORMAT"],
+                        shuffle=settings["SHUFFLE"] if split == "TRAINING" else False,
+                        dtype=settings["FLOAT_DTYPE"],
+                        patch_size=settings["PATCH_SIZE"] if split == "TRAINING" else 0,
+                        patches_per_event=settings["PATCHES_PER_EVENT"],
+                        empty_patch_ratio=settings["EMPTY_PATCH_RATIO"],
+                        num_shards=num_replicas,
+                        shard=rank,
+                        sampler=sampler,
+                        planes=settings["PLANES"],
+                        plane_mode=settings["PLANE_MODE"])
+
+def allreduce_means(group, sums, count):
+    """
+    Means over the events of all replicas from the per-replica sums and event counts.
+    """
+    totals = group.allreduce_mean(np.append(sums, count))
+    return totals[:-1]/max(totals[-1], 1e-9)
+
+def run_replica(rank, num_replicas, address, threads, settings, scaling_steps=0, results=None):
+    """
+    One replica: reads its shard of the events, computes gradients on its own copy of the model
+    and applies the gradients averaged over all replicas, so that the copies stay identical.
+    Replica 0 reports, saves the best model and plots the history.
+    With scaling_steps, only times that many steps and puts the throughput in 'results'.
+    """
+    import tensorflow as tf
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                   inter_op_parallelism_threads=threads)))
+    group = ReplicaGroup(rank, num_replicas, address)
+
+    training = make_sequence(settings, "TRAINING", num_replicas, rank)
+    validation = make_sequence(settings, "VALIDATION", num_replicas, rank)
+    # The same seed everywhere shuffles the events the same way, so the shards stay disjoint
+    seed = int(group.broadcast(np.array([training.seed % 2**24]))[0])
+    training.set_epoch(0, seed)
+
+    set_float_dtype(settings["FLOAT_DTYPE"])
+    if settings["PATCH_SIZE"]:
+        input_shape = (None, None, settings["IMAGE_DEPTH"])
+    else:
+        input_shape = (settings["IMAGE_WIDTH"], settings["IMAGE_HEIGHT"], settings["IMAGE_DEPTH"])
+    if len(settings["PLANES"]) > 1 and settings["PLANE_MODE"] == "inputs":
+        input_tensors = [Input(input_shape, name="input_{}".format(plane)) for plane in settings["PLANES"]]
+        model = get_multiplane_unet_model(input_tensors=input_tensors, num_classes=len(settings["CLASS_NAMES"]),
+                                          num_filters=settings["NUM_FILTERS"], dropout=settings["DROPOUT"],
+                                          batchnorm=True, depth=settings["DEPTH"],
+                                          width_multiplier=settings["WIDTH_MULTIPLIER"],
+                                          separable=settings["SEPARABLE"], additive_skips=settings["ADDITIVE_SKIPS"])
+    else:
+        model = get_unet_model(input_tensor=Input(input_shape), num_classes=len(settings["CLASS_NAMES"]),
+                               num_filters=settings["NUM_FILTERS"], dropout=settings["DROPOUT"], batchnorm=True,
+                               depth=settings["DEPTH"], width_multiplier=settings["WIDTH_MULTIPLIER"],
+                               separable=settings["SEPARABLE"], additive_skips=settings["ADDITIVE_SKIPS"])
+    target_tensor = K.placeholder(ndim=4, dtype="uint8", name="target")
+    optimizer = SGD(lr=1e-5, decay=0.0)
+    # Compiled only so that the saved model loads like the one of train_model.py
+    model.compile(optimizer=optimizer, loss=sparse_focal_loss(), metrics=[sparse_accuracy],
+                  target_tensors=[target_tensor])
+    compute_gradients, apply_gradients, evaluate_batch = make_step_functions(model, sparse_focal_loss(), optimizer,
+                                                                             target_tensor, sparse_accuracy)
+
+    model_and_weights = os.path.join("saved_models", "model_and_weights.hdf5")
+    if rank == 0 and not scaling_steps and os.path.isfile(model_and_weights):
+        print("Old weights found!")
+        try:
+            model.load_weights(model_and_weights)
+            print("Old weights loaded successfully!")
+        except:
+            print("Old weights couldn't be loaded successfully, will continue!")
+    # Every replica starts from the weights of replica 0
+    weights = model.get_weights()
+    model.set_weights(unflatten_array(group.broadcast(flatten_arrays(weights)), weights))
+
+    def train_step(X, y):
+        start = time.time()
+        outputs = compute_gradients([X, y])
+        computed = time.time()
+        gradients = unflatten_array(group.allreduce_mean(flatten_arrays(outputs[2:])), outputs[2:])
+        communicated = time.time()
+        apply_gradients(gradients)
+        return outputs[:2], (computed - start) + (time.time() - communicated), communicated - computed
+
+    if scaling_steps:
+        batches = iterate_in_thread(training[step % len(training)] for step in range(scaling_steps + 1))
+        # The first step builds the functions
+        train_step(*next(batches))
+        start = time.time()
+        compute, communicate, samples = 0.0, 0.0, 0
+        for X, y in batches:
+            _, step_compute, step_communicate = train_step(X, y)
+            compute += step_compute
+            communicate += step_communicate
+            samples += len(y)
+        duration = time.time() - start
+        if rank == 0:
+            results.put({"samples_per_s": num_replicas*samples/duration, "compute_s": compute,
+                         "communicate_s": communicate, "seconds": duration})
+        group.close()
+        return
+
+    history = History()
+    history.history = {}
+    best = np.inf
+    for epoch in range(settings["NUM_EPOCHS"]):
+        if epoch:
+            training.set_epoch(epoch)
+        start = time.time()
+        last = start
+        wait, compute, communicate = 0.0, 0.0, 0.0
+        sums, count = np.zeros(2), 0
+        for X, y in iterate_in_thread(training[index] for index in range(len(training))):
+            wait += time.time() - last
+            (loss, accuracy), step_compute, step_communicate = train_step(X, y)
+            last = time.time()
+            compute += step_compute
+            communicate += step_communicate
+            sums += [loss*len(y), accuracy*len(y)]
+            count += len(y)
+        duration = time.time() - start
+
+        # BatchNormalization statistics are updated by every replica on its own events
+        moving = K.batch_get_value(model.non_trainable_weights)
+        if moving:
+            K.batch_set_value(zip(model.non_trainable_weights,
+                                  unflatten_array(group.allreduce_mean(flatten_arrays(moving)), moving)))
+        loss, accuracy = allreduce_means(group, sums, count)
+
+        val_sums, val_count = np.zeros(2), 0
+        for index in range(len(validation)):
+            X, y = validation[index]
+            val_sums += np.array(evaluate_batch([X, y]))*len(y)
+            val_count += len(y)
+        val_loss, val_accuracy = allreduce_means(group, val_sums, val_count)
+
+        if rank == 0:
+            logs = {"loss": loss, "sparse_accuracy": accuracy, "val_loss": val_loss,
+                    "val_sparse_accuracy": val_accuracy}
+            for name, value in logs.items():
+                history.history.setdefault(name, []).append(value)
+            print("Epoch {}/{} - {:.0f}s - loss: {:.4f} - sparse_accuracy: {:.4f} - val_loss: {:.4f}"
+                  " - val_sparse_accuracy: {:.4f}".format(epoch + 1, settings["NUM_EPOCHS"], duration, loss, accuracy,
+                                                          val_loss, val_accuracy))
+            print("Epoch {}: {:.2f} samples/s over {} replicas; {:.1f}% waiting on data, {:.1f}% computing,"
+                  " {:.1f}% averaging gradients".format(epoch + 1, num_replicas*count/max(duration, 1e-9),
+                                                       num_replicas, 100.0*wait/max(duration, 1e-9),
+                                                       100.0*compute/max(duration, 1e-9),
+                                                       100.0*communicate/max(duration, 1e-9)))
+            if val_loss < best:
+                print("Epoch {}: val_loss improved from {:.5f} to {:.5f}, saving model to {}".format(
+                    epoch + 1, best, val_loss, model_and_weights))
+                best = val_loss
+                model.save(model_and_weights)
+    group.close()
+
+    if rank == 0 and settings["NUM_EPOCHS"]:
+        loss_path = os.path.join("plots", "loss_vs_epoch.pdf")
+        plot_history(history, quantity='loss', plot_title='Loss', y_label='Loss', plot_name=loss_path)
+
+        accuracy_path = os.path.join("plots", "accuracy_vs_epoch.pdf")
+        plot_history(history, quantity='sparse_accuracy', plot_title='Accuracy', y_label='Accuracy',
+                     plot_name=accuracy_path)
+
+def launch_replicas(num_replicas, address, threads, settings, scaling_steps=0):
+    """
+    All replicas as processes of this machine; fresh (spawned) processes, each with its own TensorFlow.
+    """
+    # The spawned replicas inherit the key through the environment
+    make_authkey()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=run_replica,
+                                 args=(rank, num_replicas, address, threads, settings, scaling_steps, results))
+                 for rank in range(num_replicas)]
+    for process in processes:
+        process.start()
+    result = None
+    if scaling_steps and wait_for_result(processes, results):
+        result = results.get()
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        print("\nError: A replica failed with exit codes {}".format([process.exitcode for process in processes]))
+        print("Exiting!\n")
+        sys.exit(1)
+    return result
+
+def wait_for_result(processes, results):
+    """
+    Wait for the result of replica 0 unless a replica fails first.
+    """
+    while results.empty():
+        if any(process.exitcode not in [None, 0] for process in processes):
+            return False
+        time.sleep(0.1)
+    return True
+
+def main():
+    args = argument_parser()
+    config = configparser.ConfigParser()
+    config_path = os.path.join("configurations", "master_configuration.ini")
+    config.read(config_path)
+    print("\nReading info from configuration:")
+
+    if args["operation"] not in ["Training", "Development"]:
+        print("\nError: Operation should be either 'Training' or 'Development'")
+        print("Exiting!\n")
+        sys.exit(1)
+    section = args["operation"].upper()
+
+    try:
+        WORKERS = int(args["workers"])
+        THREADS = int(args["threads"])
+        STEPS = int(args["steps"])
+        RANK = int(args["rank"]) if args["rank"] is not None else None
+        SCALING = [int(n) for n in args["scaling"].split(",")] if args["scaling"] else None
+        NUM_EPOCHS = int(config[section]["NUM_EPOCHS"]) if args["epoch"] == "Default" else int(args["epoch"])
+    except ValueError:
+        print("\nError: Epoch should be 'Default' or an integer; workers, rank, threads, steps and scaling integers.")
+        print("Exiting!\n")
+        sys.exit(1)
+    if RANK is not None and not 0 <= RANK < WORKERS:
+        print("\nError: Rank should be between 0 and workers-1")
+        print("Exiting!\n")
+        sys.exit(1)
+    # Replicas started one by one can't share a generated key
+    if RANK is not None and WORKERS > 1 and not os.environ.get("PARALLEL_AUTHKEY"):
+        print("\nError: Set the same secret PARALLEL_AUTHKEY for all replicas, e.g. $(openssl rand -hex 16)")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    settings = {"NUM_TRAINING": int(config[section]["NUM_TRAINING"]),
+                "NUM_VALIDATION": int(config[section]["NUM_VALIDATION"]),
+                "NUM_EPOCHS": NUM_EPOCHS,
+                "BATCH_SIZE": int(config["DEFAULT"]["BATCH_SIZE"]),
+                "IMAGE_WIDTH": int(config["DEFAULT"]["IMAGE_WIDTH"]),
+                "IMAGE_HEIGHT": int(config["DEFAULT"]["IMAGE_HEIGHT"]),
+                "IMAGE_DEPTH": int(config["DEFAULT"]["IMAGE_DEPTH"]),
+                "PLANES": config["DEFAULT"]["PLANES"].split(),
+                "PLANE_MODE": config["DEFAULT"]["PLANE_MODE"],
+                "CLASS_NAMES": config["DEFAULT"]["CLASS_NAMES"].split(),
+                "FEATURE_FILE_TRAINING": config["DEFAULT"]["FEATURE_FILE_TRAINING"],
+                "LABEL_FILE_TRAINING": config["DEFAULT"]["LABEL_FILE_TRAINING"],
+                "FEATURE_FILE_VALIDATION": config["DEFAULT"]["FEATURE_FILE_VALIDATION"],
+                "LABEL_FILE_VALIDATION": config["DEFAULT"]["LABEL_FILE_VALIDATION"],
+                "DATA_FORMAT": config["DEFAULT"]["DATA_FORMAT"],
+                "FLOAT_DTYPE": config["DEFAULT"]["FLOAT_DTYPE"],
+                "SHUFFLE": config["DEFAULT"].getboolean("SHUFFLE"),
+                "PATCH_SIZE": int(config["DEFAULT"]["PATCH_SIZE"]),
+                "PATCHES_PER_EVENT": int(config["DEFAULT"]["PATCHES_PER_EVENT"]),
+                "EMPTY_PATCH_RATIO": float(config["DEFAULT"]["EMPTY_PATCH_RATIO"]),
+                "NUM_FILTERS": int(config["DEFAULT"]["NUM_FILTERS"]),
+                "DEPTH": int(config["DEFAULT"]["DEPTH"]),
+                "WIDTH_MULTIPLIER": float(config["DEFAULT"]["WIDTH_MULTIPLIER"]),
+                "SEPARABLE": config["DEFAULT"].getboolean("SEPARABLE"),
+                "ADDITIVE_SKIPS": config["DEFAULT"].getboolean("ADDITIVE_SKIPS"),
+                "DROPOUT": float(config["DEFAULT"]["DROPOUT"]),
+                "SAMPLER": config["DEFAULT"].getboolean("SAMPLER"),
+                "SAMPLER_MIN_HITS": int(config["DEFAULT"]["SAMPLER_MIN_HITS"]),
+                "SAMPLER_RICH_CLASS": config["DEFAULT"]["SAMPLER_RICH_CLASS"],
+                "SAMPLER_RICH_PIXELS": int(config["DEFAULT"]["SAMPLER_RICH_PIXELS"]),
+                "SAMPLER_OVERSAMPLE": float(config["DEFAULT"]["SAMPLER_OVERSAMPLE"])}
+    for name, value in settings.items():
+        print("{}: {}".format(name, value))
+    print("WORKERS: {}".format(WORKERS))
+    print("ADDRESS: {}".format(args["address"]))
+    print()
+
+    # The U-Net halves the image DEPTH times
+    size = settings["PATCH_SIZE"]
+    if size % 2**settings["DEPTH"] or size > min(settings["IMAGE_WIDTH"], settings["IMAGE_HEIGHT"]):
+        print("\nError: PATCH_SIZE should be a multiple of 2**DEPTH that fits in the image")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    planes = settings["PLANES"]
+    if not planes or any(plane not in ALL_PLANES for plane in planes) or settings["PLANE_MODE"] not in PLANE_MODES:
+        print("\nError: PLANES should be some of {} and PLANE_MODE one of {}".format(ALL_PLANES, PLANE_MODES))
+        print("Exiting!\n")
+        sys.exit(1)
+    if len(planes) > 1 and settings["IMAGE_DEPTH"] != (len(planes) if settings["PLANE_MODE"] == "channels" else 1):
+        print("\nError: IMAGE_DEPTH should be the number of PLANES as channels, 1 as inputs")
+        print("Exiting!\n")
+        sys.exit(1)
+
+    if settings["SAMPLER"]:
+        if settings["SAMPLER_RICH_CLASS"] not in settings["CLASS_NAMES"] or settings["SAMPLER_OVERSAMPLE"] < 1.0:
+            print("\nError: SAMPLER_RICH_CLASS should be one of {} and SAMPLER_OVERSAMPLE at least 1".format(
+                settings["CLASS_NAMES"]))
+            print("Exiting!\n")
+            sys.exit(1)
+        # Scanned once here, the replicas read the cached index
+        sampler = get_event_sampler(settings)
+        print(sampler.report(min(settings["NUM_TRAINING"], len(sampler.index["hits"])), settings["CLASS_NAMES"]))
+
+    if SCALING:
+        # The same total number of cores is shared by the replicas of every count
+        throughputs = {}
+        results = {}
+        for num_replicas in SCALING:
+            threads = THREADS or max(1, os.cpu_count()//num_replicas)
+            print("\nTiming {} steps with {} replicas of {} threads".format(STEPS, num_replicas, threads))
+            result = launch_replicas(num_replicas, args["address"], threads, settings, STEPS)
+            throughputs[num_replicas] = result["samples_per_s"]
+            share = result["communicate_s"]/max(result["seconds"], 1e-9)
+            add_result(results, "parallel/replicas_{}/speed".format(num_replicas), result["samples_per_s"], "samples/s")
+            add_result(results, "parallel/replicas_{}/communication".format(num_replicas), 100.0*share, "%",
+                       higher_is_better=False)
+
+        scaling = get_scaling_efficiency(throughputs)
+        for num_replicas, _, _, efficiency in scaling:
+            add_result(results, "parallel/replicas_{}/efficiency".format(num_replicas), 100.0*efficiency, "%")
+        print("\n{:>8s} {:>12s} {:>9s} {:>11s}".format("Replicas", "Samples/s", "Speed-up", "Efficiency"))
+        for num_replicas, throughput, speed_up, efficiency in scaling:
+            print("{:8d} {:12.3f} {:8.2f}x {:10.1f}%".format(num_replicas, throughput, speed_up, 100.0*efficiency))
+        if args["json"]:
+            save_results(args["json"], results, dict(settings, steps=STEPS, threads=THREADS))
+            print("\nResults are saved in {}".format(args["json"]))
+    elif RANK is not None:
+        run_replica(RANK, WORKERS, args["address"], THREADS or os.cpu_count(), settings)
+    else:
+        launch_replicas(WORKERS, args["address"], THREADS or max(1, os.cpu_count()//WORKERS), settings)
+
+    print("\nDone!\n")
+
+if __name__ == "__main__":
+    main()